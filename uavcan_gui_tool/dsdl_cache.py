@@ -0,0 +1,187 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Parsing a large DSDL tree takes seconds, and it used to be done by the main process and by every tool process.
+The list of parsed types is stored on disk, keyed by the hash of the contents of the definition files; the cache is
+used while the set of files and their hashes stay the same. Hashes of files whose modification time and size have not
+changed are not recomputed, so checking the cache costs one stat() per file.
+"""
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import logging
+import uavcan
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_cache_directory():
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'uavcan_gui_tool', 'dsdl_cache')
+
+
+# The cache is unpickled, which can execute arbitrary code, so it is kept in a private directory of the user
+CACHE_DIRECTORY = _get_cache_directory()
+
+_FORMAT_VERSION = 1
+_DSDL_FILE_EXTENSION = '.uavcan'
+
+
+def _make_compound_type(*args):
+    # The constructor creates the bit length getters, which are lambdas and cannot be pickled
+    return uavcan.dsdl.CompoundType(*args)
+
+
+def _reduce_compound_type(t):
+    state = {k: v for k, v in t.__dict__.items() if not callable(v)}
+    return _make_compound_type, (t.full_name, t.kind, t.source_file, t.default_dtid, t.version, t.source_text), state
+
+
+def _dump_types(types, f):
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = {uavcan.dsdl.CompoundType: _reduce_compound_type}
+    pickler.dump(types)
+
+
+def _list_files(dirs):
+    out = []
+    for d in dirs:
+        for root, _dirs, files in os.walk(d):
+            out += [os.path.join(root, x) for x in files if x.endswith(_DSDL_FILE_EXTENSION)]
+    return sorted(out)
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _index_files(dirs, old_index):
+    """Returns {path: (mtime, size, hash)}; the hashes of the files that have not been touched are taken as is"""
+    index = {}
+    for path in _list_files(dirs):
+        st = os.stat(path)
+        old = old_index.get(path)
+        if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+            index[path] = old
+        else:
+            index[path] = st.st_mtime_ns, st.st_size, _hash_file(path)
+    return index
+
+
+def _compute_digest(index):
+    h = hashlib.sha256()
+    for path, (_mtime, _size, file_hash) in sorted(index.items()):
+        h.update(('%s\0%s\0' % (path, file_hash)).encode())
+    return h.hexdigest()
+
+
+def _get_cache_path(source_dirs, search_dirs):
+    key = repr((sys.version_info[:2], uavcan.__version__, source_dirs, search_dirs)).encode()
+    return os.path.join(CACHE_DIRECTORY, hashlib.sha1(key).hexdigest() + '.pickle')
+
+
+def _is_private(st):
+    """Whether the stat result belongs to a file owned by the current user, and not writable by anyone else"""
+    if not hasattr(os, 'getuid'):
+        return True         # Windows; the directory is in the profile of the user
+    return st.st_uid == os.getuid() and not (st.st_mode & 0o022)
+
+
+def _read_cache(path):
+    try:
+        if not _is_private(os.stat(os.path.dirname(path))):
+            logger.warning('DSDL cache directory %r is not private to the current user, ignoring it',
+                           os.path.dirname(path))
+        else:
+            with open(path, 'rb') as f:
+                if not _is_private(os.fstat(f.fileno())):
+                    logger.warning('DSDL cache %r is not private to the current user, ignoring it', path)
+                else:
+                    entry = pickle.load(f)
+                    if entry['format'] == _FORMAT_VERSION:
+                        return entry
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.warning('DSDL cache %r could not be read', path, exc_info=True)
+    return {'format': _FORMAT_VERSION, 'index': {}, 'digest': None, 'types': None}
+
+
+def _write_cache(path, entry):
+    try:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if not _is_private(os.stat(directory)):
+            logger.warning('DSDL cache directory %r is not private to the current user, not writing', directory)
+            return
+        # Other processes may be reading or writing the same file, hence the replacement
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600),
+                  'wb') as f:
+            _dump_types(entry, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        logger.warning('DSDL cache %r could not be written', path, exc_info=True)
+
+
+def parse_namespaces(source_dirs, search_dirs=None, parse=None):
+    """
+    Same as uavcan.dsdl.parse_namespaces(), but the result is taken from the cache if it is up to date.
+    The actual parsing is done by the function parse, which defaults to uavcan.dsdl.parse_namespaces.
+    """
+    parse = parse or uavcan.dsdl.parse_namespaces
+    source_dirs = [os.path.abspath(x) for x in source_dirs]
+    search_dirs = [os.path.abspath(x) for x in (search_dirs or [])]
+
+    started_at = time.monotonic()
+    path = _get_cache_path(source_dirs, search_dirs)
+    entry = _read_cache(path)
+    index = _index_files(source_dirs + search_dirs, entry['index'])
+    digest = _compute_digest(index)
+
+    if entry['types'] is not None and entry['digest'] == digest:
+        if index != entry['index']:
+            _write_cache(path, dict(entry, index=index))        # Only the modification times have changed
+        logger.info('DSDL definitions of %d types loaded from cache %r in %.3f sec',
+                    len(entry['types']), path, time.monotonic() - started_at)
+        return entry['types']
+
+    types = parse(source_dirs, search_dirs)
+    for t in types:
+        t.get_data_type_signature()     # Computing it takes about as long as parsing; the result is kept in the type
+    _write_cache(path, {'format': _FORMAT_VERSION, 'index': index, 'digest': digest, 'types': types})
+    logger.info('DSDL definitions of %d types parsed and cached in %.3f sec',
+                len(types), time.monotonic() - started_at)
+    return types
+
+
+def load_dsdl(*paths):
+    """
+    Same as uavcan.load_dsdl(), but the parsed definitions are cached.
+    The library does the parsing and the registration of the types in one function, so its parser is substituted
+    with the caching one for the duration of the call.
+    """
+    original = uavcan.dsdl.parse_namespaces
+
+    def parse_namespaces_cached(source_dirs, search_dirs=None):
+        return parse_namespaces(source_dirs, search_dirs, parse=original)
+
+    uavcan.dsdl.parse_namespaces = parse_namespaces_cached
+    try:
+        uavcan.load_dsdl(*paths)
+    finally:
+        uavcan.dsdl.parse_namespaces = original
@@ -20,6 +20,15 @@ parser = ArgumentParser(description='UAVCAN GUI tool')
 
 parser.add_argument("--debug", action='store_true', help="enable debugging")
 parser.add_argument("--dsdl", help="path to custom DSDL")
+parser.add_argument("--bus-monitor-capacity", type=int, default=None,
+                    help="number of most recent frames kept by the bus monitor (default 1000000)")
+parser.add_argument("--threaded-node", action='store_true',
+                    help="run the local UAVCAN node in a dedicated I/O thread rather than in the GUI thread")
+parser.add_argument("--warm-tool-hosts", type=int, default=0,
+                    help="number of idle processes kept ready to open the bus monitor or the plotter quickly "
+                         "(default 0)")
+parser.add_argument("--profile-startup", action='store_true',
+                    help="log how long it takes to import every module and to construct the main window")
 
 args = parser.parse_args()
 
@@ -57,8 +66,13 @@ if multiprocessing.get_start_method(True) != 'spawn':
     multiprocessing.set_start_method('spawn')
 
 #
-# Importing other stuff once the logging has been configured
+# Importing other stuff once the logging has been configured.
+# Modules that are only needed by tools and windows opened on request are imported when they are needed.
 #
+from . import startup_profiler
+if args.profile_startup:
+    startup_profiler.install()
+
 import uavcan
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QSplitter, QAction
@@ -68,7 +82,9 @@ from PyQt5.QtCore import QTimer, Qt, QUrl
 from .version import __version__
 from .setup_window import run_setup_window
 from .active_data_type_detector import ActiveDataTypeDetector
-from . import update_checker
+from .threaded_node import ThreadedNode
+from .tool_host import ToolHostPool
+from . import dsdl_cache
 
 from .widgets import show_error, get_icon, get_app_icon
 from .widgets.node_monitor import NodeMonitorWidget
@@ -77,21 +93,23 @@ from .widgets.log_message_display import LogMessageDisplayWidget
 from .widgets.bus_monitor import BusMonitorManager
 from .widgets.dynamic_node_id_allocator import DynamicNodeIDAllocatorWidget
 from .widgets.file_server import FileServerWidget
-from .widgets.node_properties import NodePropertiesWindow
-from .widgets.console import ConsoleManager, InternalObjectDescriptor
-from .widgets.subscriber import SubscriberWindow
 from .widgets.plotter import PlotterManager
-from .widgets.about_window import AboutWindow
-from .widgets.can_adapter_control_panel import spawn_window as spawn_can_adapter_control_panel
 
 from .panels import PANELS
 
 
 NODE_NAME = 'org.uavcan.gui_tool'
 
+# Imported by warm tool hosts in advance, see --warm-tool-hosts
+TOOL_MODULES = [
+    'uavcan_gui_tool.widgets.bus_monitor.window',
+    'uavcan_gui_tool.widgets.plotter.window',
+]
+
 
 class MainWindow(QMainWindow):
     MAX_SUCCESSIVE_NODE_ERRORS = 1000
+    CONSOLE_MANAGER_INIT_DELAY = 1      # The console is not needed to get the window on the screen
 
     # noinspection PyTypeChecker,PyCallByClass,PyUnresolvedReferences
     def __init__(self, node, iface_name):
@@ -113,19 +131,28 @@ class MainWindow(QMainWindow):
 
         self._node_windows = {}  # node ID : window object
 
-        self._node_monitor_widget = NodeMonitorWidget(self, node)
-        self._node_monitor_widget.on_info_window_requested = self._show_node_window
-
-        self._local_node_widget = LocalNodeWidget(self, node)
-        self._log_message_widget = LogMessageDisplayWidget(self, node)
-        self._dynamic_node_id_allocation_widget = DynamicNodeIDAllocatorWidget(self, node,
-                                                                               self._node_monitor_widget.monitor)
-        self._file_server_widget = FileServerWidget(self, node)
-
-        self._plotter_manager = PlotterManager(self._node)
-        self._bus_monitor_manager = BusMonitorManager(self._node, iface_name)
-        # Console manager depends on other stuff via context, initialize it last
-        self._console_manager = ConsoleManager(self._make_console_context)
+        with startup_profiler.section('Node monitor'):
+            self._node_monitor_widget = NodeMonitorWidget(self, node)
+            self._node_monitor_widget.on_info_window_requested = self._show_node_window
+
+        with startup_profiler.section('Local node, log messages, node ID allocator, file server'):
+            self._local_node_widget = LocalNodeWidget(self, node)
+            self._log_message_widget = LogMessageDisplayWidget(self, node)
+            self._dynamic_node_id_allocation_widget = DynamicNodeIDAllocatorWidget(self, node,
+                                                                                   self._node_monitor_widget.monitor)
+            self._file_server_widget = FileServerWidget(self, node)
+
+        with startup_profiler.section('Tool hosts'):
+            self._tool_host_pool = ToolHostPool(args.warm_tool_hosts, TOOL_MODULES)
+            self._plotter_manager = PlotterManager(self._node, self._tool_host_pool)
+            self._bus_monitor_manager = BusMonitorManager(self._node, iface_name, self._tool_host_pool,
+                                                          args.bus_monitor_capacity)
+
+        # Console manager depends on other stuff via context, initialize it last.
+        # Starting the kernel takes a while, so it is done once the window is on the screen, or when the console
+        # is requested, whichever happens first.
+        self._console_manager = None
+        QTimer.singleShot(int(self.CONSOLE_MANAGER_INIT_DELAY * 1000), self._get_console_manager)
 
         #
         # File menu
@@ -153,8 +180,7 @@ class MainWindow(QMainWindow):
         new_subscriber_action = QAction(get_icon('newspaper-o'), '&Subscriber', self)
         new_subscriber_action.setShortcut(QKeySequence('Ctrl+Shift+S'))
         new_subscriber_action.setStatusTip('Open subscription tool')
-        new_subscriber_action.triggered.connect(
-            lambda: SubscriberWindow.spawn(self, self._node, self._active_data_type_detector))
+        new_subscriber_action.triggered.connect(self._show_subscriber_window)
 
         new_plotter_action = QAction(get_icon('area-chart'), '&Plotter', self)
         new_plotter_action.setShortcut(QKeySequence('Ctrl+Shift+P'))
@@ -199,7 +225,7 @@ class MainWindow(QMainWindow):
             lambda: QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.dirname(log_file.name))))
 
         about_action = QAction(get_icon('info'), '&About', self)
-        about_action.triggered.connect(lambda: AboutWindow(self).show())
+        about_action.triggered.connect(self._show_about_window)
 
         help_menu = self.menuBar().addMenu('&Help')
         help_menu.addAction(uavcan_website_action)
@@ -237,11 +263,22 @@ class MainWindow(QMainWindow):
 
     def _try_spawn_can_adapter_control_panel(self):
         try:
+            from .widgets.can_adapter_control_panel import spawn_window as spawn_can_adapter_control_panel
             spawn_can_adapter_control_panel(self, self._node, self._iface_name)
         except Exception as ex:
             show_error('CAN Adapter Control Panel error', 'Could not spawn CAN Adapter Control Panel', ex, self)
 
+    def _show_subscriber_window(self):
+        from .widgets.subscriber import SubscriberWindow
+        SubscriberWindow.spawn(self, self._node, self._active_data_type_detector)
+
+    def _show_about_window(self):
+        from .widgets.about_window import AboutWindow
+        AboutWindow(self).show()
+
     def _make_console_context(self):
+        from .widgets.console import InternalObjectDescriptor
+
         default_transfer_priority = 30
 
         active_handles = []
@@ -510,9 +547,16 @@ class MainWindow(QMainWindow):
                                      'Sends a raw CAN frame'),
         ]
 
+    def _get_console_manager(self):
+        if self._console_manager is None:
+            with startup_profiler.section('Console'):
+                from .widgets.console import ConsoleManager
+                self._console_manager = ConsoleManager(self._make_console_context)
+        return self._console_manager
+
     def _show_console_window(self):
         try:
-            self._console_manager.show_console_window(self)
+            self._get_console_manager().show_console_window(self)
         except Exception as ex:
             logger.error('Could not spawn console', exc_info=True)
             show_error('Console error', 'Could not spawn console window', ex, self)
@@ -529,14 +573,17 @@ class MainWindow(QMainWindow):
                 pass    # Sometimes fails with "wrapped C/C++ object of type NodePropertiesWindow has been deleted"
             del self._node_windows[node_id]
 
+        from .widgets.node_properties import NodePropertiesWindow
         w = NodePropertiesWindow(self, self._node, node_id, self._file_server_widget,
                                  self._node_monitor_widget.monitor, self._dynamic_node_id_allocation_widget)
         w.show()
         self._node_windows[node_id] = w
 
     def _spin_node(self):
-        # We're running the node in the GUI thread.
+        # By default we're running the node in the GUI thread.
         # This is not great, but at the moment seems like other options are even worse.
+        # With --threaded-node, the node is spun by a dedicated I/O thread, and this call only invokes the callbacks
+        # that were queued by the I/O thread since the previous call.
         try:
             self._node.spin(0)
             self._successive_node_errors = 0
@@ -558,7 +605,10 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, qcloseevent):
         self._plotter_manager.close()
-        self._console_manager.close()
+        self._bus_monitor_manager.close()
+        self._tool_host_pool.close()
+        if self._console_manager is not None:
+            self._console_manager.close()
         self._active_data_type_detector.close()
         super(MainWindow, self).closeEvent(qcloseevent)
 
@@ -571,6 +621,7 @@ def main():
         # Asking the user to specify which interface to work with
         try:
             iface, iface_kwargs, dsdl_directory = run_setup_window(get_app_icon(), args.dsdl)
+            startup_profiler.mark('Setup window closed')
             if not iface:
                 sys.exit(0)
         except Exception as ex:
@@ -583,7 +634,8 @@ def main():
         try:
             if dsdl_directory:
                 logger.info('Loading custom DSDL from %r', dsdl_directory)
-                uavcan.load_dsdl(dsdl_directory)
+                with startup_profiler.section('Custom DSDL'):
+                    dsdl_cache.load_dsdl(dsdl_directory)
                 logger.info('Custom DSDL loaded successfully')
 
                 # setup an environment variable for sub-processes to know where to load custom DSDL from
@@ -619,15 +671,25 @@ def main():
         else:
             break
 
+    if args.threaded_node:
+        node = ThreadedNode(node)
+
     logger.info('Creating main window; iface %r', iface)
-    window = MainWindow(node, iface)
-    window.show()
+    with startup_profiler.section('Main window'):
+        window = MainWindow(node, iface)
+        window.show()
+    startup_profiler.mark('Main window shown')
 
     try:
+        from . import update_checker
         update_checker.begin_async_check(window)
     except Exception:
         logger.error('Could not start update checker', exc_info=True)
 
+    if startup_profiler.is_installed():
+        # Reporting once the deferred initialization is done
+        QTimer.singleShot(int((MainWindow.CONSOLE_MANAGER_INIT_DELAY + 1) * 1000), startup_profiler.report)
+
     logger.info('Init complete, invoking the Qt event loop')
     exit_code = app.exec_()
 
@@ -0,0 +1,132 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Startup profiling, enabled with --profile-startup.
+The time it takes to import every module is measured by wrapping the loaders of the modules that are imported after
+install(); the total time of a module includes the modules it imports, the own time does not. Other startup steps,
+such as construction of the main window widgets, are measured with section().
+"""
+
+import sys
+import time
+import logging
+import contextlib
+
+
+logger = logging.getLogger(__name__)
+
+_installed_at = None
+_stack = []                 # Time spent in nested imports, one entry per module being imported
+_import_times = {}          # Module name : (total, own)
+_sections = []              # (name, duration)
+_marks = []                 # (name, time since install())
+
+
+class _TimedLoader:
+    def __init__(self, loader):
+        self._loader = loader
+        self._create_time = 0
+        self._create_nested = 0
+
+    def __getattr__(self, item):
+        return getattr(self._loader, item)
+
+    def create_module(self, spec):
+        # Extension modules are initialized here rather than in exec_module(); some loaders import other modules here
+        _stack.append(0)
+        started_at = time.perf_counter()
+        try:
+            return self._loader.create_module(spec)
+        finally:
+            self._create_time = time.perf_counter() - started_at
+            self._create_nested = _stack.pop()
+
+    def exec_module(self, module):
+        # The module must see its actual loader; e.g. pkg_resources looks up resource providers by the loader type
+        module.__loader__ = self._loader
+        if getattr(module, '__spec__', None) is not None:
+            module.__spec__.loader = self._loader
+
+        _stack.append(self._create_nested)
+        started_at = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - started_at + self._create_time
+            nested = _stack.pop()
+            if _stack:
+                _stack[-1] += total
+            _import_times[module.__name__] = total, total - nested
+
+
+class _TimingFinder:
+    """Finds modules using the other finders, and wraps the loaders they return"""
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is cls or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+
+
+def install():
+    global _installed_at
+    if _installed_at is None:
+        _installed_at = time.perf_counter()
+        sys.meta_path.insert(0, _TimingFinder)
+
+
+def is_installed():
+    return _installed_at is not None
+
+
+@contextlib.contextmanager
+def section(name):
+    """Measures the duration of the enclosed code, if profiling is enabled"""
+    if _installed_at is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _sections.append((name, time.perf_counter() - started_at))
+
+
+def mark(name):
+    """Records the time since install(), if profiling is enabled"""
+    if _installed_at is not None:
+        _marks.append((name, time.perf_counter() - _installed_at))
+
+
+def report(max_modules=40):
+    """Logs the measurements made since install(); the slowest modules are listed first"""
+    if _installed_at is None:
+        return
+
+    lines = ['Startup profile, %.3f sec since the profiler was installed' % (time.perf_counter() - _installed_at)]
+
+    for name, elapsed in _marks:
+        lines.append('%s after %.3f sec' % (name, elapsed))
+
+    lines.append('%-50s %10s' % ('Section', 'Time, ms'))
+    for name, duration in _sections:
+        lines.append('%-50s %10.1f' % (name, duration * 1e3))
+
+    lines.append('%-50s %10s %10s' % ('Module (%d imported)' % len(_import_times), 'Total, ms', 'Own, ms'))
+    slowest = sorted(_import_times.items(), key=lambda x: -x[1][0])[:max_modules]
+    for name, (total, own) in slowest:
+        lines.append('%-50s %10.1f %10.1f' % (name, total * 1e3, own * 1e3))
+
+    logger.info('\n'.join(lines))
@@ -0,0 +1,251 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import time
+import inspect
+import logging
+import threading
+import collections
+from functools import partial
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Relay:
+    """
+    Forwards invocations of a callback from the I/O thread to the GUI thread.
+    Once the relay is deactivated, the invocations that are still pending will be discarded.
+    """
+    def __init__(self, owner, callback, coalesce=False):
+        self.owner = owner
+        self.callback = callback
+        self.coalesce = coalesce        # If set, at most one invocation can be pending at any moment
+        self.active = True
+        self.pending = False
+
+    def __call__(self, *args):
+        if self.coalesce:
+            if self.pending:
+                return
+            self.pending = True
+        self.owner._post(self, args)
+
+
+class _LockedHandle:
+    def __init__(self, lock, handle, relay=None):
+        self._lock = lock
+        self._handle = handle
+        self._relay = relay
+
+    def remove(self):
+        if self._relay is not None:
+            self._relay.active = False
+        with self._lock:
+            self._handle.remove()
+
+    def try_remove(self):
+        if self._relay is not None:
+            self._relay.active = False
+        with self._lock:
+            return self._handle.try_remove()
+
+
+class _LockedDriver:
+    """
+    Forwards everything to the CAN driver, invoking its methods under the lock of the node, because the driver is
+    also used by the I/O thread, and the IO hooks that it invokes on sending are not thread safe.
+    """
+    def __init__(self, lock, driver):
+        self._lock = lock
+        self._driver = driver
+
+    @property
+    def __class__(self):
+        return self._driver.__class__
+
+    def __getattr__(self, item):
+        attr = getattr(self._driver, item)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class ThreadedNode:
+    """
+    Runs a UAVCAN node in a dedicated I/O thread, so that a slow GUI cannot delay the reception of CAN frames.
+
+    This object is a drop-in replacement for the node object. Calls of the methods of the node that are defined here,
+    assignments to its attributes, and calls of the methods of its CAN driver (node.can_driver) are serialized with
+    the I/O thread using a lock; any other attribute is forwarded to the node as is, so it must not be used to modify
+    the state of the node from the GUI thread. Transfer hooks, message handlers, response callbacks, and scheduled
+    (periodic/deferred) callbacks are not invoked in the I/O thread; instead, they are put into a lock-free queue
+    that is drained by the GUI thread in one batch every time spin() is invoked, so all of the application logic
+    still runs in the GUI thread, exactly as it does when the node is spun from a GUI timer.
+
+    The exceptions are service request handlers, which must produce a response synchronously, and CAN driver IO
+    hooks (node.can_driver.add_io_hook()); these are invoked directly from the I/O thread.
+    """
+    SPIN_SLICE = 0.002
+    YIELD_INTERVAL = 0.0002
+    MAX_PENDING_EVENTS = 100000
+
+    def __init__(self, node):
+        self._node = node
+        self._lock = threading.RLock()
+
+        # Deque operations are atomic, so the producer and the consumer do not need to hold any lock
+        self._events = collections.deque()
+        self._errors = collections.deque()
+
+        self._num_events_dropped = 0
+        self._num_events_delivered = 0
+        self._max_delivery_latency = 0
+        self._total_delivery_latency = 0
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='uavcan_node_io', daemon=True)
+        self._thread.start()
+
+        logger.info('Node I/O thread started')
+
+    def __getattr__(self, item):
+        if item == 'can_driver':
+            return _LockedDriver(self._lock, self._node.can_driver)
+        return getattr(self._node, item)
+
+    def __setattr__(self, key, value):
+        if key.startswith('_'):
+            super(ThreadedNode, self).__setattr__(key, value)
+        else:
+            with self._lock:
+                setattr(self._node, key, value)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                with self._lock:
+                    self._node.spin(self.SPIN_SLICE)
+            except Exception as ex:
+                logger.debug('Node I/O thread error', exc_info=True)
+                self._errors.append(ex)
+                self._stop_event.wait(self.SPIN_SLICE)      # Do not let a persistent error spin us at 100% CPU
+
+            # Releasing the lock for a moment, otherwise the GUI thread may be unable to grab it
+            time.sleep(self.YIELD_INTERVAL)
+
+    def _post(self, relay, args):
+        if len(self._events) >= self.MAX_PENDING_EVENTS:
+            self._num_events_dropped += 1
+            return
+        self._events.append((time.monotonic(), relay, args))
+
+    def _make_relay(self, callback, coalesce=False):
+        return _Relay(self, callback, coalesce=coalesce)
+
+    def spin(self, timeout=0):
+        """
+        Must be invoked from the GUI thread periodically.
+        Invokes the callbacks that were queued by the I/O thread since the previous call; the timeout is ignored.
+        Errors reported by the I/O thread and by the callbacks are re-raised from here.
+        """
+        first_error = None
+
+        # Processing only what is already there, so that callbacks that post new events cannot make us loop forever
+        for _ in range(len(self._events)):
+            posted_at, relay, args = self._events.popleft()
+            relay.pending = False
+            if not relay.active:
+                continue
+
+            latency = time.monotonic() - posted_at
+            self._num_events_delivered += 1
+            self._total_delivery_latency += latency
+            self._max_delivery_latency = max(self._max_delivery_latency, latency)
+
+            try:
+                relay.callback(*args)
+            except Exception as ex:
+                logger.error('Node callback %r failed', relay.callback, exc_info=True)
+                first_error = first_error or ex
+
+        if self._errors:
+            raise self._errors.popleft()
+
+        if first_error is not None:
+            raise first_error
+
+    def get_statistics(self):
+        """Returns a dict with the counters of events delivered from the I/O thread to the GUI thread"""
+        return {
+            'delivered': self._num_events_delivered,
+            'dropped': self._num_events_dropped,
+            'pending': len(self._events),
+            'max_latency': self._max_delivery_latency,
+            'mean_latency': self._total_delivery_latency / max(self._num_events_delivered, 1),
+        }
+
+    def add_handler(self, uavcan_type, handler, **kwargs):
+        with self._lock:
+            if uavcan_type.kind == uavcan_type.KIND_SERVICE:
+                # The response must be returned synchronously, so service handlers are invoked from the I/O thread
+                return _LockedHandle(self._lock, self._node.add_handler(uavcan_type, handler, **kwargs))
+
+            if inspect.isclass(handler):
+                def callback(event):
+                    handler(event, **kwargs).on_message()
+            else:
+                callback = partial(handler, **kwargs)
+
+            relay = self._make_relay(callback)
+            return _LockedHandle(self._lock, self._node.add_handler(uavcan_type, relay), relay)
+
+    def add_transfer_hook(self, hook, **kwargs):
+        with self._lock:
+            relay = self._make_relay(partial(hook, **kwargs))
+            return _LockedHandle(self._lock, self._node.add_transfer_hook(relay), relay)
+
+    def remove_handlers(self, uavcan_type):
+        with self._lock:
+            self._node.remove_handlers(uavcan_type)
+
+    def periodic(self, period_seconds, callback):
+        with self._lock:
+            # If the GUI thread is late, pending calls are merged rather than piled up
+            relay = self._make_relay(callback, coalesce=True)
+            return _LockedHandle(self._lock, self._node.periodic(period_seconds, relay), relay)
+
+    def defer(self, timeout_seconds, callback):
+        with self._lock:
+            relay = self._make_relay(callback)
+            return _LockedHandle(self._lock, self._node.defer(timeout_seconds, relay), relay)
+
+    def request(self, payload, dest_node_id, callback, priority=None, timeout=None):
+        with self._lock:
+            return self._node.request(payload, dest_node_id, self._make_relay(callback),
+                                      priority=priority, timeout=timeout)
+
+    def respond(self, payload, dest_node_id, transfer_id, priority):
+        with self._lock:
+            return self._node.respond(payload, dest_node_id, transfer_id, priority)
+
+    def broadcast(self, payload, priority=None):
+        with self._lock:
+            return self._node.broadcast(payload, priority=priority)
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join(1)
+        logger.info('Node I/O thread stopped; event statistics: %r', self.get_statistics())
+        with self._lock:
+            self._node.close()
@@ -0,0 +1,360 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Tools that may be heavy, such as the bus monitor or the plotter, run in separate processes, so that they cannot
+slow down the main window. Every such process runs a generic host that owns the Qt application and the channel to
+the main process; the tool itself is started later by a command that carries the factory of its window.
+This allows to start host processes in advance and keep them idle until a tool is requested (see ToolHostPool);
+such warm hosts also import the modules of the tools and load custom DSDL before they are needed.
+
+The data that tools need are delivered from the main process by data feeds, which are attached to tool processes.
+"""
+
+import os
+import sys
+import time
+import queue
+import logging
+import importlib
+import collections
+import multiprocessing
+from PyQt5.QtCore import QTimer
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    # noinspection PyUnresolvedReferences
+    sys.getwindowsversion()
+    RUNNING_ON_WINDOWS = True
+except AttributeError:
+    RUNNING_ON_WINDOWS = False
+    PARENT_PID = os.getppid()
+
+
+class IPCChannel:
+    """
+    This class is built as an abstraction over the underlying IPC communication channel.
+    The main queue carries commands and data from the main process to the child, the feedback queue carries data
+    in the opposite direction.
+    """
+    def __init__(self):
+        # Queue is slower than pipe, but it allows to implement non-blocking sending easier,
+        # and the buffer can be arbitrarily large.
+        self._q = multiprocessing.Queue()
+        self._feedback_q = multiprocessing.Queue()
+
+    @staticmethod
+    def _put_nonblocking(q, obj):
+        try:
+            q.put_nowait(obj)
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def _get_nonblocking(q):
+        try:
+            return True, q.get_nowait()
+        except queue.Empty:
+            return False, None
+
+    def send_nonblocking(self, obj):
+        self._put_nonblocking(self._q, obj)
+
+    def receive_nonblocking(self):
+        """Returns: (True, object) if successful, (False, None) if no data to read """
+        return self._get_nonblocking(self._q)
+
+    def send_feedback_nonblocking(self, obj):
+        self._put_nonblocking(self._feedback_q, obj)
+
+    def receive_feedback_nonblocking(self):
+        """Same as receive_nonblocking(), but for the objects sent by the child process"""
+        return self._get_nonblocking(self._feedback_q)
+
+
+IPC_COMMAND_STOP = 'stop'
+IPC_COMMAND_START = 'start'         # (command, tool name, factory, args, wall time of the request)
+
+
+class ToolHost:
+    """
+    Child process side of a tool process.
+    Commands from the main process are executed here; everything else is queued for the tool, which takes it
+    using receive(). The tool window is created by the factory as factory(host, *args).
+    """
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, app, channel):
+        self._app = app
+        self._channel = channel
+        self._data = collections.deque()
+        self._exit_handlers = []
+        self._requested_at = None           # Reset once the tool has received its first data
+        self.tool_name = None
+        self.tool = None
+
+    def _start(self, tool_name, factory, args, requested_at):
+        started_at = time.time()
+        self.tool_name = tool_name
+        self.tool = factory(self, *args)
+        self._requested_at = requested_at
+        logger.info('Tool host %r has started %r: %.3f sec after the request, of which %.3f sec to create the tool',
+                    os.getpid(), tool_name, time.time() - requested_at, time.time() - started_at)
+
+    def report_data_received(self):
+        """Invoked whenever the tool receives data; the delay of the first data since the request is logged"""
+        if self._requested_at is not None:
+            logger.info('Tool %r has received its first data %.3f sec after the request',
+                        self.tool_name, time.time() - self._requested_at)
+            self._requested_at = None
+
+    def poll(self):
+        while True:
+            received, obj = self._channel.receive_nonblocking()
+            if not received:
+                break
+            if isinstance(obj, str) and obj == IPC_COMMAND_STOP:
+                logger.info('Tool host %r has received a stop request, goodbye', os.getpid())
+                self._app.exit(0)
+                break
+            if isinstance(obj, tuple) and obj and obj[0] == IPC_COMMAND_START:
+                self._start(*obj[1:])
+            else:
+                self._data.append(obj)
+
+    def receive(self):
+        """Returns the next object sent to the tool by the main process, or None if there are none"""
+        if not self._data:
+            self.poll()
+        if self._data:
+            self.report_data_received()
+            return self._data.popleft()
+
+    def send(self, obj):
+        """Sends an object to the main process; see ToolProcess.receive()"""
+        self._channel.send_feedback_nonblocking(obj)
+
+    def add_exit_handler(self, handler):
+        """The handler will be invoked once the event loop of the process has finished"""
+        self._exit_handlers.append(handler)
+
+    def run_exit_handlers(self):
+        for handler in self._exit_handlers:
+            try:
+                handler()
+            except Exception:
+                logger.error('Exit handler failed', exc_info=True)
+
+
+def _load_custom_dsdl():
+    # The main process sets this variable once it has loaded the custom DSDL
+    dsdl_directory = os.environ.get('UAVCAN_CUSTOM_DSDL_PATH', None)
+    if dsdl_directory:
+        from .dsdl_cache import load_dsdl
+        started_at = time.monotonic()
+        load_dsdl(dsdl_directory)
+        logger.info('Tool host %r has loaded custom DSDL from %r in %.3f sec',
+                    os.getpid(), dsdl_directory, time.monotonic() - started_at)
+
+
+def _preload(module_names):
+    started_at = time.monotonic()
+    for name in module_names:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logger.error('Could not preload module %r', name, exc_info=True)
+    logger.info('Tool host %r has preloaded %d modules in %.3f sec',
+                os.getpid(), len(module_names), time.monotonic() - started_at)
+
+
+def _host_entry_point(channel, preload_modules):
+    logger.info('Tool host process started with PID %r', os.getpid())
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication(sys.argv)    # Inheriting args from the parent process
+
+    if preload_modules:
+        _preload(preload_modules)
+    try:
+        _load_custom_dsdl()
+    except Exception:
+        logger.error('Tool host %r could not load custom DSDL', os.getpid(), exc_info=True)
+
+    def exit_if_should():
+        if not RUNNING_ON_WINDOWS and os.getppid() != PARENT_PID:
+            logger.info('Parent process is dead, tool host %r is exiting', os.getpid())
+            app.exit(0)
+
+    exit_check_timer = QTimer()
+    exit_check_timer.setSingleShot(False)
+    exit_check_timer.timeout.connect(exit_if_should)
+    exit_check_timer.start(2000)
+
+    host = ToolHost(app, channel)
+
+    poll_timer = QTimer()
+    poll_timer.setSingleShot(False)
+    poll_timer.timeout.connect(host.poll)
+    poll_timer.start(int(ToolHost.POLL_INTERVAL * 1000))
+
+    logger.info('Tool host process %r initialized successfully, now starting the event loop', os.getpid())
+    exit_code = app.exec_()
+    host.run_exit_handlers()
+    sys.exit(exit_code)
+
+
+class ToolProcess:
+    """
+    Main process side of a tool process.
+    The modules listed in preload_modules are imported by the host before it becomes ready to start a tool.
+    """
+    def __init__(self, preload_modules=()):
+        self.channel = IPCChannel()
+        self.tool_name = None
+        self.feeds = []
+
+        self.proc = multiprocessing.Process(target=_host_entry_point, name='tool_host',
+                                            args=(self.channel, tuple(preload_modules)))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def __repr__(self):
+        return '%s(%r, pid=%r)' % (type(self).__name__, self.tool_name, self.proc.pid)
+
+    def start_tool(self, tool_name, factory, args):
+        """The factory must be a module-level function, because it is pickled by reference"""
+        self.tool_name = tool_name
+        self.channel.send_nonblocking((IPC_COMMAND_START, tool_name, factory, tuple(args), time.time()))
+
+    def is_alive(self):
+        return self.proc.is_alive()
+
+    def send(self, obj):
+        self.channel.send_nonblocking(obj)
+
+    def receive(self):
+        """Returns: (True, object) if the child has sent something, (False, None) otherwise"""
+        return self.channel.receive_feedback_nonblocking()
+
+    def stop(self):
+        self.channel.send_nonblocking(IPC_COMMAND_STOP)
+
+
+class DataFeed:
+    """
+    Source of data for tool processes. A feed is attached to a process before its tool is started, and detached
+    once the process has exited. What attach() returns is passed to the tool factory as the first argument after
+    the host; it is either the object the tool receives the data from, or None if the data are sent through the
+    channel of the process, in which case the tool receives them from the host.
+    """
+    def attach(self, tool_process):
+        raise NotImplementedError
+
+    def detach(self, tool_process):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ToolHostPool:
+    """
+    Starts tool processes and keeps track of them.
+    Up to num_warm host processes are kept idle in advance, so that a tool can be started without waiting for a new
+    interpreter to start up; the warm hosts import the modules listed in preload_modules while they are idle.
+    Processes that have exited are detected periodically and detached from their feeds.
+    """
+    LIVENESS_CHECK_INTERVAL = 1
+    REFILL_DELAY = 2        # The new warm host should not compete for the CPU with the tool being started
+
+    def __init__(self, num_warm=0, preload_modules=()):
+        self._num_warm = num_warm
+        self._preload_modules = tuple(preload_modules)
+        self._warm = []
+        self._active = []
+        self._closed = False
+
+        self._liveness_check_timer = QTimer()
+        self._liveness_check_timer.setSingleShot(False)
+        self._liveness_check_timer.timeout.connect(self._check_liveness)
+        self._liveness_check_timer.start(int(self.LIVENESS_CHECK_INTERVAL * 1000))
+
+        self._refill()
+
+    def _refill(self):
+        while not self._closed and len(self._warm) < self._num_warm:
+            proc = ToolProcess(self._preload_modules)
+            self._warm.append(proc)
+            logger.info('Started warm tool host %r', proc)
+
+    def _check_liveness(self):
+        for proc in self._active[:]:
+            if not proc.is_alive():
+                logger.info('Tool process %r appears to be dead, removing', proc)
+                self._active.remove(proc)
+                for feed in proc.feeds:
+                    try:
+                        feed.detach(proc)
+                    except Exception:
+                        logger.error('Could not detach feed %r from %r', feed, proc, exc_info=True)
+
+        dead = [x for x in self._warm if not x.is_alive()]
+        if dead:
+            logger.warning('Warm tool hosts %r have died unexpectedly', dead)
+            self._warm = [x for x in self._warm if x not in dead]
+            self._refill()
+
+    def spawn(self, tool_name, factory, args=(), feed=None):
+        """
+        Starts the tool in a warm process if there is one, otherwise in a new process.
+        If a feed is specified, it is attached to the process, and the result is prepended to the arguments.
+        """
+        proc = self._warm.pop(0) if self._warm else ToolProcess()
+
+        if feed is not None:
+            args = (feed.attach(proc),) + tuple(args)
+            proc.feeds.append(feed)
+
+        proc.start_tool(tool_name, factory, args)
+        self._active.append(proc)
+        logger.info('Spawned %r', proc)
+
+        QTimer.singleShot(int(self.REFILL_DELAY * 1000), self._refill)
+        return proc
+
+    def close(self):
+        self._closed = True
+        self._liveness_check_timer.stop()
+        procs = self._active + self._warm
+
+        for proc in procs:
+            try:
+                proc.stop()
+            except Exception:
+                pass
+
+        for proc in procs:
+            try:
+                proc.proc.join(1)
+            except Exception:
+                pass
+
+        for proc in procs:
+            try:
+                proc.proc.terminate()
+            except Exception:
+                pass
+            for feed in proc.feeds:
+                try:
+                    feed.detach(proc)
+                except Exception:
+                    pass
+
+        self._active, self._warm = [], []
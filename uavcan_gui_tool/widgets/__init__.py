@@ -8,11 +8,12 @@
 
 import os
 import re
+import time
 import pkg_resources
 import queue
 from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem, QAbstractItemView, QHeaderView, QApplication, QWidget, \
-    QComboBox, QCompleter, QPushButton, QHBoxLayout, QVBoxLayout, QMessageBox
-from PyQt5.QtCore import Qt, QTimer, QStringListModel
+    QComboBox, QCompleter, QPushButton, QHBoxLayout, QVBoxLayout, QMessageBox, QProgressBar
+from PyQt5.QtCore import Qt, QTimer, QStringListModel, QObject, pyqtSignal
 from PyQt5.QtGui import QColor, QKeySequence, QFont, QFontInfo, QIcon
 from logging import getLogger
 import qtawesome
@@ -46,6 +47,72 @@ def request_confirmation(title, text, parent=None):
     return reply == QMessageBox().Yes
 
 
+class IncrementalSearch(QObject):
+    """
+    Finds the next row that matches the pattern without blocking the event loop.
+    Rows are scanned in slices of limited duration from a zero-interval timer, starting from the row next to the
+    start row and wrapping around. get_text(row) must return the searchable text of the row, or None to skip the row.
+    The signal finished is emitted exactly once, with the found row, or with None if nothing was found or the
+    search was cancelled.
+    """
+    TIME_SLICE = 0.02
+
+    progress = pyqtSignal([float])
+    finished = pyqtSignal([object])
+
+    def __init__(self, parent, num_rows, start_row, direction, get_text, matcher):
+        super(IncrementalSearch, self).__init__(parent)
+        self._num_rows = num_rows
+        self._start_row = start_row
+        self._step = -1 if direction == 'up' else 1
+        self._get_text = get_text
+        self._matcher = matcher
+        self._num_checked = 0
+        self._cancelled = False
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(False)
+        self._timer.timeout.connect(self._run_slice)
+
+    def start(self):
+        self._timer.start(0)
+
+    def cancel(self):
+        if self.active:
+            self._cancelled = True
+            self._finish(None)
+
+    @property
+    def active(self):
+        return self._timer.isActive()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def _finish(self, row):
+        self._timer.stop()
+        self.finished.emit(row)
+        self.deleteLater()
+
+    def _run_slice(self):
+        deadline = time.monotonic() + self.TIME_SLICE
+        while time.monotonic() < deadline:
+            for _ in range(100):
+                self._num_checked += 1
+                if self._num_checked >= self._num_rows:
+                    self._finish(None)
+                    return
+
+                row = (self._start_row + self._step * self._num_checked) % self._num_rows
+                text = self._get_text(row)
+                if text is not None and self._matcher.match(text):
+                    self._finish(row)
+                    return
+
+        self.progress.emit(self._num_checked / self._num_rows)
+
+
 class BasicTable(QTableWidget):
     class Column:
         def __init__(self, name, renderer, resize_mode=QHeaderView.ResizeToContents,
@@ -63,6 +130,9 @@ class BasicTable(QTableWidget):
 
         self.filter = None
 
+        # Searchable text of the rows from the top; rows are invalidated when they are modified, inserted, or removed
+        self._search_text_cache = []
+
         self.on_enter_pressed = lambda list_of_row_col_pairs: None
 
         self.setShowGrid(False)
@@ -91,6 +161,28 @@ class BasicTable(QTableWidget):
         self.setHorizontalHeaderLabels([x.name for x in self.columns])
         self.setRowCount(0)
 
+    def setRowCount(self, rows):
+        del self._search_text_cache[rows:]
+        super(BasicTable, self).setRowCount(rows)
+
+    def insertRow(self, row):
+        del self._search_text_cache[row:]       # Appending to the bottom does not invalidate anything
+        super(BasicTable, self).insertRow(row)
+
+    def removeRow(self, row):
+        del self._search_text_cache[row:]
+        super(BasicTable, self).removeRow(row)
+
+    def _get_search_text(self, row):
+        if self.isRowHidden(row):
+            return None
+        cache = self._search_text_cache
+        if row >= len(cache):
+            cache.extend([None] * (row + 1 - len(cache)))
+        if cache[row] is None:
+            cache[row] = self.get_row_as_string(row, lambda c: c.searchable)
+        return cache[row]
+
     def get_row_as_string(self, row, column_predicate=None):
         first = True
         out_string = ''
@@ -112,6 +204,9 @@ class BasicTable(QTableWidget):
             return True
 
     def set_row(self, row, model):
+        if row < len(self._search_text_cache):
+            self._search_text_cache[row] = None
+
         for col, spec in enumerate(self.columns):
             value = spec.render(model)
             color = None
@@ -145,6 +240,7 @@ class BasicTable(QTableWidget):
                 self.on_enter_pressed([(x.row(), x.column()) for x in self.selectedIndexes()])
 
     def search(self, direction, matcher):
+        """Returns a started IncrementalSearch, or None if the table is empty"""
         if self.rowCount() == 0:
             return
 
@@ -162,21 +258,19 @@ class BasicTable(QTableWidget):
 
         self.clearSelection()
 
-        # Searching
-        current_row = search_from_row + (-1 if direction == 'up' else 1)
-        while current_row != search_from_row:
-            if not self.isRowHidden(current_row):
-                text = self.get_row_as_string(current_row, lambda c: c.searchable)
-                if matcher.match(text):
-                    self.selectRow(current_row)
-                    self.scrollTo(self.model().index(current_row, 0))
-                    return current_row
-
-            current_row += -1 if direction == 'up' else 1
-            if current_row >= self.rowCount():
-                current_row = 0
-            if current_row < 0:
-                current_row = self.rowCount() - 1
+        def get_text(row):
+            # The table may have been cleared while the search was running
+            return self._get_search_text(row) if row < self.rowCount() else None
+
+        def on_finished(row):
+            if row is not None:
+                self.selectRow(row)
+                self.scrollTo(self.model().index(row, 0))
+
+        job = IncrementalSearch(self, self.rowCount(), search_from_row, direction, get_text, matcher)
+        job.finished.connect(on_finished)
+        job.start()
+        return job
 
     def set_filter(self, matcher):
         self.filter = matcher
@@ -219,17 +313,20 @@ class SearchMatcher:
         self.use_regex = use_regex
         self.case_sensitive = case_sensitive
         self.inverse = inverse
+        self._regex = None              # Compiled on first use, once per matcher
 
     def _do_match(self, text):
         if self.use_regex:
-            try:
-                flags = re.UNICODE
-                if not self.case_sensitive:
-                    flags |= re.IGNORECASE
-                return bool(re.findall(self.pattern, text, flags=flags))
-            except Exception as ex:
-                logger.warning('Regular expression match failed', exc_info=True)
-                raise self.BadPatternException(str(ex))
+            if self._regex is None:
+                try:
+                    flags = re.UNICODE
+                    if not self.case_sensitive:
+                        flags |= re.IGNORECASE
+                    self._regex = re.compile(self.pattern, flags=flags)
+                except Exception as ex:
+                    logger.warning('Regular expression compilation failed', exc_info=True)
+                    raise self.BadPatternException(str(ex))
+            return self._regex.search(text) is not None
         else:
             if self.case_sensitive:
                 pattern = self.pattern
@@ -297,7 +394,17 @@ class SearchBar(QWidget):
         self._button_search_up = make_icon_button('caret-up', 'Search up', self,
                                                   on_clicked=partial(self._do_search, 'up'))
 
+        # Returns an IncrementalSearch, or None if there is nothing to search
         self.on_search = lambda *_: None
+        self._search_job = None
+
+        self._progress = QProgressBar(self)
+        self._progress.setRange(0, 100)
+        self._progress.setMaximumWidth(100)
+        self._progress.setVisible(False)
+
+        self._button_cancel = make_icon_button('stop', 'Cancel search [Esc]', self, on_clicked=self.cancel)
+        self._button_cancel.setVisible(False)
 
         layout = QHBoxLayout(self)
         layout.addWidget(self._bar, 1)
@@ -305,6 +412,8 @@ class SearchBar(QWidget):
         layout.addWidget(self._button_search_up)
         layout.addWidget(self._use_regex)
         layout.addWidget(self._case_sensitive)
+        layout.addWidget(self._progress)
+        layout.addWidget(self._button_cancel)
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
         self.setVisible(False)
@@ -312,8 +421,19 @@ class SearchBar(QWidget):
     def keyPressEvent(self, qkeyevent):
         super(SearchBar, self).keyPressEvent(qkeyevent)
         if qkeyevent.key() == Qt.Key_Escape:
-            self.setVisible(False)
-            self.show_search_bar_button.setChecked(False)
+            if self.searching:
+                self.cancel()
+            else:
+                self.setVisible(False)
+                self.show_search_bar_button.setChecked(False)
+
+    @property
+    def searching(self):
+        return self._search_job is not None and self._search_job.active
+
+    def cancel(self):
+        if self._search_job is not None:
+            self._search_job.cancel()
 
     def show(self):
         self.setVisible(True)
@@ -331,18 +451,40 @@ class SearchBar(QWidget):
         logger.debug('Search request %r: %r', direction, text)
 
         matcher = SearchMatcher(text, self._use_regex.isChecked(), self._case_sensitive.isChecked())
+        self.cancel()
         try:
-            result = self.on_search(direction, matcher)
+            matcher.match('')               # Validating the pattern before the search is started
+            job = self.on_search(direction, matcher)
         except SearchMatcher.BadPatternException as ex:
             flash(self, 'Invalid search pattern: %s', ex, duration=10)
-        else:
-            if result is None:
-                flash(self, 'Nothing found', duration=10)
+            return
+
+        if job is None:
+            flash(self, 'Nothing found', duration=10)
+            return
+
+        self._search_job = job
+        job.progress.connect(lambda x: self._progress.setValue(int(x * 100)))
+        job.finished.connect(partial(self._on_search_finished, job))
+        self._progress.setValue(0)
+        self._progress.setVisible(True)
+        self._button_cancel.setVisible(True)
+
+    def _on_search_finished(self, job, row):
+        if job is not self._search_job:
+            return
+        self._search_job = None
+        self._progress.setVisible(False)
+        self._button_cancel.setVisible(False)
+        if job.cancelled:
+            flash(self, 'Search cancelled', duration=3)
+        elif row is None:
+            flash(self, 'Nothing found', duration=10)
 
 
 class FilterBar(QWidget):
     class Filter(QWidget):
-        def __init__(self, parent, pattern_completion_model):
+        def __init__(self, parent, pattern_completion_model, pattern_tool_tip=None):
             super(FilterBar.Filter, self).__init__(parent)
 
             self.on_commit = lambda: None
@@ -354,6 +496,8 @@ class FilterBar(QWidget):
             self._bar = SearchBarComboBox(self, pattern_completion_model)
             self._bar.on_commit = self._on_commit
             self._bar.setFocus(Qt.OtherFocusReason)
+            if pattern_tool_tip:
+                self._bar.setToolTip(pattern_tool_tip)
 
             self._apply_button = make_icon_button('check', 'Apply this filter expression [Enter]', self,
                                                   on_clicked=self._on_commit)
@@ -393,9 +537,11 @@ class FilterBar(QWidget):
                                     inverse=self._inverse_button.isChecked())
             return matcher
 
-    def __init__(self, parent):
+    def __init__(self, parent, pattern_tool_tip=None):
         super(FilterBar, self).__init__(parent)
 
+        self._pattern_tool_tip = pattern_tool_tip
+
         self.add_filter_button = make_icon_button('filter', 'Add filter', self, on_clicked=self._on_add_filter)
 
         self.on_filter = lambda *_: None
@@ -423,7 +569,7 @@ class FilterBar(QWidget):
             self.on_filter(None)
 
     def _on_add_filter(self):
-        new_filter = self.Filter(self, self._pattern_completion_model)
+        new_filter = self.Filter(self, self._pattern_completion_model, self._pattern_tool_tip)
         new_filter.on_remove = self._on_remove_filter
         new_filter.on_commit = self._do_filter
 
@@ -521,7 +667,7 @@ class RealtimeLogWidget(QWidget):
 
     def _search(self, *args, **kwargs):
         self._pause.setChecked(True)
-        self._table.search(*args, **kwargs)
+        return self._table.search(*args, **kwargs)
 
     def _clear(self):
         self._table.setRowCount(0)
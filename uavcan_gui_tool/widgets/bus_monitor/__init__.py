@@ -6,137 +6,84 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
-import os
-import sys
-import queue
 import logging
-import multiprocessing
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import QTimer
-from .window import BusMonitorWindow
+from ...tool_host import DataFeed
+from .transport import make_frame_transport
 
 logger = logging.getLogger(__name__)
 
-try:
-    # noinspection PyUnresolvedReferences
-    sys.getwindowsversion()
-    RUNNING_ON_WINDOWS = True
-except AttributeError:
-    RUNNING_ON_WINDOWS = False
-    PARENT_PID = os.getppid()
 
-
-class IPCChannel:
-    """
-    This class is built as an abstraction over the underlying IPC communication channel.
-    """
-    def __init__(self):
-        # Queue is slower than pipe, but it allows to implement non-blocking sending easier,
-        # and the buffer can be arbitrarily large.
-        self._q = multiprocessing.Queue()
-
-    def send_nonblocking(self, obj):
-        try:
-            self._q.put_nowait(obj)
-        except queue.Full:
-            pass
-
-    def receive_nonblocking(self):
-        """Returns: (True, object) if successful, (False, None) if no data to read """
-        try:
-            return True, self._q.get_nowait()
-        except queue.Empty:
-            return False, None
-
-
-IPC_COMMAND_STOP = 'stop'
-
-
-def _process_entry_point(channel, iface_name):
-    logger.info('Bus monitor process started with PID %r', os.getpid())
-    app = QApplication(sys.argv)    # Inheriting args from the parent process
-
-    def exit_if_should():
-        if RUNNING_ON_WINDOWS:
-            return False
-        else:
-            return os.getppid() != PARENT_PID       # Parent is dead
-
-    exit_check_timer = QTimer()
-    exit_check_timer.setSingleShot(False)
-    exit_check_timer.timeout.connect(exit_if_should)
-    exit_check_timer.start(2000)
-
-    def get_frame():
-        received, obj = channel.receive_nonblocking()
-        if received:
-            if obj == IPC_COMMAND_STOP:
-                logger.info('Bus monitor process has received a stop request, goodbye')
-                app.exit(0)
-            else:
-                return obj
-
-    win = BusMonitorWindow(get_frame, iface_name)
+def _create_window(host, frame_transport, iface_name, capacity):
+    from .window import BusMonitorWindow     # The main process does not need it
+    frame_transport.attach(host)
+    win = BusMonitorWindow(frame_transport, iface_name, capacity)
     win.show()
+    host.add_exit_handler(win.stop_recording)   # The recording will be completed before the process exits
+    return win
 
-    logger.info('Bus monitor process %r initialized successfully, now starting the event loop', os.getpid())
-    sys.exit(app.exec_())
 
+class FrameFeed(DataFeed):
+    """
+    Delivers every CAN frame sent or received by the local node to the attached processes.
+    """
+    FLUSH_INTERVAL = 0.02
 
-# TODO: Duplicates PlotterManager; refactor into an abstract process factory
-class BusMonitorManager:
-    def __init__(self, node, can_iface_name):
+    def __init__(self, node):
         self._node = node
-        self._can_iface_name = can_iface_name
-        self._inferiors = []    # process object, channel
+        self._transports = []       # tool process, frame transport
         self._hook_handle = None
+        self._flush_timer_handle = None
 
+    # With --threaded-node, this is invoked from the node I/O thread, so the list of transports is never modified
+    # in place; it is replaced instead
     def _frame_hook(self, direction, frame):
-        for proc, channel in self._inferiors[:]:
-            if proc.is_alive():
-                try:
-                    channel.send_nonblocking((direction, frame))
-                except Exception:
-                    logger.error('Failed to send data to process %r', proc, exc_info=True)
-            else:
-                logger.info('Bus monitor process %r appears to be dead, removing', proc)
-                self._inferiors.remove((proc, channel))
+        for proc, frame_transport in self._transports:
+            try:
+                frame_transport.push(direction, frame)
+            except Exception:
+                logger.error('Failed to send data to process %r', proc, exc_info=True)
 
-    def spawn_monitor(self):
-        channel = IPCChannel()
+    def _flush(self):
+        for proc, frame_transport in self._transports:
+            try:
+                frame_transport.flush()
+            except Exception:
+                logger.error('Failed to send data to process %r', proc, exc_info=True)
 
+    def attach(self, tool_process):
         if self._hook_handle is None:
             self._hook_handle = self._node.can_driver.add_io_hook(self._frame_hook)
+            self._flush_timer_handle = self._node.periodic(self.FLUSH_INTERVAL, self._flush)
 
-        proc = multiprocessing.Process(target=_process_entry_point, name='bus_monitor',
-                                       args=(channel, self._can_iface_name))
-        proc.daemon = True
-        proc.start()
-
-        self._inferiors.append((proc, channel))
+        frame_transport = make_frame_transport(tool_process.channel)
+        self._transports = self._transports + [(tool_process, frame_transport)]
+        logger.info('Frames will be delivered to %r using %s', tool_process, type(frame_transport).__name__)
+        return frame_transport
 
-        logger.info('Spawned new bus monitor process %r', proc)
+    def detach(self, tool_process):
+        for proc, frame_transport in self._transports:
+            if proc is tool_process:
+                frame_transport.close()
+        self._transports = [x for x in self._transports if x[0] is not tool_process]
 
     def close(self):
-        try:
-            self._hook_handle.remove()
-        except Exception:
-            pass
-
-        for _, channel in self._inferiors:
+        for handle in (self._hook_handle, self._flush_timer_handle):
             try:
-                channel.send_nonblocking(IPC_COMMAND_STOP)
+                handle.remove()
             except Exception:
                 pass
 
-        for proc, _ in self._inferiors:
-            try:
-                proc.join(1)
-            except Exception:
-                pass
 
-        for proc, _ in self._inferiors:
-            try:
-                proc.terminate()
-            except Exception:
-                pass
+class BusMonitorManager:
+    def __init__(self, node, can_iface_name, tool_host_pool, capacity=None):
+        self._can_iface_name = can_iface_name
+        self._capacity = capacity       # Number of frames kept by each monitor; None selects the default
+        self._tool_host_pool = tool_host_pool
+        self._feed = FrameFeed(node)
+
+    def spawn_monitor(self):
+        self._tool_host_pool.spawn('bus_monitor', _create_window, (self._can_iface_name, self._capacity),
+                                   feed=self._feed)
+
+    def close(self):
+        self._feed.close()
@@ -0,0 +1,259 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Filtering of the frame store.
+A filter expression that consists only of field conditions, such as 'src=10 type=NodeStatus', is evaluated as
+NumPy masks over the columns of the store. Any other expression is matched against the rendered text of the rows,
+like in the other tables; such matchers are only applied to the rows that have passed all field conditions.
+"""
+
+import re
+import numpy
+import uavcan
+from logging import getLogger
+from .frame_store import FLAG_EXTENDED, FLAG_TX
+
+
+logger = getLogger(__name__)
+
+FILTER_HELP = """Either text to match or field conditions separated by spaces, all of which must hold:
+    id=0x155                    CAN ID, hex or decimal
+    id=0x100..0x1FF             CAN ID range, inclusive
+    src=10, src=10..20          source node ID; 0 matches anonymous messages
+    dst=125, dst=1..10          destination node ID of service transfers
+    type=NodeStatus             data type whose full name contains the text (case insensitive)
+    dir=tx, dir=rx              direction
+    dlc=8                       data length
+    data=11??33                 payload bytes in hex starting from the first byte; ?? matches any byte
+    data[7]=0xC0                payload byte
+    data[7]&0xC0=0x80           payload byte under a bit mask
+In regular expression mode, patterns are always matched as text."""
+
+CHUNK_SIZE = 1024 * 1024        # Masks are computed in chunks to keep the memory footprint bounded
+
+_CONDITION_REGEX = re.compile(r'^(id|src|dst|type|dir|dlc|data)(?:\[(\d)\])?(?:&(\w+))?=(\S+)$', re.IGNORECASE)
+
+
+class BadFilterException(ValueError):
+    pass
+
+
+def _parse_int(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise BadFilterException('Invalid number: %r' % text)
+
+
+def _parse_range(text):
+    if '..' in text:
+        low, high = text.split('..', 1)
+        return _parse_int(low), _parse_int(high)
+    value = _parse_int(text)
+    return value, value
+
+
+def _in_range(values, value_range):
+    low, high = value_range
+    return (values >= low) & (values <= high)
+
+
+def _get_node_id_masks(can_id, flags):
+    extended = (flags & FLAG_EXTENDED) != 0
+    service = extended & (((can_id >> 7) & 1) != 0)
+    return extended, service
+
+
+def _make_id_predicate(value_range):
+    return lambda store, slots: _in_range(store.can_id[slots], value_range)
+
+
+def _make_src_predicate(value_range):
+    def predicate(store, slots):
+        can_id = store.can_id[slots]
+        extended, _ = _get_node_id_masks(can_id, store.flags[slots])
+        return extended & _in_range(can_id & 0x7F, value_range)
+    return predicate
+
+
+def _make_dst_predicate(value_range):
+    def predicate(store, slots):
+        can_id = store.can_id[slots]
+        _, service = _get_node_id_masks(can_id, store.flags[slots])
+        return service & _in_range((can_id >> 8) & 0x7F, value_range)
+    return predicate
+
+
+def _make_type_predicate(name):
+    name = name.lower()
+    message_ids, service_ids = [], []
+    for full_name, t in uavcan.TYPENAMES.items():
+        if name in full_name.lower() and t.default_dtid is not None:
+            (service_ids if t.kind == t.KIND_SERVICE else message_ids).append(t.default_dtid)
+
+    if not message_ids and not service_ids:
+        raise BadFilterException('No data types with default data type ID match %r' % name)
+
+    message_ids = numpy.array(message_ids, dtype=numpy.uint32)
+    service_ids = numpy.array(service_ids, dtype=numpy.uint32)
+
+    def predicate(store, slots):
+        can_id = store.can_id[slots]
+        extended, service = _get_node_id_masks(can_id, store.flags[slots])
+
+        message_type_id = (can_id >> 8) & 0xFFFF
+        anonymous = (can_id & 0x7F) == 0
+        message_type_id[anonymous] &= 0b11          # Anonymous messages carry only two bits of the type ID
+
+        is_message = extended & ~service & numpy.isin(message_type_id, message_ids)
+        is_service = service & numpy.isin((can_id >> 16) & 0xFF, service_ids)
+        return is_message | is_service
+    return predicate
+
+
+def _make_dir_predicate(direction):
+    direction = direction.lower()
+    if direction not in ('tx', 'rx'):
+        raise BadFilterException('Direction must be either tx or rx')
+    want_tx = direction == 'tx'
+    return lambda store, slots: ((store.flags[slots] & FLAG_TX) != 0) == want_tx
+
+
+def _make_dlc_predicate(value_range):
+    return lambda store, slots: _in_range(store.dlc[slots], value_range)
+
+
+def _make_data_pattern_predicate(pattern):
+    if len(pattern) % 2 or len(pattern) > 16:
+        raise BadFilterException('Data pattern must consist of up to 8 hex bytes: %r' % pattern)
+
+    conditions = []
+    for index in range(len(pattern) // 2):
+        byte = pattern[index * 2:index * 2 + 2]
+        if byte != '??':
+            conditions.append((index, 0xFF, _parse_int('0x' + byte)))
+    return _make_data_byte_predicate(conditions, min_length=len(pattern) // 2)
+
+
+def _make_data_byte_predicate(conditions, min_length=None):
+    if min_length is None:
+        min_length = max(index for index, _, _ in conditions) + 1
+
+    def predicate(store, slots):
+        data = store.data[slots]
+        mask = store.dlc[slots] >= min_length
+        for index, bit_mask, value in conditions:
+            mask &= (data[:, index] & bit_mask) == value
+        return mask
+    return predicate
+
+
+def _compile_condition(text):
+    match = _CONDITION_REGEX.match(text)
+    if not match:
+        return None
+    field, index, bit_mask, value = match.groups()
+    field = field.lower()
+
+    if field == 'data':
+        if index is None:
+            if bit_mask is not None:
+                raise BadFilterException('Bit mask requires a byte index: %r' % text)
+            return _make_data_pattern_predicate(value)
+        index = int(index)
+        if index >= 8:
+            raise BadFilterException('Byte index is out of range: %r' % text)
+        bit_mask = 0xFF if bit_mask is None else _parse_int(bit_mask)
+        return _make_data_byte_predicate([(index, bit_mask, _parse_int(value) & bit_mask)])
+
+    if index is not None or bit_mask is not None:
+        raise BadFilterException('Only data bytes can be indexed and masked: %r' % text)
+
+    return {
+        'id': lambda: _make_id_predicate(_parse_range(value)),
+        'src': lambda: _make_src_predicate(_parse_range(value)),
+        'dst': lambda: _make_dst_predicate(_parse_range(value)),
+        'type': lambda: _make_type_predicate(value),
+        'dir': lambda: _make_dir_predicate(value),
+        'dlc': lambda: _make_dlc_predicate(_parse_range(value)),
+    }[field]()
+
+
+def compile_field_conditions(text):
+    """
+    Returns a predicate (store, slots) -> boolean mask, or None if the text is not a list of field conditions.
+    Throws BadFilterException if the text looks like a list of field conditions but is invalid.
+    """
+    tokens = text.split()
+    if not tokens:
+        return None
+
+    predicates = []
+    for token in tokens:
+        predicate = _compile_condition(token)
+        if predicate is None:
+            return None
+        predicates.append(predicate)
+
+    def predicate(store, slots):
+        mask = predicates[0](store, slots)
+        for p in predicates[1:]:
+            mask &= p(store, slots)
+        return mask
+    return predicate
+
+
+class FrameFilter:
+    """
+    Applies a SearchMatcherChain to the frame store. Matchers whose patterns are lists of field conditions are
+    evaluated vectorially; the rest, including all regular expression matchers, fall back to matching the text
+    rendered by render_text(seq).
+    """
+    def __init__(self, chain, render_text):
+        self._render_text = render_text
+        self._predicates = []       # (predicate, inverse)
+        self._text_matchers = []
+
+        for matcher in chain.matchers:
+            if matcher.use_regex:
+                self._text_matchers.append(matcher)
+                continue
+            try:
+                predicate = compile_field_conditions(matcher.pattern)
+            except BadFilterException as ex:
+                raise matcher.BadPatternException(str(ex))
+
+            if predicate is not None:
+                self._predicates.append((predicate, matcher.inverse))
+            else:
+                self._text_matchers.append(matcher)
+
+        logger.info('Frame filter: %d vectorized conditions, %d text matchers',
+                    len(self._predicates), len(self._text_matchers))
+
+    def apply(self, store, begin, end):
+        """Returns a sorted array of sequence numbers within [begin, end) that pass the filter"""
+        out = []
+        for chunk_begin in range(begin, end, CHUNK_SIZE):
+            seqs = numpy.arange(chunk_begin, min(chunk_begin + CHUNK_SIZE, end), dtype=numpy.int64)
+            slots = store.slots(seqs)
+
+            mask = numpy.ones(len(seqs), dtype=bool)
+            for predicate, inverse in self._predicates:
+                m = predicate(store, slots)
+                mask &= ~m if inverse else m
+            seqs = seqs[mask]
+
+            if self._text_matchers:
+                seqs = numpy.array([seq for seq in seqs.tolist()
+                                    if all(m.match(self._render_text(seq)) for m in self._text_matchers)],
+                                   dtype=numpy.int64)
+            out.append(seqs)
+
+        return numpy.concatenate(out) if out else numpy.zeros(0, dtype=numpy.int64)
@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Offline browsing of binary logs written by the recorder (see recorder.BinaryLogFormat).
+The file is memory-mapped, so it can be much larger than the available memory; only the pages that are actually
+displayed or decoded are read from disk, and frames are never converted into Python objects in bulk.
+"""
+
+import os
+import numpy
+from logging import getLogger
+from .frame_store import FrameStore, FRAME_RECORD_DTYPE
+from .recorder import BinaryLogFormat
+from .transfer_decoder import WindowedTransferIndex
+
+
+logger = getLogger(__name__)
+
+
+class MappedFrameStore(FrameStore):
+    """
+    Read-only FrameStore backed by a memory-mapped binary log.
+    The sequence number of a frame is its index in the file, and the columns are views of the mapping.
+    """
+    def __init__(self, path):
+        header_size = BinaryLogFormat.HEADER.size
+        with open(path, 'rb') as f:
+            header = f.read(header_size)
+
+        if len(header) < header_size:
+            raise ValueError('File is too short to be a CAN log: %r' % path)
+        magic, version, record_size = BinaryLogFormat.HEADER.unpack(header)
+        if magic != BinaryLogFormat.MAGIC or record_size != FRAME_RECORD_DTYPE.itemsize:
+            raise ValueError('Not a CAN log or unsupported format: %r' % path)
+
+        # The last record may be incomplete if the recording was interrupted
+        num_records = (os.path.getsize(path) - header_size) // FRAME_RECORD_DTYPE.itemsize
+        if num_records > 0:
+            self._records = numpy.memmap(path, dtype=FRAME_RECORD_DTYPE, mode='r', offset=header_size,
+                                         shape=(num_records,))
+        else:
+            self._records = numpy.zeros(0, dtype=FRAME_RECORD_DTYPE)
+
+        self._capacity = max(num_records, 1)
+        self._end = num_records
+
+        self.can_id = self._records['can_id']
+        self.dlc = self._records['dlc']
+        self.data = self._records['data']
+        self.flags = self._records['flags']
+        self.ts_mono = self._records['ts_mono']
+        self.ts_real = self._records['ts_real']
+
+        self.transfers = WindowedTransferIndex()
+
+        logger.info('Opened CAN log %r with %d frames', path, num_records)
+
+    def clear(self):
+        pass                # The log is immutable
+
+    def extend(self, records):
+        raise TypeError('CAN log is read-only')
+
+    def get_records(self, begin, end):
+        """Returns the FRAME_RECORD_DTYPE records in the range of sequence numbers [begin, end)"""
+        return self._records[begin:end]
+
+
+class SparseTimeIndex:
+    """
+    Maps real timestamps to sequence numbers by sampling every STRIDE-th frame.
+    Building the index touches only one page of the file per sample, and a lookup reads at most one stride of
+    timestamps. Real time may go backwards (e.g. when the system clock is adjusted), so the samples are made
+    monotonic; the result of a lookup is then the first frame at or after the requested time within the stride.
+    """
+    STRIDE = 4096
+
+    def __init__(self, store):
+        self._store = store
+        self._seqs = numpy.arange(store.first, store.end, self.STRIDE, dtype=numpy.int64)
+        self._ts_real = numpy.array(store.ts_real[self._seqs])
+        if len(self._ts_real):
+            self._ts_real = numpy.maximum.accumulate(self._ts_real)
+        self._ts_mono = numpy.array(store.ts_mono[self._seqs])
+
+    def find(self, ts_real):
+        """Returns the sequence number of the first frame with a real timestamp not less than the specified one"""
+        if not len(self._seqs):
+            return self._store.end
+
+        block = max(int(numpy.searchsorted(self._ts_real, ts_real, side='left')) - 1, 0)
+        while block < len(self._seqs):
+            begin = int(self._seqs[block])
+            end = min(begin + self.STRIDE, self._store.end)
+            later = numpy.nonzero(self._store.ts_real[begin:end] >= ts_real)[0]
+            if len(later):
+                return begin + int(later[0])
+            block += 1
+        return self._store.end
+
+    def get_frame_rate(self):
+        """Returns (monotonic timestamps, frames per second), estimated over every stride"""
+        dt = numpy.diff(self._ts_mono)
+        valid = dt > 0
+        return self._ts_mono[1:][valid], self.STRIDE / dt[valid]
+
+
+class FrameLogFile:
+    """
+    Frame source for BusMonitorWindow that replays a log file.
+    Unlike live sources, it does not deliver frames incrementally; all of them are available in the store at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.store = MappedFrameStore(path)
+        self.time_index = SparseTimeIndex(self.store)
+
+    def receive(self):
+        return numpy.zeros(0, dtype=FRAME_RECORD_DTYPE)
+
+    @property
+    def dropped(self):
+        return 0
@@ -0,0 +1,140 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import numpy
+from uavcan.driver import CANFrame
+from .transfer_decoder import TransferIndex
+
+
+FLAG_EXTENDED = 1
+FLAG_TX = 2
+
+# Packed representation of a single frame, used for bulk transfers between processes and for log files
+FRAME_RECORD_DTYPE = numpy.dtype([
+    ('ts_mono', '<f8'),
+    ('ts_real', '<f8'),
+    ('can_id', '<u4'),
+    ('flags', 'u1'),
+    ('dlc', 'u1'),
+    ('data', 'u1', (CANFrame.MAX_DATA_LENGTH,)),
+    ('padding', 'u1', (2,)),
+])
+
+
+class FrameStore:
+    """
+    Preallocated columnar ring buffer of CAN frames.
+    Every frame is assigned a sequence number, which starts from zero and grows monotonically until the store is
+    cleared. The frame with sequence number N lives in the slot N % capacity, so once the store is full, every new
+    frame evicts the oldest one. Only the sequence numbers in the range [first, end) are valid.
+    The memory footprint is fixed and does not depend on the amount of traffic (about 46 bytes per frame,
+    including the transfer index).
+    """
+    DEFAULT_CAPACITY = 1000000
+
+    def __init__(self, capacity=None):
+        capacity = int(capacity or self.DEFAULT_CAPACITY)
+        if capacity < 1:
+            raise ValueError('Invalid frame store capacity: %r' % capacity)
+
+        self._capacity = capacity
+        self._end = 0
+
+        self.can_id = numpy.zeros(capacity, dtype=numpy.uint32)
+        self.dlc = numpy.zeros(capacity, dtype=numpy.uint8)
+        self.data = numpy.zeros((capacity, CANFrame.MAX_DATA_LENGTH), dtype=numpy.uint8)
+        self.flags = numpy.zeros(capacity, dtype=numpy.uint8)
+        self.ts_mono = numpy.zeros(capacity, dtype=numpy.float64)
+        self.ts_real = numpy.zeros(capacity, dtype=numpy.float64)
+
+        self.transfers = TransferIndex(capacity)
+
+    def __len__(self):
+        return self._end - self.first
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def first(self):
+        """Sequence number of the oldest frame that is still stored"""
+        return max(0, self._end - self._capacity)
+
+    @property
+    def end(self):
+        """Sequence number that will be assigned to the next frame"""
+        return self._end
+
+    def clear(self):
+        # The arrays are not touched; the stale data will be overwritten as new frames arrive
+        self._end = 0
+        self.transfers.clear()
+
+    def append(self, direction, frame):
+        record = numpy.zeros(1, dtype=FRAME_RECORD_DTYPE)[0]
+        record['can_id'] = frame.id
+        record['dlc'] = len(frame.data)
+        record['data'][:len(frame.data)] = numpy.frombuffer(bytes(frame.data), dtype=numpy.uint8)
+        record['flags'] = (FLAG_EXTENDED if frame.extended else 0) | (FLAG_TX if direction == 'tx' else 0)
+        record['ts_mono'] = frame.ts_monotonic
+        record['ts_real'] = frame.ts_real
+        self.extend(record.reshape(1))
+
+    def extend(self, records):
+        """Appends an array of FRAME_RECORD_DTYPE records"""
+        num_records = len(records)
+        if num_records > self._capacity:
+            # Only the most recent frames would survive anyway
+            self._end += num_records - self._capacity
+            records = records[-self._capacity:]
+            num_records = self._capacity
+
+        slots = (self._end + numpy.arange(num_records)) % self._capacity
+
+        self.can_id[slots] = records['can_id']
+        self.dlc[slots] = records['dlc']
+        self.data[slots] = records['data']
+        self.flags[slots] = records['flags']
+        self.ts_mono[slots] = records['ts_mono']
+        self.ts_real[slots] = records['ts_real']
+
+        self.transfers.add(self._end, records)
+        self._end += num_records
+
+    def contains(self, seq):
+        return self.first <= seq < self._end
+
+    def slots(self, seqs):
+        """Maps an array of sequence numbers to the array of storage slots"""
+        return numpy.asarray(seqs, dtype=numpy.int64) % self._capacity
+
+    def get_direction(self, seq):
+        return 'tx' if self.flags[seq % self._capacity] & FLAG_TX else 'rx'
+
+    def is_end_of_transfer(self, seq):
+        slot = seq % self._capacity
+        dlc = self.dlc[slot]
+        return dlc > 0 and bool(self.data[slot, dlc - 1] & 0b01000000)
+
+    def get_ts_real(self, seq):
+        return float(self.ts_real[seq % self._capacity])
+
+    def get(self, seq):
+        """Returns: (direction, CANFrame); the sequence number must be valid"""
+        if not self.contains(seq):
+            raise IndexError('Frame %r is not in the store [%r, %r)' % (seq, self.first, self._end))
+
+        slot = seq % self._capacity
+        flags = int(self.flags[slot])
+        frame = CANFrame(int(self.can_id[slot]),
+                         self.data[slot, :self.dlc[slot]].tobytes(),
+                         bool(flags & FLAG_EXTENDED),
+                         ts_monotonic=float(self.ts_mono[slot]),
+                         ts_real=float(self.ts_real[slot]))
+        return ('tx' if flags & FLAG_TX else 'rx'), frame
@@ -0,0 +1,487 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import os
+import numpy
+from collections import OrderedDict
+from logging import getLogger
+from PyQt5.QtWidgets import QTableView, QAbstractItemView, QHeaderView, QApplication, QWidget, QHBoxLayout, \
+    QVBoxLayout
+from PyQt5.QtCore import Qt, QTimer, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QKeySequence
+from .. import SearchBar, FilterBar, LabelWithIcon, IncrementalSearch, make_icon_button, get_icon
+from .frame_store import FrameStore
+from .frame_filter import FrameFilter, FILTER_HELP
+
+
+logger = getLogger(__name__)
+
+
+class FrameTableModel(QAbstractTableModel):
+    """
+    Exposes the contents of a FrameStore to a table view.
+    Cells are rendered on demand, only when the view asks for them, so the cost of a row does not depend on the
+    size of the capture. The model does not track the store automatically; call sync() to expose new frames.
+    Column renderers receive a tuple (direction, CANFrame, real timestamp of the previous frame or None).
+    """
+    RENDER_CACHE_SIZE = 4096
+    SEARCH_TEXT_CACHE_SIZE = 256 * 1024
+
+    def __init__(self, parent, columns, store):
+        super(FrameTableModel, self).__init__(parent)
+        self._columns = columns
+        self._store = store
+
+        # Range of sequence numbers that is currently exposed to the view
+        self._first = 0
+        self._end = 0
+
+        self._filter = None
+        self._filtered_seqs = None          # Sorted array of matching sequence numbers; None if not filtered
+
+        self._render_cache = OrderedDict()  # Sequence number : list of (text, color)
+
+        # Searchable text of the frames, addressed by sequence number modulo the size like the frame store; since
+        # stored frames never change, an entry only becomes invalid when its slot is reused by a newer frame
+        self._search_text = [None] * self.SEARCH_TEXT_CACHE_SIZE
+        self._search_text_seqs = [-1] * self.SEARCH_TEXT_CACHE_SIZE
+        self._marked = set()                # Sequence numbers
+        self._mark_icon = None
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def columns(self):
+        return self._columns
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self._filtered_seqs is not None:
+            return len(self._filtered_seqs)
+        return self._end - self._first
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self._columns[section].name
+
+    def flags(self, index):
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return
+
+        seq = self.row_to_seq(index.row())
+        if not self._store.contains(seq):
+            return                          # Evicted from the store while the updates were paused
+
+        if role == Qt.DisplayRole:
+            return self._render(seq)[index.column()][0]
+
+        if role == Qt.BackgroundRole:
+            return self._render(seq)[index.column()][1]
+
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignVCenter | Qt.AlignLeft)
+
+        if role == Qt.DecorationRole and index.column() == 0 and seq in self._marked:
+            if self._mark_icon is None:
+                self._mark_icon = get_icon('circle')
+            return self._mark_icon
+
+    def _render_uncached(self, seq):
+        direction, frame = self._store.get(seq)
+        prev_ts_real = self._store.get_ts_real(seq - 1) if self._store.contains(seq - 1) else None
+        model = direction, frame, prev_ts_real
+
+        out = []
+        for spec in self._columns:
+            value = spec.render(model)
+            color = None
+            if isinstance(value, tuple):
+                value, color = value
+            out.append((str(value), color))
+        return out
+
+    def _render_text(self, seq, column_predicate):
+        """Renders only the text of the selected columns, bypassing the cache; used for bulk matching"""
+        direction, frame = self._store.get(seq)
+        prev_ts_real = self._store.get_ts_real(seq - 1) if self._store.contains(seq - 1) else None
+        model = direction, frame, prev_ts_real
+
+        out = []
+        for spec in self._columns:
+            if column_predicate(spec):
+                value = spec.render(model)
+                out.append(str(value[0] if isinstance(value, tuple) else value))
+        return '\t'.join(out)
+
+    def _render(self, seq):
+        try:
+            out = self._render_cache[seq]
+            self._render_cache.move_to_end(seq)
+            return out
+        except KeyError:
+            pass
+
+        out = self._render_uncached(seq)
+        self._render_cache[seq] = out
+        while len(self._render_cache) > self.RENDER_CACHE_SIZE:
+            self._render_cache.popitem(last=False)
+        return out
+
+    def row_to_seq(self, row):
+        if self._filtered_seqs is not None:
+            return int(self._filtered_seqs[row])
+        return self._first + row
+
+    def seq_to_row(self, seq):
+        """Returns the row where the specified frame is displayed, or None if it is not displayed"""
+        if self._filtered_seqs is not None:
+            row = int(numpy.searchsorted(self._filtered_seqs, seq))
+            if row < len(self._filtered_seqs) and self._filtered_seqs[row] == seq:
+                return row
+        elif self._first <= seq < self._end:
+            return seq - self._first
+
+    def find_row(self, seq):
+        """Returns the row of the specified frame or of the first displayed frame after it, or None if none"""
+        if self._filtered_seqs is not None:
+            row = int(numpy.searchsorted(self._filtered_seqs, seq))
+        else:
+            row = max(seq, self._first) - self._first
+        return row if row < self.rowCount() else None
+
+    def get_text(self, row, column):
+        return self._render(self.row_to_seq(row))[column][0]
+
+    def get_search_text(self, row):
+        """Returns the text of the searchable columns, or None if the frame has been evicted from the store"""
+        seq = self.row_to_seq(row)
+        if not self._store.contains(seq):
+            return None
+
+        slot = seq % self.SEARCH_TEXT_CACHE_SIZE
+        if self._search_text_seqs[slot] != seq:
+            self._search_text[slot] = self._render_text(seq, lambda c: c.searchable)
+            self._search_text_seqs[slot] = seq
+        return self._search_text[slot]
+
+    def get_row_as_string(self, row, column_predicate=None):
+        return self._get_seq_as_string(self.row_to_seq(row), column_predicate)
+
+    def _get_seq_as_string(self, seq, column_predicate=None):
+        cells = self._render(seq)
+        return '\t'.join(text for (text, _), col in zip(cells, self._columns)
+                         if column_predicate is None or column_predicate(col))
+
+    def _match_range(self, begin, end):
+        """Returns a sorted array of sequence numbers within [begin, end) that pass the current filter"""
+        return self._filter.apply(self._store, begin, end)
+
+    def sync(self):
+        """Exposes the frames that were added to the store since the previous call; returns the number of new rows"""
+        first, end = self._store.first, self._store.end
+        if end < self._end:
+            self.reset()                    # The store has been cleared behind our back
+            return 0
+
+        # Removing the rows that were evicted from the store
+        if self._filtered_seqs is not None:
+            num_evicted = int(numpy.searchsorted(self._filtered_seqs, first))
+        else:
+            num_evicted = min(first, self._end) - self._first
+        if num_evicted > 0:
+            self.beginRemoveRows(QModelIndex(), 0, num_evicted - 1)
+            if self._filtered_seqs is not None:
+                self._filtered_seqs = self._filtered_seqs[num_evicted:]
+            self._first = first
+            self._end = max(self._end, first)
+            self.endRemoveRows()
+        else:
+            self._first = max(self._first, first)
+            self._end = max(self._end, first)
+
+        # Appending the new rows
+        if self._filtered_seqs is not None:
+            new_seqs = self._match_range(self._end, end)
+            num_added = len(new_seqs)
+        else:
+            new_seqs = None
+            num_added = end - self._end
+        if num_added > 0:
+            row_count = self.rowCount()
+            self.beginInsertRows(QModelIndex(), row_count, row_count + num_added - 1)
+            if new_seqs is not None:
+                self._filtered_seqs = numpy.concatenate((self._filtered_seqs, new_seqs))
+            self._end = end
+            self.endInsertRows()
+        else:
+            self._end = end
+
+        return num_added
+
+    def set_filter(self, matcher):
+        """Accepts a SearchMatcherChain or None; see frame_filter for the supported field conditions"""
+        filtered_seqs = None
+        self._filter = None
+        if matcher is not None:
+            # May throw if the pattern is invalid
+            self._filter = FrameFilter(matcher, lambda seq: self._render_text(seq, lambda c: c.filterable))
+            filtered_seqs = self._match_range(self._first, self._end)
+
+        self.beginResetModel()
+        self._filtered_seqs = filtered_seqs
+        self.endResetModel()
+
+    def reset(self):
+        self.beginResetModel()
+        self._first = self._end = 0
+        if self._filtered_seqs is not None:
+            self._filtered_seqs = numpy.zeros(0, dtype=numpy.int64)
+        self._render_cache.clear()
+        self._search_text_seqs = [-1] * self.SEARCH_TEXT_CACHE_SIZE       # Sequence numbers will be reused
+        self._marked.clear()
+        self.endResetModel()
+
+    def clear(self):
+        self._store.clear()
+        self.reset()
+
+    def toggle_mark(self, row):
+        """Returns True if the row is marked now, False if the mark has been removed"""
+        seq = self.row_to_seq(row)
+        if seq in self._marked:
+            self._marked.remove(seq)
+        else:
+            self._marked.add(seq)
+        index = self.index(row, 0)
+        self.dataChanged.emit(index, index)
+        return seq in self._marked
+
+
+class FrameTableView(QTableView):
+    def __init__(self, parent, model, font=None):
+        super(FrameTableView, self).__init__(parent)
+        self.setModel(model)
+
+        self.setShowGrid(False)
+        self.setWordWrap(False)
+        self.verticalHeader().setVisible(False)
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(20)                 # TODO: I feel this is not very portable
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.Fixed)
+
+        for idx, col in enumerate(model.columns):
+            self.horizontalHeader().setSectionResizeMode(idx, col.resize_mode)
+
+        if font:
+            self.setFont(font)
+
+    def keyPressEvent(self, qkeyevent):
+        if qkeyevent.matches(QKeySequence.Copy):
+            selected_rows = [x.row() for x in self.selectionModel().selectedRows()]
+            logger.info('Copy to clipboard requested [%r rows]' % len(selected_rows))
+
+            out_string = ''
+            for row in sorted(selected_rows):
+                out_string += self.model().get_row_as_string(row) + os.linesep
+
+            if out_string:
+                QApplication.clipboard().setText(out_string)
+        else:
+            super(FrameTableView, self).keyPressEvent(qkeyevent)
+
+    def search(self, direction, matcher):
+        """Returns a started IncrementalSearch, or None if the table is empty"""
+        model = self.model()
+        row_count = model.rowCount()
+        if row_count == 0:
+            return
+
+        # Determining the start location
+        selected_rows = sorted([x.row() for x in self.selectionModel().selectedRows()])
+        if selected_rows:
+            # If at least one row is selected, search from there
+            search_from_row = selected_rows[0] if direction == 'up' else selected_rows[-1]
+        else:
+            # If nothing is selected, search from beginning
+            search_from_row = (row_count - 1) if direction == 'up' else 0
+
+        search_from_row = max(0, search_from_row)
+        logger.debug('Frame table search from %r, %r', search_from_row, direction)
+
+        self.clearSelection()
+
+        def get_text(row):
+            return model.get_search_text(row) if row < model.rowCount() else None
+
+        def on_finished(row):
+            if row is not None:
+                self.selectRow(row)
+                self.scrollTo(model.index(row, 0))
+
+        job = IncrementalSearch(self, row_count, search_from_row, direction, get_text, matcher)
+        job.finished.connect(on_finished)
+
+        # Row numbers are no longer valid once the rows are shifted or reset
+        model.rowsRemoved.connect(job.cancel)
+        model.modelReset.connect(job.cancel)
+
+        job.start()
+        return job
+
+
+class FrameLogWidget(QWidget):
+    """
+    Same controls as RealtimeLogWidget, but the frames are kept in a fixed-size FrameStore rather than in
+    a QTableWidget, so the memory footprint and the redraw cost do not grow with the length of the capture.
+    If a store is provided, it is displayed as is and the capture controls are hidden; this is used for log files.
+    """
+    def __init__(self, parent, columns, capacity=None, font=None, started_by_default=False, pre_redraw_hook=None,
+                 store=None):
+        super(FrameLogWidget, self).__init__(parent)
+
+        self.on_selection_changed = None
+
+        self.pre_redraw_hook = pre_redraw_hook or (lambda: None)
+
+        read_only = store is not None
+        self._store = store if read_only else FrameStore(capacity)
+        self._model = FrameTableModel(self, columns, self._store)
+        self._table = FrameTableView(self, self._model, font=font)
+        self._table.selectionModel().selectionChanged.connect(self._call_on_selection_changed)
+
+        self._clear_button = make_icon_button('trash-o', 'Clear', self, on_clicked=self._clear)
+
+        self._pause = make_icon_button('pause', 'Pause updates; data received while paused will not be lost '
+                                       'unless the capacity of the frame store is exceeded', self, checkable=True)
+
+        self._start_button = make_icon_button('video-camera', 'Start/stop capturing', self,
+                                              checkable=True,
+                                              checked=started_by_default or read_only,
+                                              on_clicked=self._on_start_button_clicked)
+
+        self._search_bar = SearchBar(self)
+        self._search_bar.on_search = self._search
+
+        self._filter_bar = FilterBar(self, pattern_tool_tip=FILTER_HELP)
+        self._filter_bar.on_filter = self._model.set_filter
+
+        self._row_count = LabelWithIcon(get_icon('list'), '0', self)
+        if read_only:
+            self._row_count.setToolTip('Row count')
+        else:
+            self._row_count.setToolTip('Row count; up to %d most recent frames are kept' % self._store.capacity)
+
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(False)
+        self._redraw_timer.timeout.connect(self._redraw)
+        self._redraw_timer.start(100)
+
+        layout = QVBoxLayout(self)
+
+        controls_layout = QHBoxLayout(self)
+        controls_layout.addWidget(self._start_button)
+        controls_layout.addWidget(self._pause)
+        controls_layout.addWidget(self._clear_button)
+        controls_layout.addWidget(self._search_bar.show_search_bar_button)
+        controls_layout.addWidget(self._filter_bar.add_filter_button)
+
+        self._custom_area_layout = QHBoxLayout(self)
+        self._custom_area_layout.setContentsMargins(0, 0, 0, 0)
+        controls_layout.addLayout(self._custom_area_layout, 1)
+        controls_layout.addStretch()
+
+        controls_layout.addWidget(self._row_count)
+
+        layout.addLayout(controls_layout)
+        layout.addWidget(self._search_bar)
+        layout.addWidget(self._filter_bar)
+        layout.addWidget(self._table, 1)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        if read_only:
+            for w in (self._start_button, self._pause, self._clear_button):
+                w.hide()
+            self._model.sync()
+            self._row_count.setText(str(self._model.rowCount()))
+
+    def keyPressEvent(self, qkeyevent):
+        super(FrameLogWidget, self).keyPressEvent(qkeyevent)
+        if qkeyevent.matches(QKeySequence.Find):
+            self._search_bar.show()
+
+    def _search(self, *args, **kwargs):
+        self._pause.setChecked(True)
+        return self._table.search(*args, **kwargs)
+
+    def _clear(self):
+        self._model.clear()
+        self._row_count.setText(str(self._model.rowCount()))
+
+    def _call_on_selection_changed(self):
+        if not self.on_selection_changed:
+            return
+
+        # Passing the ranges rather than individual indexes, because the selection may span millions of rows
+        selected_row_ranges = [(r.top(), r.bottom()) for r in self._table.selectionModel().selection()]
+        self.on_selection_changed(selected_row_ranges)
+
+    def _redraw(self):
+        self.pre_redraw_hook()
+
+        if self.started and not self.paused:
+            if self._model.sync() > 0 and not self.read_only:
+                self._table.scrollToBottom()
+
+        self._row_count.setText(str(self._model.rowCount()))
+
+    def _on_start_button_clicked(self):
+        self._pause.setChecked(False)
+
+    def add_records(self, records):
+        if self.started:
+            self._store.extend(records)
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def read_only(self):
+        return self._start_button.isHidden()
+
+    @property
+    def paused(self):
+        return self._pause.isChecked()
+
+    @property
+    def started(self):
+        return self._start_button.isChecked()
+
+    @property
+    def custom_area_layout(self):
+        return self._custom_area_layout
@@ -0,0 +1,267 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Streaming of captured CAN frames to disk.
+The GUI thread only enqueues batches of FRAME_RECORD_DTYPE records; formatting and disk I/O are done by a dedicated
+writer thread, so a slow disk can never stall the UI. If the writer cannot keep up, whole batches are dropped and
+counted rather than buffered without bound.
+"""
+
+import os
+import time
+import queue
+import struct
+import logging
+import threading
+import numpy
+from .frame_store import FRAME_RECORD_DTYPE, FLAG_EXTENDED
+
+
+logger = logging.getLogger(__name__)
+
+
+class BinaryLogFormat:
+    """
+    Native format: a 16-byte header followed by raw FRAME_RECORD_DTYPE records, 32 bytes per frame.
+    Unlike the other formats, it preserves both timestamps and the direction of every frame.
+    """
+    name = 'Binary log'
+    extension = '.canlog'
+
+    MAGIC = b'UAVCANBM'
+    VERSION = 1
+    HEADER = struct.Struct('<8sHH4x')
+
+    @classmethod
+    def make_header(cls, iface_name):
+        return cls.HEADER.pack(cls.MAGIC, cls.VERSION, FRAME_RECORD_DTYPE.itemsize)
+
+    @staticmethod
+    def format(records, iface_name):
+        return records.tobytes()
+
+
+class CandumpFormat:
+    """Text log compatible with 'candump -l' and 'canplayer'. Directions are not preserved."""
+    name = 'candump log'
+    extension = '.log'
+
+    @staticmethod
+    def make_header(iface_name):
+        return b''
+
+    @staticmethod
+    def format(records, iface_name):
+        iface_name = os.path.basename(iface_name) or 'can0'
+        lines = []
+        for ts, can_id, flags, dlc, data in zip(records['ts_real'].tolist(), records['can_id'].tolist(),
+                                                records['flags'].tolist(), records['dlc'].tolist(),
+                                                records['data'].tolist()):
+            lines.append('(%.6f) %s %0*X#%s\n' % (ts, iface_name, 8 if flags & FLAG_EXTENDED else 3, can_id,
+                                                  ''.join(['%02X' % x for x in data[:dlc]])))
+        return ''.join(lines).encode('ascii')
+
+
+class PcapFormat:
+    """Classic pcap with LINKTYPE_CAN_SOCKETCAN, readable by Wireshark and tcpdump. Directions are not preserved."""
+    name = 'pcap'
+    extension = '.pcap'
+
+    LINKTYPE_CAN_SOCKETCAN = 227
+    CAN_EFF_FLAG = 0x80000000
+    HEADER = struct.Struct('<IHHiIII')
+
+    # Per-packet header followed by struct can_frame; the CAN ID is in network byte order
+    PACKET_DTYPE = numpy.dtype([
+        ('ts_sec', '<u4'),
+        ('ts_usec', '<u4'),
+        ('incl_len', '<u4'),
+        ('orig_len', '<u4'),
+        ('can_id', '>u4'),
+        ('dlc', 'u1'),
+        ('reserved', 'u1', (3,)),
+        ('data', 'u1', (8,)),
+    ])
+    CAN_FRAME_SIZE = 16
+
+    @classmethod
+    def make_header(cls, iface_name):
+        return cls.HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, cls.CAN_FRAME_SIZE, cls.LINKTYPE_CAN_SOCKETCAN)
+
+    @classmethod
+    def format(cls, records, iface_name):
+        packets = numpy.zeros(len(records), dtype=cls.PACKET_DTYPE)
+        ts_usec = numpy.round(records['ts_real'] * 1e6).astype(numpy.int64)
+        packets['ts_sec'] = ts_usec // 1000000
+        packets['ts_usec'] = ts_usec % 1000000
+        packets['incl_len'] = cls.CAN_FRAME_SIZE
+        packets['orig_len'] = cls.CAN_FRAME_SIZE
+        extended = (records['flags'] & FLAG_EXTENDED) != 0
+        packets['can_id'] = records['can_id'] | numpy.where(extended, cls.CAN_EFF_FLAG, 0).astype(numpy.uint32)
+        packets['dlc'] = records['dlc']
+        packets['data'] = records['data']
+        return packets.tobytes()
+
+
+FORMATS = [BinaryLogFormat, CandumpFormat, PcapFormat]
+
+
+class FrameRecorder:
+    """
+    Writes frames to a file, or to a sequence of files if rotation is enabled.
+    With rotation, the files are named <name>-0001<ext>, <name>-0002<ext>, etc., and a new file is started once the
+    current one exceeds max_file_size bytes or max_file_duration seconds (zero means no limit).
+    """
+    MAX_PENDING_BATCHES = 1000
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, file_format, iface_name='', max_file_size=0, max_file_duration=0):
+        self._path = path
+        self._format = file_format
+        self._iface_name = iface_name
+        self._max_file_size = int(max_file_size or 0)
+        self._max_file_duration = float(max_file_duration or 0)
+
+        self._queue = queue.Queue(self.MAX_PENDING_BATCHES)
+        self._stop_event = threading.Event()
+
+        self._file = None
+        self._file_index = 0
+        self._file_size = 0
+        self._file_opened_at = 0
+        self._current_path = None
+
+        self._num_frames_written = 0
+        self._num_bytes_written = 0
+        self._num_frames_dropped = 0
+        self._error = None
+
+        self._open_next_file()      # Failing early, so that the error can be reported to the user immediately
+
+        self._thread = threading.Thread(target=self._run, name='bus_monitor_recorder')
+        self._thread.start()
+
+    def _make_path(self):
+        if not (self._max_file_size or self._max_file_duration):
+            return self._path
+        base, ext = os.path.splitext(self._path)
+        return '%s-%04d%s' % (base, self._file_index, ext)
+
+    def _open_next_file(self):
+        if self._file is not None:
+            self._file.close()
+
+        self._file_index += 1
+        self._current_path = self._make_path()
+        self._file = open(self._current_path, 'wb', buffering=self.WRITE_BUFFER_SIZE)
+        self._file_opened_at = time.monotonic()
+
+        header = self._format.make_header(self._iface_name)
+        self._file.write(header)
+        self._file_size = len(header)
+        self._num_bytes_written += len(header)
+        logger.info('Recording CAN frames to %r', self._current_path)
+
+    def _needs_rotation(self):
+        if self._max_file_size and self._file_size >= self._max_file_size:
+            return True
+        if self._max_file_duration and time.monotonic() - self._file_opened_at >= self._max_file_duration:
+            return True
+        return False
+
+    def _write(self, records):
+        if self._needs_rotation():
+            self._open_next_file()
+
+        blob = self._format.format(records, self._iface_name)
+        self._file.write(blob)
+        self._file_size += len(blob)
+        self._num_bytes_written += len(blob)
+        self._num_frames_written += len(records)
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    if self._stop_event.is_set():
+                        records = self._queue.get_nowait()
+                    else:
+                        records = self._queue.get(timeout=self.FLUSH_INTERVAL)
+                except queue.Empty:
+                    if self._stop_event.is_set():
+                        break
+                    self._file.flush()      # Keeping the file reasonably up to date while the bus is quiet
+                    if self._needs_rotation():
+                        self._open_next_file()
+                    continue
+
+                if records is not None:     # None only wakes the thread up, see close()
+                    self._write(records)
+        except Exception as ex:
+            logger.error('Recording failed', exc_info=True)
+            self._error = ex
+        finally:
+            try:
+                self._file.close()
+            except Exception:
+                logger.error('Could not close the recording', exc_info=True)
+            logger.info('Recording stopped; %d frames written, %d dropped',
+                        self._num_frames_written, self._num_frames_dropped)
+
+    def write(self, records):
+        """Never blocks. Returns False if the batch was dropped because the writer is falling behind."""
+        if self._stop_event.is_set() or self._error is not None:
+            return False
+        try:
+            self._queue.put_nowait(records)
+            return True
+        except queue.Full:
+            self._num_frames_dropped += len(records)
+            return False
+
+    def close(self):
+        """
+        Never blocks. The data that is already enqueued will be written out by the writer thread in the background;
+        the thread is not a daemon, so the process will not exit before the file is complete. See join().
+        """
+        self._stop_event.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass                            # The writer is busy anyway
+
+    def join(self, timeout=None):
+        """Waits for the writer thread to finish after close(); returns True if it has finished"""
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    @property
+    def active(self):
+        return self._thread.is_alive()
+
+    @property
+    def current_path(self):
+        return self._current_path
+
+    @property
+    def frames_written(self):
+        return self._num_frames_written
+
+    @property
+    def bytes_written(self):
+        return self._num_bytes_written
+
+    @property
+    def frames_dropped(self):
+        return self._num_frames_dropped
+
+    @property
+    def error(self):
+        return self._error
@@ -6,64 +6,131 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import numpy
 import uavcan
 from uavcan.transport import Transfer, Frame
 
-# How many rows will be traversed while looking for beginning/end of a multi frame transfer
-TABLE_TRAVERSING_RANGE = 2000
+
+# Index keys include these flags, so that frames of different direction or CAN ID format are never mixed
+_KEY_FLAGS_MASK = 0b11      # FLAG_EXTENDED | FLAG_TX, see frame_store
+
+_SOT_MASK = 0b10000000
+_EOT_MASK = 0b01000000
+_TRANSFER_ID_MASK = 0b00011111
 
 
 class DecodingFailedException(Exception):
     pass
 
 
-def _get_transfer_id(frame):
-    if len(frame.data):
-        return frame.data[-1] & 0b00011111
+class TransferIndex:
+    """
+    Links the frames of every transfer together as they are captured, so that a transfer can be reassembled
+    without scanning the capture.
+    For every stored frame, the index keeps the sequence number of the first frame of its transfer (SOT), and the
+    sequence number of the next frame of the same transfer; frames are matched by (CAN ID, transfer ID, direction).
+    The index is a ring of the same capacity as the frame store, so it is addressed by the same slots.
+    """
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._start = numpy.full(capacity, -1, dtype=numpy.int64)
+        self._next = numpy.full(capacity, -1, dtype=numpy.int64)
+        self._open = {}         # (CAN ID, transfer ID, flags) : (SOT sequence number, last sequence number)
+
+    def clear(self):
+        self._open.clear()
+
+    def add(self, first_seq, records):
+        """Indexes FRAME_RECORD_DTYPE records that were stored under the sequence numbers starting from first_seq"""
+        num_records = len(records)
+        seqs = first_seq + numpy.arange(num_records, dtype=numpy.int64)
+        slots = seqs % self._capacity
+
+        dlc = records['dlc'].astype(numpy.int64)
+        has_tail = dlc > 0
+        tail = records['data'][numpy.arange(num_records), numpy.maximum(dlc, 1) - 1]
+        sot = has_tail & ((tail & _SOT_MASK) != 0)
+        eot = has_tail & ((tail & _EOT_MASK) != 0)
+
+        # Single-frame transfers, which make up most of the traffic, are indexed here without touching Python objects
+        self._start[slots] = numpy.where(sot, seqs, -1)
+        self._next[slots] = -1
+
+        # Frames of multi-frame transfers have to be linked one by one in the order of arrival
+        multi_frame = numpy.nonzero(has_tail & ~(sot & eot))[0]
+        if not len(multi_frame):
+            return
+
+        keys = zip(records['can_id'][multi_frame].tolist(),
+                   (tail[multi_frame] & _TRANSFER_ID_MASK).tolist(),
+                   (records['flags'][multi_frame] & _KEY_FLAGS_MASK).tolist())
+
+        for seq, key, is_sot, is_eot in zip(seqs[multi_frame].tolist(), keys,
+                                             sot[multi_frame].tolist(), eot[multi_frame].tolist()):
+            if is_sot:
+                self._open[key] = seq, seq
+            else:
+                try:
+                    start, last = self._open[key]
+                except KeyError:
+                    continue                        # SOT was never seen; the start stays unknown
+                if seq - last >= self._capacity:
+                    # The EOT of that transfer was lost, and its frames have been overwritten since
+                    del self._open[key]
+                    continue
+                self._next[last % self._capacity] = seq
+                self._start[seq % self._capacity] = start
+                self._open[key] = start, seq
+
+            if is_eot:
+                self._open.pop(key, None)
+
+    def get_transfer_seqs(self, store, seq):
+        """Returns the list of sequence numbers of all frames of the transfer that contains the specified frame"""
+        start = int(self._start[seq % self._capacity])
+        if start < 0 or not store.contains(start):
+            raise DecodingFailedException('SOT not found')
 
+        seqs = [start]
+        while not store.is_end_of_transfer(seqs[-1]):
+            nxt = int(self._next[seqs[-1] % self._capacity])
+            if nxt < 0 or not store.contains(nxt) or int(self._start[nxt % self._capacity]) != start:
+                raise DecodingFailedException('EOT not found')
+            seqs.append(nxt)
 
-def _is_start_of_transfer(frame):
-    if len(frame.data):
-        return frame.data[-1] & 0b10000000
+        if seq not in seqs:
+            raise DecodingFailedException('Frame does not belong to the transfer')  # Evicted and overwritten
+        return seqs
 
 
-def _is_end_of_transfer(frame):
-    if len(frame.data):
-        return frame.data[-1] & 0b01000000
+class WindowedTransferIndex:
+    """
+    Replacement for TransferIndex for stores that are too large to be indexed in advance, such as log files.
+    The frames around the requested one are indexed on demand, so only transfers that fit into the window can be
+    reassembled; this is normally not a limitation, because the frames of a transfer are close to each other.
+    """
+    DEFAULT_WINDOW = 4096
 
+    def __init__(self, window=None):
+        self._window = int(window or self.DEFAULT_WINDOW)
 
-def decode_transfer_from_frame(entry_row, row_to_frame):
-    entry_frame, direction = row_to_frame(entry_row)
-    can_id = entry_frame.id
-    transfer_id = _get_transfer_id(entry_frame)
-    frames = [entry_frame]
+    def clear(self):
+        pass
 
-    related_rows = []
+    def get_transfer_seqs(self, store, seq):
+        begin = max(store.first, seq - self._window)
+        end = min(store.end, seq + self._window)
+        index = TransferIndex(max(end - begin, 1))
+        index.add(begin, store.get_records(begin, end))
+        return index.get_transfer_seqs(store, seq)
 
-    # Scanning backward looking for the first frame
-    row = entry_row - 1
-    while not _is_start_of_transfer(frames[0]):
-        if row < 0 or entry_row - row > TABLE_TRAVERSING_RANGE:
-            raise DecodingFailedException('SOT not found')
-        f, d = row_to_frame(row)
-        row -= 1
-        if f.id == can_id and _get_transfer_id(f) == transfer_id and d == direction:
-            frames.insert(0, f)
-            related_rows.insert(0, row)
-
-    # Scanning forward looking for the last frame
-    row = entry_row + 1
-    while not _is_end_of_transfer(frames[-1]):
-        f, d = row_to_frame(row)
-        if f is None or row - entry_row > TABLE_TRAVERSING_RANGE:
-            raise DecodingFailedException('EOT not found')
-        row += 1
-        if f.id == can_id and _get_transfer_id(f) == transfer_id and d == direction:
-            frames.append(f)
-            related_rows.append(row)
+
+def decode_transfer_from_frame(store, seq):
+    seqs = store.transfers.get_transfer_seqs(store, seq)
+    frames = [store.get(x)[1] for x in seqs]
 
     # The transfer is now fully recovered
     tr = Transfer()
     tr.from_frames([Frame(x.id, x.data) for x in frames])
 
-    return related_rows, uavcan.to_yaml(tr.payload)
+    return seqs, uavcan.to_yaml(tr.payload)
@@ -0,0 +1,260 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Transports that deliver captured CAN frames from the main process to a bus monitor process.
+Frames are packed into fixed-size binary records (see FRAME_RECORD_DTYPE), so nothing is pickled per frame, and the
+consumer receives all pending frames at once as a NumPy record array.
+Both transports are single-producer single-consumer; each bus monitor process gets its own instance.
+Transports are created in the main process and passed to the bus monitor process in the command that starts the
+tool, where attach() is invoked before frames are received.
+"""
+
+import struct
+import logging
+import threading
+import numpy
+from .frame_store import FRAME_RECORD_DTYPE, FLAG_EXTENDED, FLAG_TX
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:         # Python older than 3.8
+    shared_memory = None
+
+
+logger = logging.getLogger(__name__)
+
+_RECORD = struct.Struct('<ddIBB8s2x')
+assert _RECORD.size == FRAME_RECORD_DTYPE.itemsize
+
+_COUNTER = struct.Struct('<Q')
+
+
+def _pack_frame(direction, frame):
+    flags = (FLAG_EXTENDED if frame.extended else 0) | (FLAG_TX if direction == 'tx' else 0)
+    return frame.ts_monotonic, frame.ts_real, frame.id, flags, len(frame.data), bytes(frame.data)
+
+
+def _make_empty_records():
+    return numpy.zeros(0, dtype=FRAME_RECORD_DTYPE)
+
+
+class SharedFrameRing:
+    """
+    Lock-free ring of frame records in shared memory.
+    The header contains the write counter (owned by the producer), the read counter (owned by the consumer), and
+    the number of frames dropped by the producer because the ring was full. The counters are placed in different
+    cache lines, and each of them is only ever written by one side, so no locking is needed.
+    """
+    DEFAULT_CAPACITY = 65536
+
+    _WRITE_OFFSET = 0
+    _DROPPED_OFFSET = 8
+    _READ_OFFSET = 64
+    _HEADER_SIZE = 128
+
+    def __init__(self, capacity=None):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory is not supported by this version of Python')
+
+        self._capacity = int(capacity or self.DEFAULT_CAPACITY)
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=self._HEADER_SIZE + self._capacity * _RECORD.size)
+        self._owner = True
+        self._shm.buf[:self._HEADER_SIZE] = bytes(self._HEADER_SIZE)
+        self._write = 0
+        self._read = 0
+        self._dropped = 0
+        self._host = None
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'capacity': self._capacity}
+
+    def __setstate__(self, state):
+        self._capacity = state['capacity']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False             # The segment will be unlinked by the producer
+        self._write = self._load(self._WRITE_OFFSET)
+        self._read = self._load(self._READ_OFFSET)
+        self._dropped = self._load(self._DROPPED_OFFSET)
+        self._host = None
+
+    def attach(self, host):
+        self._host = host   # Frames do not go through the host, it is only notified of them
+
+    def _load(self, offset):
+        # Re-reading until two successive reads agree protects against torn reads of a counter being updated
+        value = _COUNTER.unpack_from(self._shm.buf, offset)[0]
+        while True:
+            again = _COUNTER.unpack_from(self._shm.buf, offset)[0]
+            if again == value:
+                return value
+            value = again
+
+    def _store(self, offset, value):
+        _COUNTER.pack_into(self._shm.buf, offset, value)
+
+    def push(self, direction, frame):
+        """Producer side. Returns False if the frame was dropped because the consumer is falling behind."""
+        if self._write - self._load(self._READ_OFFSET) >= self._capacity:
+            self._dropped += 1
+            self._store(self._DROPPED_OFFSET, self._dropped)
+            return False
+
+        offset = self._HEADER_SIZE + (self._write % self._capacity) * _RECORD.size
+        _RECORD.pack_into(self._shm.buf, offset, *_pack_frame(direction, frame))
+
+        # The record must be complete before the counter is updated, otherwise the consumer may read garbage
+        self._write += 1
+        self._store(self._WRITE_OFFSET, self._write)
+        return True
+
+    def flush(self):
+        pass                # Every frame is visible to the consumer as soon as it is pushed
+
+    def receive(self):
+        """Consumer side. Returns all pending frames as an array of FRAME_RECORD_DTYPE records."""
+        write = self._load(self._WRITE_OFFSET)
+        num_records = write - self._read
+        if num_records <= 0:
+            return _make_empty_records()
+
+        begin = self._read % self._capacity
+        head = min(num_records, self._capacity - begin)
+        chunks = [numpy.frombuffer(self._shm.buf, dtype=FRAME_RECORD_DTYPE, count=head,
+                                   offset=self._HEADER_SIZE + begin * _RECORD.size)]
+        if head < num_records:
+            chunks.append(numpy.frombuffer(self._shm.buf, dtype=FRAME_RECORD_DTYPE, count=num_records - head,
+                                           offset=self._HEADER_SIZE))
+        records = numpy.concatenate(chunks)         # Copying out before the producer is allowed to overwrite
+
+        self._read = write
+        self._store(self._READ_OFFSET, self._read)
+        if self._host is not None:
+            self._host.report_data_received()
+        return records
+
+    @property
+    def dropped(self):
+        """Total number of frames that could not be delivered because the consumer was falling behind"""
+        return self._load(self._DROPPED_OFFSET) if not self._owner else self._dropped
+
+    def close(self):
+        try:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+        except Exception:
+            logger.debug('Could not release shared memory', exc_info=True)
+
+
+class BatchedFrameQueue:
+    """
+    Fallback for platforms where shared memory is not available.
+    Frames are packed into a bytes object that is sent through the channel of the tool process once per flush,
+    so the cost of pickling and locking is paid once per batch rather than once per frame.
+    The channel itself is not bounded, so the consumer acknowledges the batches it has received through the feedback
+    queue of the channel; once MAX_OUTSTANDING_BATCHES batches are not acknowledged, or MAX_PENDING_FRAMES frames
+    are waiting for the next flush, new frames are dropped and counted. The total number of dropped frames is sent
+    to the consumer along with every batch.
+    Pushing and flushing may be done from different threads.
+    """
+    MAX_BATCHES_PER_RECEIVE = 1000
+    MAX_OUTSTANDING_BATCHES = 500
+    MAX_PENDING_FRAMES = 65536
+
+    _ACK = 'frame_batches_received'         # Consumer to producer: (ack, number of batches)
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.__setstate__({})
+
+    def __getstate__(self):
+        return {}           # The consumer receives the batches from its host
+
+    def __setstate__(self, state):
+        self._host = None
+        self._lock = threading.Lock()
+        self._pending = bytearray()
+        self._num_pending = 0
+        self._num_batches_sent = 0
+        self._num_batches_acknowledged = 0
+        self._dropped = 0
+        self._dropped_reported = 0
+
+    def attach(self, host):
+        self._host = host
+
+    def push(self, direction, frame):
+        """Producer side. Returns False if the frame was dropped because the consumer is falling behind."""
+        record = _RECORD.pack(*_pack_frame(direction, frame))
+        with self._lock:
+            if self._num_pending >= self.MAX_PENDING_FRAMES:
+                self._dropped += 1
+                return False
+            self._pending += record
+            self._num_pending += 1
+        return True
+
+    def _process_acknowledgements(self):
+        while True:
+            received, obj = self._channel.receive_feedback_nonblocking()
+            if not received:
+                break
+            if isinstance(obj, tuple) and obj and obj[0] == self._ACK:
+                self._num_batches_acknowledged += obj[1]
+
+    def flush(self):
+        self._process_acknowledgements()
+        backlogged = self._num_batches_sent - self._num_batches_acknowledged >= self.MAX_OUTSTANDING_BATCHES
+
+        with self._lock:
+            pending, num_pending = self._pending, self._num_pending
+            self._pending = bytearray()
+            self._num_pending = 0
+            if backlogged:
+                self._dropped += num_pending
+            dropped = self._dropped
+
+        if backlogged or not (num_pending or dropped != self._dropped_reported):
+            return
+
+        self._channel.send_nonblocking((dropped, bytes(pending)))
+        self._num_batches_sent += 1
+        self._dropped_reported = dropped
+
+    def receive(self):
+        """Consumer side. Returns all pending frames as an array of FRAME_RECORD_DTYPE records."""
+        blobs = []
+        while len(blobs) < self.MAX_BATCHES_PER_RECEIVE:
+            batch = self._host.receive()
+            if batch is None:
+                break
+            self._dropped, blob = batch
+            blobs.append(blob)
+
+        if not blobs:
+            return _make_empty_records()
+        self._host.send((self._ACK, len(blobs)))
+        return numpy.frombuffer(b''.join(blobs), dtype=FRAME_RECORD_DTYPE)
+
+    @property
+    def dropped(self):
+        """Total number of frames that could not be delivered because the consumer was falling behind"""
+        return self._dropped
+
+    def close(self):
+        pass
+
+
+def make_frame_transport(channel):
+    try:
+        return SharedFrameRing()
+    except Exception:
+        logger.warning('Shared memory frame transport is not available, falling back to the queue', exc_info=True)
+        return BatchedFrameQueue(channel)
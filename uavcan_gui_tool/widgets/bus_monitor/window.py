@@ -9,26 +9,30 @@
 import datetime
 import time
 import os
-from functools import partial
+import numpy
 import uavcan
-from uavcan.driver import CANFrame
+from collections import OrderedDict
 from PyQt5.QtWidgets import QMainWindow, QHeaderView, QLabel, QSplitter, QSizePolicy, QWidget, QHBoxLayout, \
-    QPlainTextEdit, QDialog, QVBoxLayout, QMenu, QAction
-from PyQt5.QtGui import QColor, QIcon, QTextOption
+    QPlainTextEdit, QDialog, QVBoxLayout, QMenu, QAction, QLineEdit, QPushButton, QComboBox, QSpinBox, QFileDialog, \
+    QGridLayout
+from PyQt5.QtGui import QColor, QTextOption
 from PyQt5.QtCore import Qt, QTimer
 from ...thirdparty.pyqtgraph import PlotWidget, mkPen
 from logging import getLogger
-from .. import BasicTable, map_7bit_to_color, RealtimeLogWidget, get_monospace_font, get_icon, flash, get_app_icon, \
-    show_error
+from .. import BasicTable, map_7bit_to_color, get_monospace_font, get_icon, flash, get_app_icon, show_error, \
+    make_icon_button
 from .transfer_decoder import decode_transfer_from_frame
+from .frame_table import FrameLogWidget
+from .frame_store import FLAG_TX
+from .recorder import FrameRecorder, BinaryLogFormat, FORMATS as RECORDING_FORMATS
+from .frame_log import FrameLogFile
 
 
 logger = getLogger(__name__)
 
 
-def parse_can_frame(frame):
-    if frame.extended:
-        can_id = frame.id
+def parse_can_id(can_id, extended):
+    if extended:
         source_node_id = can_id & 0x7F
 
         service_not_message = bool((can_id >> 7) & 1)
@@ -62,33 +66,91 @@ def parse_can_frame(frame):
     }
 
 
+def parse_can_frame(frame):
+    return parse_can_id(frame.id, frame.extended)
+
+
+class CANIDDescriptor:
+    """
+    Everything the renderers need to know about a CAN ID, parsed once.
+    The colors are shared between all frames with the same CAN ID, so they must not be modified.
+    """
+    __slots__ = ('src', 'dst', 'data_type', 'service_not_message', 'src_color', 'dst_color', 'data_type_color',
+                 'priority_color')
+
+    def __init__(self, can_id, extended):
+        parsed = parse_can_id(can_id, extended)
+        self.src = parsed['src']
+        self.dst = parsed['dst']
+        self.data_type = parsed['data_type']
+        self.service_not_message = extended and bool((can_id >> 7) & 1)
+
+        self.src_color = map_7bit_to_color(self.src) if isinstance(self.src, int) else None
+        self.dst_color = map_7bit_to_color(self.dst) if isinstance(self.dst, int) else None
+        self.data_type_color = map_7bit_to_color(sum(self.data_type.encode('ascii')) & 0xF7)
+
+        if extended:
+            mask = 0b11111
+            priority = (can_id >> 24) & mask
+            self.priority_color = QColor()
+            self.priority_color.setRgb(0xFF, 0xFF - (mask - priority) * 6, 0xFF)
+        else:
+            self.priority_color = None
+
+
+class CANIDDescriptorCache:
+    """
+    Bounded LRU cache of CAN ID descriptors.
+    Real buses carry a limited set of CAN IDs, so nearly every lookup is a hit; the bound only protects against
+    pathological traffic, such as a flood of random IDs.
+    """
+    DEFAULT_SIZE = 8192
+
+    def __init__(self, size=None):
+        self._size = int(size or self.DEFAULT_SIZE)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, frame):
+        key = frame.id, frame.extended
+        try:
+            desc = self._entries[key]
+        except KeyError:
+            desc = CANIDDescriptor(*key)
+            self._entries[key] = desc
+            if len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return desc
+
+
+# Shared by all column renderers, so that every CAN ID is parsed only once
+can_id_descriptors = CANIDDescriptorCache()
+
+
 def render_node_id_with_color(frame, field):
-    nid = parse_can_frame(frame)[field]
-    return nid, (map_7bit_to_color(nid) if isinstance(nid, int) else None)
+    desc = can_id_descriptors.get(frame)
+    if field == 'src':
+        return desc.src, desc.src_color
+    return desc.dst, desc.dst_color
 
 
 def render_data_type_with_color(frame):
-    dtname = parse_can_frame(frame)['data_type']
-    color_hash = sum(dtname.encode('ascii')) & 0xF7
-    return dtname, map_7bit_to_color(color_hash)
+    desc = can_id_descriptors.get(frame)
+    return desc.data_type, desc.data_type_color
 
 
 def colorize_can_id(frame):
-    if not frame.extended:
-        return
-    mask = 0b11111
-    priority = (frame.id >> 24) & mask
-    col = QColor()
-    col.setRgb(0xFF, 0xFF - (mask - priority) * 6, 0xFF)
-    return col
+    return can_id_descriptors.get(frame).priority_color
 
 
-def colorize_transfer_id(e):
-    if len(e[1].data) < 1:
-        return
-
-    # Making a rather haphazard hash using transfer ID and a part of CAN ID
-    x = (e[1].data[-1] & 0b11111) | (((e[1].id >> 16) & 0b1111) << 5)
+def _make_transfer_id_color(x):
     red = ((x >> 6) & 0b111) * 25
     green = ((x >> 3) & 0b111) * 25
     blue = (x & 0b111) * 25
@@ -98,31 +160,34 @@ def colorize_transfer_id(e):
     return col
 
 
-class TimestampRenderer:
-    FORMAT = '%H:%M:%S.%f'
+# There are only 512 possible hash values, so all colors are created in advance
+_TRANSFER_ID_COLORS = [_make_transfer_id_color(x) for x in range(512)]
 
-    def __init__(self):
-        self._prev_ts = 0
 
-    def __call__(self, e):
-        ts = datetime.datetime.fromtimestamp(e[1].ts_real).strftime(self.FORMAT)
-        col = QColor()
+def colorize_transfer_id(e):
+    if len(e[1].data) < 1:
+        return
+
+    # Making a rather haphazard hash using transfer ID and a part of CAN ID
+    x = (e[1].data[-1] & 0b11111) | (((e[1].id >> 16) & 0b1111) << 5)
+    return _TRANSFER_ID_COLORS[x]
 
-        # Constraining delta to [0, 1]
-        delta = min(1, e[1].ts_real - self._prev_ts)
-        if delta < 0:
-            col.setRgb(255, 230, 230)
-        else:
-            self._prev_ts = e[1].ts_real
-            col.setRgb(*([255 - int(192 * delta)] * 3))
-        return ts, col
 
-    @staticmethod
-    def compute_timestamp_difference(earlier, later):
-        def s2delta(string):
-            h, m, s = [float(x) for x in string.split(':')]
-            return datetime.timedelta(hours=h, minutes=m, seconds=s)
-        return (s2delta(later) - s2delta(earlier)).total_seconds()
+def render_timestamp_with_color(e):
+    ts = datetime.datetime.fromtimestamp(e[1].ts_real).strftime('%H:%M:%S.%f')
+    col = QColor()
+
+    prev_ts = e[2]
+    if prev_ts is None:
+        prev_ts = 0
+
+    # Constraining delta to [0, 1]
+    delta = min(1, e[1].ts_real - prev_ts)
+    if delta < 0:
+        col.setRgb(255, 230, 230)
+    else:
+        col.setRgb(*([255 - int(192 * delta)] * 3))
+    return ts, col
 
 
 class TrafficStatCounter:
@@ -137,22 +202,25 @@ class TrafficStatCounter:
         self._frames_since_fps_checkpoint = 0
         self._last_fps_estimates = [0] * self.MOVING_AVERAGE_LENGTH
 
-    def add_frame(self, direction, frame):
-        if direction == 'tx':
-            self._tx += 1
-        else:
-            self._rx += 1
+    def add_records(self, records):
+        is_tx = (records['flags'] & FLAG_TX) != 0
+        num_tx = int(numpy.count_nonzero(is_tx))
+        self._tx += num_tx
+        self._rx += len(records) - num_tx
 
         # Updating FPS estimate.
         # It is extremely important that the algorithm relies only on the timestamps provided by the driver!
         # Naive timestamping produces highly unreliable estimates, because the application is not nearly real-time.
-        self._frames_since_fps_checkpoint += 1
-        if direction == 'rx':
-            dt = frame.ts_monotonic - self._prev_fps_checkpoint_mono
+        # The estimate is checkpointed at most once per batch, which is fine as long as batches are short.
+        self._frames_since_fps_checkpoint += len(records)
+        rx_ts_mono = records['ts_mono'][~is_tx]
+        if len(rx_ts_mono):
+            ts_mono = float(rx_ts_mono[-1])
+            dt = ts_mono - self._prev_fps_checkpoint_mono
             if dt >= self.FPS_ESTIMATION_WINDOW:
                 self._last_fps_estimates.pop()
                 self._last_fps_estimates.insert(0, self._frames_since_fps_checkpoint / dt)
-                self._prev_fps_checkpoint_mono = frame.ts_monotonic
+                self._prev_fps_checkpoint_mono = ts_mono
                 self._frames_since_fps_checkpoint = 0
 
     @property
@@ -171,11 +239,12 @@ class TrafficStatCounter:
         return (sum(self._last_fps_estimates) / len(self._last_fps_estimates)), self._prev_fps_checkpoint_mono
 
 
+# Renderers accept a tuple (direction, CANFrame, real timestamp of the previous frame or None), see FrameTableModel
 COLUMNS = [
     BasicTable.Column('Dir',
                       lambda e: (e[0].upper()),
                       searchable=False),
-    BasicTable.Column('Local Time', TimestampRenderer(), searchable=False),
+    BasicTable.Column('Local Time', render_timestamp_with_color, searchable=False),
     BasicTable.Column('CAN ID',
                       lambda e: (('%0*X' % (8 if e[1].extended else 3, e[1].id)).rjust(8),
                                  colorize_can_id(e[1]))),
@@ -195,75 +264,182 @@ COLUMNS = [
 ]
 
 
-def row_to_frame(table, row_index):
-    if row_index >= table.rowCount():
-        return None, None
+def run_recording_setup_dialog(parent, iface_name):
+    """Returns the keyword arguments for FrameRecorder, or None if the user has cancelled"""
+    win = QDialog(parent)
+    win.setWindowTitle('Record CAN frames to disk')
+
+    path = QLineEdit(win)
+    path.setMinimumWidth(400)
+    path.setText(os.path.join(os.path.expanduser('~'),
+                              'can_%s_%s' % (os.path.basename(iface_name) or 'bus',
+                                             datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))))
+
+    file_format = QComboBox(win)
+    file_format.setEditable(False)
+    for fmt in RECORDING_FORMATS:
+        file_format.addItem('%s (*%s)' % (fmt.name, fmt.extension))
 
-    can_id = None
-    payload = None
-    extended = None
-    direction = None
+    def on_browse():
+        fmt = RECORDING_FORMATS[file_format.currentIndex()]
+        selected = QFileDialog().getSaveFileName(win, 'Select the output file', path.text() + fmt.extension,
+                                                 file_format.currentText())[0]
+        if selected:
+            path.setText(os.path.splitext(selected)[0])
 
-    for col_index, col_spec in enumerate(COLUMNS):
-        item = table.item(row_index, col_index).text()
-        if col_spec.name == 'CAN ID':
-            extended = len(item.strip()) > 3
-            can_id = int(item, 16)
-        if col_spec.name == 'Data Hex':
-            payload = bytes([int(x, 16) for x in item.split()])
-        if col_spec.name == 'Dir':
-            direction = item.strip()
+    browse = make_icon_button('folder-open-o', 'Browse', win, on_clicked=on_browse)
 
-    assert all(map(lambda x: x is not None, [can_id, payload, extended, direction]))
-    return CANFrame(can_id, payload, extended, ts_monotonic=-1, ts_real=-1), direction
+    max_file_size = QSpinBox(win)
+    max_file_size.setRange(0, 1000000)
+    max_file_size.setSuffix(' MB')
+    max_file_size.setSpecialValueText('No limit')
+
+    max_file_duration = QSpinBox(win)
+    max_file_duration.setRange(0, 100000)
+    max_file_duration.setSuffix(' min')
+    max_file_duration.setSpecialValueText('No limit')
+
+    result = None
+
+    def on_ok():
+        nonlocal result
+        if not path.text().strip():
+            show_error('Invalid parameters', 'File name cannot be empty', 'Please select the output file', win)
+            return
+        fmt = RECORDING_FORMATS[file_format.currentIndex()]
+        result = {
+            'path': path.text().strip() + fmt.extension,
+            'file_format': fmt,
+            'iface_name': iface_name,
+            'max_file_size': max_file_size.value() * 1024 * 1024,
+            'max_file_duration': max_file_duration.value() * 60,
+        }
+        win.accept()
+
+    ok = QPushButton('Start recording', win)
+    ok.clicked.connect(on_ok)
+    cancel = QPushButton('Cancel', win)
+    cancel.clicked.connect(win.reject)
+
+    layout = QGridLayout(win)
+    layout.addWidget(QLabel('File name, without extension:', win), 0, 0)
+    layout.addWidget(path, 0, 1)
+    layout.addWidget(browse, 0, 2)
+    layout.addWidget(QLabel('Format:', win), 1, 0)
+    layout.addWidget(file_format, 1, 1, 1, 2)
+    layout.addWidget(QLabel('Start a new file every:', win), 2, 0)
+    layout.addWidget(max_file_size, 2, 1, 1, 2)
+    layout.addWidget(QLabel('Or every:', win), 3, 0)
+    layout.addWidget(max_file_duration, 3, 1, 1, 2)
+
+    buttons = QHBoxLayout()
+    buttons.addStretch(1)
+    buttons.addWidget(cancel)
+    buttons.addWidget(ok)
+    layout.addLayout(buttons, 4, 0, 1, 3)
+    win.setLayout(layout)
+
+    win.exec_()
+    return result
+
+
+def parse_time_of_day(text, reference_ts):
+    """
+    Accepts either an offset in seconds from the reference, such as '+12.5', or a local time of day, such as
+    '12:34:56.789', which is interpreted at the date of the reference. Returns a real timestamp.
+    """
+    text = text.strip()
+    if text.startswith('+'):
+        return reference_ts + float(text[1:])
+
+    parts = text.split(':')
+    if not 1 <= len(parts) <= 3:
+        raise ValueError('Invalid time: %r' % text)
+    seconds = 0
+    for p in parts:
+        seconds = seconds * 60 + float(p)
+    seconds *= 60 ** (3 - len(parts))       # '12:34' means 12:34:00
+
+    midnight = datetime.datetime.combine(datetime.datetime.fromtimestamp(reference_ts).date(), datetime.time())
+    return midnight.timestamp() + seconds
 
 
 class BusMonitorWindow(QMainWindow):
     DEFAULT_PLOT_X_RANGE = 120
     BUS_LOAD_PLOT_MAX_SAMPLES = 50000
+    RECORDING_STOP_TIMEOUT = 2.0
 
-    def __init__(self, get_frame, iface_name):
+    def __init__(self, frame_source, iface_name, capacity=None):
         super(BusMonitorWindow, self).__init__()
-        self.setWindowTitle('CAN bus monitor (%s)' % iface_name.split(os.path.sep)[-1])
         self.setWindowIcon(get_app_icon())
+        self._iface_name = iface_name
+
+        # Log files are browsed in place rather than received frame by frame
+        self._log_file = frame_source if isinstance(frame_source, FrameLogFile) else None
+        if self._log_file is None:
+            self.setWindowTitle('CAN bus monitor (%s)' % iface_name.split(os.path.sep)[-1])
+        else:
+            self.setWindowTitle('CAN log (%s)' % os.path.basename(self._log_file.path))
+        self._log_windows = []
 
-        # get dsdl_directory from parent process, if set
-        dsdl_directory = os.environ.get('UAVCAN_CUSTOM_DSDL_PATH',None)
-        if dsdl_directory:
-            uavcan.load_dsdl(dsdl_directory)
+        # Custom DSDL has been loaded by the tool host, see tool_host.py
 
-        self._get_frame = get_frame
+        # Must provide receive(), which returns an array of FRAME_RECORD_DTYPE records, and the property dropped
+        self._frame_source = frame_source
+        self._num_dropped_frames = 0
 
-        self._log_widget = RealtimeLogWidget(self, columns=COLUMNS, font=get_monospace_font(),
-                                             pre_redraw_hook=self._redraw_hook)
+        self._log_widget = FrameLogWidget(self, columns=COLUMNS, capacity=capacity, font=get_monospace_font(),
+                                          pre_redraw_hook=self._redraw_hook,
+                                          store=self._log_file.store if self._log_file else None)
         self._log_widget.on_selection_changed = self._update_measurement_display
 
-        self._log_widget.table.cellClicked.connect(lambda row, col: self._decode_transfer_at_row(row))
+        self._log_widget.table.clicked.connect(lambda index: self._decode_transfer_at_row(index.row()))
 
         self._log_widget.table.setContextMenuPolicy(Qt.CustomContextMenu)
         self._log_widget.table.customContextMenuRequested.connect(self._context_menu_requested)
 
-        self._stat_display = QLabel('0 / 0 / 0', self)
-        stat_display_label = QLabel('TX / RX / FPS: ', self)
+        self._stat_display = QLabel('0 / 0 / 0 / 0', self)
+        stat_display_label = QLabel('TX / RX / FPS / Lost: ', self)
         stat_display_label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
         self._log_widget.custom_area_layout.addWidget(stat_display_label)
         self._log_widget.custom_area_layout.addWidget(self._stat_display)
 
-        def flip_row_mark(row, col):
-            if col == 0:
-                item = self._log_widget.table.item(row, col)
-                if item.icon().isNull():
-                    item.setIcon(get_icon('circle'))
-                    flash(self, 'Row %d was marked, click again to unmark', row, duration=3)
-                else:
-                    item.setIcon(QIcon())
+        # Recording works regardless of whether the capture into the table is started
+        self._recorder = None
+        self._record_button = make_icon_button('circle', 'Record all frames to disk', self, checkable=True,
+                                               on_clicked=self._on_record_button_clicked)
+        self._record_status = QLabel(self)
+        self._open_log_button = make_icon_button('folder-open-o', 'Open a recorded CAN log', self,
+                                                 on_clicked=self._open_log)
+        self._log_widget.custom_area_layout.addWidget(self._record_button)
+        self._log_widget.custom_area_layout.addWidget(self._record_status)
+        self._log_widget.custom_area_layout.addWidget(self._open_log_button)
+
+        self._go_to_time = QLineEdit(self)
+        self._go_to_time.setPlaceholderText('Go to time')
+        self._go_to_time.setToolTip('Local time of day, e.g. 12:34:56.789, or seconds since the first frame, e.g. +60')
+        self._go_to_time.setMaximumWidth(150)
+        self._go_to_time.returnPressed.connect(self._on_go_to_time)
+        self._log_widget.custom_area_layout.addWidget(self._go_to_time)
+
+        if self._log_file is None:
+            self._go_to_time.hide()
+        else:
+            self._record_button.hide()
+            stat_display_label.setText('Frames / Duration / FPS: ')
+
+        def flip_row_mark(index):
+            if index.column() == 0:
+                if self._log_widget.model.toggle_mark(index.row()):
+                    flash(self, 'Row %d was marked, click again to unmark', index.row(), duration=3)
 
-        self._log_widget.table.cellPressed.connect(flip_row_mark)
+        self._log_widget.table.pressed.connect(flip_row_mark)
 
         self._stat_update_timer = QTimer(self)
         self._stat_update_timer.setSingleShot(False)
         self._stat_update_timer.timeout.connect(self._update_stat)
-        self._stat_update_timer.start(500)
+        if self._log_file is None:
+            self._stat_update_timer.start(500)
 
         self._traffic_stat = TrafficStatCounter()
 
@@ -307,6 +483,9 @@ class BusMonitorWindow(QMainWindow):
         self.setMinimumWidth(700)
         self.resize(800, 600)
 
+        if self._log_file is not None:
+            self._show_log_file_stat()
+
         # Calling directly from the constructor gets you wrong size information
         # noinspection PyCallByClass,PyTypeChecker
         QTimer.singleShot(500, self._update_widget_sizes)
@@ -319,7 +498,106 @@ class BusMonitorWindow(QMainWindow):
         super(BusMonitorWindow, self).resizeEvent(qresizeevent)
         self._update_widget_sizes()
 
+    def closeEvent(self, qcloseevent):
+        self.stop_recording()
+        super(BusMonitorWindow, self).closeEvent(qcloseevent)
+
+    def _on_record_button_clicked(self, checked):
+        if not checked:
+            self.stop_recording()
+            return
+
+        kwargs = run_recording_setup_dialog(self, self._iface_name)
+        if kwargs is None:
+            self._record_button.setChecked(False)
+            return
+
+        try:
+            self._recorder = FrameRecorder(**kwargs)
+        except Exception as ex:
+            self._record_button.setChecked(False)
+            show_error('Recording error', 'Could not start recording', ex, self)
+            return
+
+        self._update_record_status()
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            if self._recorder.join(self.RECORDING_STOP_TIMEOUT):
+                flash(self, 'Recording stopped; %d frames written to %s',
+                      self._recorder.frames_written, self._recorder.current_path)
+            else:
+                flash(self, 'Recording is stopping; %d frames written to %s so far',
+                      self._recorder.frames_written, self._recorder.current_path)
+            self._recorder = None
+        self._record_button.setChecked(False)
+        self._record_status.setText('')
+
+    def _update_record_status(self):
+        if self._recorder is None:
+            return
+
+        if self._recorder.error is not None:
+            error = self._recorder.error
+            self.stop_recording()
+            show_error('Recording error', 'Recording has been stopped because of an error', error, self)
+            return
+
+        self._record_status.setText('%s, %.1f MB, %d lost' % (os.path.basename(self._recorder.current_path),
+                                                              self._recorder.bytes_written / 1024 / 1024,
+                                                              self._recorder.frames_dropped))
+
+    def _open_log(self):
+        path = QFileDialog().getOpenFileName(self, 'Open CAN log', '',
+                                             '%s (*%s)' % (BinaryLogFormat.name, BinaryLogFormat.extension))[0]
+        if not path:
+            return
+        try:
+            win = BusMonitorWindow(FrameLogFile(path), self._iface_name)
+        except Exception as ex:
+            show_error('CAN log error', 'Could not open the CAN log', ex, self)
+            return
+        self._log_windows.append(win)
+        win.show()
+
+    def _show_log_file_stat(self):
+        store = self._log_file.store
+        if len(store):
+            duration = store.get_ts_real(store.end - 1) - store.get_ts_real(store.first)
+        else:
+            duration = 0
+        self._stat_display.setText('%d / %s / %d' % (len(store), datetime.timedelta(seconds=int(duration)),
+                                                     len(store) / duration if duration > 0 else 0))
+
+        ts_mono, fps = self._log_file.time_index.get_frame_rate()
+        if len(ts_mono):
+            self._bus_load_plot.setData(ts_mono - ts_mono[0], fps)
+            self._load_plot.setRange(xRange=(0, ts_mono[-1] - ts_mono[0]), padding=0)
+
+    def _on_go_to_time(self):
+        store = self._log_file.store
+        if not len(store):
+            return
+        try:
+            ts = parse_time_of_day(self._go_to_time.text(), store.get_ts_real(store.first))
+        except ValueError as ex:
+            flash(self, 'Invalid time: %s', ex, duration=3)
+            return
+
+        row = self._log_widget.model.find_row(self._log_file.time_index.find(ts))
+        if row is None:
+            flash(self, 'No frames after %s', datetime.datetime.fromtimestamp(ts), duration=3)
+            return
+
+        table = self._log_widget.table
+        table.clearSelection()
+        table.selectRow(row)
+        table.scrollTo(self._log_widget.model.index(row, 0), table.PositionAtCenter)
+
     def _update_stat(self):
+        self._update_record_status()
+
         bus_load, ts_mono = self._traffic_stat.get_frames_per_second()
 
         if len(self._bus_load_samples[0]) >= self.BUS_LOAD_PLOT_MAX_SAMPLES:
@@ -338,41 +616,49 @@ class BusMonitorWindow(QMainWindow):
         self._load_plot.setRange(xRange=(xmin, xmax), padding=0)
 
     def _redraw_hook(self):
-        while True:
-            item = self._get_frame()
-            if item is None:
-                break
-            direction, frame = item
-            self._traffic_stat.add_frame(direction, frame)
-            # There is no need to maintain a second queue actually; should be refactored
-            self._log_widget.add_item_async((direction, frame))
+        records = self._frame_source.receive()
+        if len(records):
+            if self._recorder is not None:
+                self._recorder.write(records)
+            self._traffic_stat.add_records(records)
+            self._log_widget.add_records(records)
+
+        if self._log_file is not None:
+            return          # The statistics of the log file are displayed once, see _show_log_file_stat()
+
+        num_dropped_frames = self._frame_source.dropped
+        if num_dropped_frames != self._num_dropped_frames:
+            logger.warning('%d frames were lost because the bus monitor could not keep up',
+                           num_dropped_frames - self._num_dropped_frames)
+            self._num_dropped_frames = num_dropped_frames
 
         bus_load, _ = self._traffic_stat.get_frames_per_second()
-        self._stat_display.setText('%d / %d / %d' % (self._traffic_stat.tx, self._traffic_stat.rx, bus_load))
+        self._stat_display.setText('%d / %d / %d / %d' % (self._traffic_stat.tx, self._traffic_stat.rx, bus_load,
+                                                          self._num_dropped_frames))
 
     def _decode_transfer_at_row(self, row):
         try:
-            rows, text = decode_transfer_from_frame(row, partial(row_to_frame, self._log_widget.table))
+            seq = self._log_widget.model.row_to_seq(row)
+            _, text = decode_transfer_from_frame(self._log_widget.store, seq)
         except Exception as ex:
             text = 'Transfer could not be decoded:\n' + str(ex)
-            rows = [row]
 
         self._decoded_message_box.setPlainText(text.strip())
 
-    def _update_measurement_display(self, selected_rows_cols):
-        if not selected_rows_cols:
+    def _update_measurement_display(self, selected_row_ranges):
+        if not selected_row_ranges:
             return
 
-        min_row = min([row for row, _ in selected_rows_cols])
-        max_row = max([row for row, _ in selected_rows_cols])
+        min_row = min([top for top, _ in selected_row_ranges])
+        max_row = max([bottom for _, bottom in selected_row_ranges])
 
         if min_row == max_row:
             self._decode_transfer_at_row(min_row)
 
         def get_ts_diff(row_earlier, row_later):
-            e = self._log_widget.table.item(row_earlier, 1).text()
-            l = self._log_widget.table.item(row_later, 1).text()
-            return TimestampRenderer.compute_timestamp_difference(e, l)
+            model = self._log_widget.model
+            return model.store.get_ts_real(model.row_to_seq(row_later)) - \
+                model.store.get_ts_real(model.row_to_seq(row_earlier))
 
         def get_load_str(num_frames, dt):
             if dt >= 1e-6:
@@ -402,7 +688,7 @@ class BusMonitorWindow(QMainWindow):
 
     def _show_data_type_definition(self, row):
         try:
-            data_type_name = self._log_widget.table.item(row, self._log_widget.table.columnCount() - 1).text()
+            data_type_name = self._log_widget.model.get_text(row, len(COLUMNS) - 1)
             definition = uavcan.TYPENAMES[data_type_name].source_text
         except Exception as ex:
             show_error('Data type lookup error', 'Could not load data type definition', ex, self)
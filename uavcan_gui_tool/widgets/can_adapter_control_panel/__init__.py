@@ -17,7 +17,7 @@ def spawn_window(parent, node, iface_name):
         mbox = QMessageBox(parent)
         mbox.setWindowTitle('Unsupported CAN Backend')
         mbox.setText('CAN Adapter Control Panel cannot be used with the current CAN backend.')
-        mbox.setInformativeText('The current backend is %r.' % type(driver).__name__)
+        mbox.setInformativeText('The current backend is %r.' % driver.__class__.__name__)
         mbox.setIcon(QMessageBox.Information)
         mbox.setStandardButtons(QMessageBox.Ok)
         mbox.show()     # Not exec() because we don't want it to block!
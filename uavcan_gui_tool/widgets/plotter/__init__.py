@@ -6,199 +6,201 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
-import os
-import sys
-import queue
+import time
 import uavcan
 import logging
-import multiprocessing
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import QTimer
-from .window import PlotterWindow
+from ...tool_host import DataFeed
+from .value_extractor import merge_field_names
+from .transfer_encoding import MessageTransfer, MessageBatch, RecordLayout, describe_message_type, \
+    UnsupportedLayoutException
 
 logger = logging.getLogger(__name__)
 
-try:
-    # noinspection PyUnresolvedReferences
-    sys.getwindowsversion()
-    RUNNING_ON_WINDOWS = True
-except AttributeError:
-    RUNNING_ON_WINDOWS = False
-    PARENT_PID = os.getppid()
 
+IPC_COMMAND_ANNOUNCE_DATA_TYPE = 'announce_data_type'          # Parent to child: (command, data type name)
+IPC_COMMAND_SET_WANTED_DATA_TYPES = 'set_wanted_data_types'    # Child to parent: (command, {type name: fields})
+IPC_COMMAND_DEFINE_LAYOUT = 'define_layout'     # Parent to child: (command, layout ID, type name, description)
 
-class IPCChannel:
-    """
-    This class is built as an abstraction over the underlying IPC communication channel.
-    """
-    def __init__(self):
-        # Queue is slower than pipe, but it allows to implement non-blocking sending easier,
-        # and the buffer can be arbitrarily large.
-        self._q = multiprocessing.Queue()
-
-    def send_nonblocking(self, obj):
-        try:
-            self._q.put_nowait(obj)
-        except queue.Full:
-            pass
-
-    def receive_nonblocking(self):
-        """Returns: (True, object) if successful, (False, None) if no data to read """
-        try:
-            return True, self._q.get_nowait()
-        except queue.Empty:
-            return False, None
 
-
-IPC_COMMAND_STOP = 'stop'
-
-
-def _process_entry_point(channel):
-    logger.info('Plotter process started with PID %r', os.getpid())
-    app = QApplication(sys.argv)    # Inheriting args from the parent process
-
-    def exit_if_should():
-        if RUNNING_ON_WINDOWS:
-            return False
-        else:
-            return os.getppid() != PARENT_PID       # Parent is dead
-
-    exit_check_timer = QTimer()
-    exit_check_timer.setSingleShot(False)
-    exit_check_timer.timeout.connect(exit_if_should)
-    exit_check_timer.start(2000)
+def _create_window(host, _feed_endpoint):
+    from .window import PlotterWindow        # The main process does not need it
+    layouts = {}                            # Layout ID : RecordLayout
 
     def get_transfer():
-        received, obj = channel.receive_nonblocking()
-        if received:
-            if obj == IPC_COMMAND_STOP:
-                logger.info('Plotter process has received a stop request, goodbye')
-                app.exit(0)
+        while True:
+            obj = host.receive()
+            if obj is None:
+                return
+            if isinstance(obj, MessageBatch):
+                return layouts[obj.layout_id].decode_batch(obj.data)
+            elif isinstance(obj, tuple) and obj[0] == IPC_COMMAND_ANNOUNCE_DATA_TYPE:
+                win.add_active_data_type(obj[1])
+            elif isinstance(obj, tuple) and obj[0] == IPC_COMMAND_DEFINE_LAYOUT:
+                layouts[obj[1]] = RecordLayout(obj[2], obj[3])
             else:
                 return obj
 
-    win = PlotterWindow(get_transfer)
-    win.show()
+    def set_wanted_data_types(wanted):
+        host.send((IPC_COMMAND_SET_WANTED_DATA_TYPES, dict(wanted)))
 
-    logger.info('Plotter process %r initialized successfully, now starting the event loop', os.getpid())
-    sys.exit(app.exec_())
-
-
-class CompactMessage:
+    win = PlotterWindow(get_transfer, set_wanted_data_types)
+    host.add_exit_handler(win.stop_recording)       # The window may not be closed if the process is exiting
+    win.show()
+    return win
+
+
+class _Subscriber:
+    """Plotter process as seen by the transfer feed"""
+    def __init__(self, proc):
+        self.proc = proc
+        self.wanted_data_types = {}             # Data type name : field names or None if all; others are not sent
+        self.announced_data_types = set()       # The process knows that these are present on the bus
+        self.defined_layouts = set()            # IDs of the layouts that have been sent to the process
+        self.pending_records = {}               # Layout ID : records that will be sent in the next batch
+
+    def process_feedback(self):
+        """Returns True if the set of wanted data types has been updated"""
+        updated = False
+        while True:
+            received, obj = self.proc.receive()
+            if not received:
+                return updated
+            if isinstance(obj, tuple) and obj[0] == IPC_COMMAND_SET_WANTED_DATA_TYPES:
+                logger.info('Plotter process %r wants data types %r', self.proc, obj[1])
+                self.wanted_data_types = obj[1]
+                updated = True
+
+    def send_record(self, layout_id, layout, record, max_batch_size):
+        if layout_id not in self.defined_layouts:
+            self.proc.send((IPC_COMMAND_DEFINE_LAYOUT, layout_id, layout.data_type_name, layout.description))
+            self.defined_layouts.add(layout_id)
+
+        records = self.pending_records.setdefault(layout_id, [])
+        records.append(record)
+        if len(records) >= max_batch_size:
+            self.flush()
+
+    def flush(self):
+        for layout_id, records in self.pending_records.items():
+            if records:
+                self.proc.send(MessageBatch(layout_id, b''.join(records)))
+        self.pending_records = {}
+
+
+class TransferFeed(DataFeed):
     """
-    Transfer and message objects from Pyuavcan cannot be exchanged between processes,
-    so we build this minimal representation that is just enough to mimic a Pyuavcan message object.
+    Delivers received message transfers to the attached processes, but only those of the data types the processes
+    have asked for, and only the fields their extractors refer to.
     """
-    def __init__(self, uavcan_data_type_name):
-        self._uavcan_data_type_name = uavcan_data_type_name
-        self._fields = {}
-
-    def __repr__(self):
-        return '%s(%r)' % (self._uavcan_data_type_name, self._fields)
-
-    def _add_field(self, name, value):
-        self._fields[name] = value
-
-    def __getattr__(self, item):
-        if item not in ('_fields', '_uavcan_data_type_name'):
-            try:
-                return self._fields[item]
-            except KeyError:
-                pass
-            try:
-                return getattr(uavcan.TYPENAMES[self._uavcan_data_type_name](), item)
-            except KeyError:
-                pass
-        raise AttributeError(item)
-
-
-# noinspection PyProtectedMember
-def _extract_struct_fields(m):
-    if isinstance(m, uavcan.transport.CompoundValue):
-        out = CompactMessage(uavcan.get_uavcan_data_type(m).full_name)
-        for field_name, field in uavcan.get_fields(m).items():
-            if uavcan.is_union(m) and uavcan.get_active_union_field(m) != field_name:
-                continue
-            val = _extract_struct_fields(field)
-            if val is not None:
-                out._add_field(field_name, val)
-        return out
-    elif isinstance(m, uavcan.transport.ArrayValue):
-        # cannot say I'm breaking the rules
-        container = bytes if uavcan.get_uavcan_data_type(m).is_string_like else list
-        # if I can glue them back together
-        return container(filter(lambda x: x is not None, (_extract_struct_fields(item) for item in m)))
-    elif isinstance(m, uavcan.transport.PrimitiveValue):
-        return m.value
-    elif isinstance(m, (int, float, bool)):
-        return m
-    elif isinstance(m, uavcan.transport.VoidValue):
-        pass
-    else:
-        raise ValueError(':(')
-
-
-class MessageTransfer:
-    def __init__(self, tr):
-        self.source_node_id = tr.source_node_id
-        self.ts_mono = tr.ts_monotonic
-        self.data_type_name = uavcan.get_uavcan_data_type(tr.payload).full_name
-        self.message = _extract_struct_fields(tr.payload)
-
+    FEEDBACK_POLL_INTERVAL = 0.1
+    FLUSH_INTERVAL = 0.05
+    MAX_BATCH_SIZE = 4096
 
-class PlotterManager:
     def __init__(self, node):
         self._node = node
-        self._inferiors = []    # process object, channel
+        self._subscribers = []
         self._hook_handle = None
+        self._flush_handle = None
+        self._last_feedback_poll = 0
+        self._wanted_fields = {}        # Data type name : union of the fields wanted by the processes, None if all
+        self._layouts = {}              # (data type name, field names) : (layout ID, RecordLayout or None)
+
+    def _update_wanted_fields(self):
+        wanted = {}
+        for sub in self._subscribers:
+            for data_type_name, fields in sub.wanted_data_types.items():
+                if data_type_name in wanted:
+                    fields = merge_field_names(wanted[data_type_name], fields)
+                wanted[data_type_name] = fields
+        self._wanted_fields = wanted
+
+    def _get_layout(self, data_type_name):
+        """Returns (layout ID, RecordLayout), or (None, None) if the type cannot be encoded as a fixed record"""
+        fields = self._wanted_fields.get(data_type_name)
+        key = data_type_name, (None if fields is None else frozenset(fields))
+        try:
+            return self._layouts[key]
+        except KeyError:
+            pass
+
+        try:
+            layout = RecordLayout(data_type_name, describe_message_type(data_type_name, fields))
+            entry = len(self._layouts), layout
+            logger.info('New layout %d for %s, %d bytes per record', entry[0], data_type_name, layout.record_size)
+        except UnsupportedLayoutException as ex:
+            logger.info('Transfers of %s will be pickled: %s', data_type_name, ex)
+            entry = None, None
+
+        self._layouts[key] = entry
+        return entry
+
+    def _flush(self):
+        for sub in self._subscribers:
+            try:
+                sub.flush()
+            except Exception:
+                logger.error('Failed to send data to process %r', sub.proc, exc_info=True)
 
     def _transfer_hook(self, tr):
-        if tr.direction == 'rx' and not tr.service_not_message and len(self._inferiors):
-            msg = MessageTransfer(tr)
-            for proc, channel in self._inferiors[:]:
-                if proc.is_alive():
+        if tr.direction == 'rx' and not tr.service_not_message and len(self._subscribers):
+            if time.monotonic() - self._last_feedback_poll >= self.FEEDBACK_POLL_INTERVAL:
+                self._last_feedback_poll = time.monotonic()
+                updated = False
+                for sub in self._subscribers:
                     try:
-                        channel.send_nonblocking(msg)
+                        updated = sub.process_feedback() or updated
                     except Exception:
-                        logger.error('Failed to send data to process %r', proc, exc_info=True)
-                else:
-                    logger.info('Plotter process %r appears to be dead, removing', proc)
-                    self._inferiors.remove((proc, channel))
-
-    def spawn_plotter(self):
-        channel = IPCChannel()
-
+                        logger.error('Failed to receive feedback from process %r', sub.proc, exc_info=True)
+                if updated:
+                    self._update_wanted_fields()
+
+            data_type_name = uavcan.get_uavcan_data_type(tr.payload).full_name
+            msg = None          # Encoded only if at least one process wants it
+            for sub in self._subscribers:
+                try:
+                    if data_type_name in sub.wanted_data_types:
+                        if msg is None:
+                            layout_id, layout = self._get_layout(data_type_name)
+                            if layout is not None:
+                                msg = layout.encode(tr)
+                            else:
+                                msg = MessageTransfer(tr, data_type_name, self._wanted_fields.get(data_type_name))
+
+                        if layout is not None:
+                            sub.send_record(layout_id, layout, msg, self.MAX_BATCH_SIZE)
+                        else:
+                            sub.proc.send(msg)
+                    elif data_type_name not in sub.announced_data_types:
+                        sub.proc.send((IPC_COMMAND_ANNOUNCE_DATA_TYPE, data_type_name))
+                    sub.announced_data_types.add(data_type_name)
+                except Exception:
+                    logger.error('Failed to send data to process %r', sub.proc, exc_info=True)
+
+    def attach(self, tool_process):
         if self._hook_handle is None:
             self._hook_handle = self._node.add_transfer_hook(self._transfer_hook)
+            self._flush_handle = self._node.periodic(self.FLUSH_INTERVAL, self._flush)
+        self._subscribers.append(_Subscriber(tool_process))
 
-        proc = multiprocessing.Process(target=_process_entry_point, name='plotter', args=(channel,))
-        proc.daemon = True
-        proc.start()
-
-        self._inferiors.append((proc, channel))
-
-        logger.info('Spawned new plotter process %r', proc)
+    def detach(self, tool_process):
+        self._subscribers = [x for x in self._subscribers if x.proc is not tool_process]
+        self._update_wanted_fields()
 
     def close(self):
-        try:
-            self._hook_handle.remove()
-        except Exception:
-            pass
-
-        for _, channel in self._inferiors:
+        for handle in (self._hook_handle, self._flush_handle):
             try:
-                channel.send_nonblocking(IPC_COMMAND_STOP)
+                handle.remove()
             except Exception:
                 pass
 
-        for proc, _ in self._inferiors:
-            try:
-                proc.join(1)
-            except Exception:
-                pass
 
-        for proc, _ in self._inferiors:
-            try:
-                proc.terminate()
-            except Exception:
-                pass
+class PlotterManager:
+    def __init__(self, node, tool_host_pool):
+        self._tool_host_pool = tool_host_pool
+        self._feed = TransferFeed(node)
+
+    def spawn_plotter(self):
+        self._tool_host_pool.spawn('plotter', _create_window, feed=self._feed)
+
+    def close(self):
+        self._feed.close()
@@ -6,6 +6,7 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import numpy
 from collections import OrderedDict
 from PyQt5.QtGui import QColor
 from PyQt5.QtCore import Qt
@@ -16,6 +17,17 @@ class AbstractPlotArea:
     def add_value(self, extractor, timestamp, value):
         pass
 
+    def add_values(self, extractor, timestamps, values):
+        """
+        Adds many values of the extractor at once; the timestamps are an array. The values are either a NumPy array
+        with one row per value, or a list. Plot areas can override this to add the values in bulk.
+        """
+        for timestamp, value in zip(timestamps.tolist(), values):
+            try:
+                self.add_value(extractor, timestamp, value)
+            except Exception:
+                extractor.register_error()
+
     def remove_curves_provided_by_extractor(self, extractor):
         pass
 
@@ -26,6 +38,91 @@ class AbstractPlotArea:
         pass
 
 
+class PointBuffer:
+    """
+    Fixed-capacity FIFO of (x, y) points stored in NumPy arrays.
+    The arrays are twice as large as the capacity: points are appended at the end, and once the end is reached,
+    the most recent points are moved to the beginning. Appending is therefore amortized O(1), and the stored points
+    are always available as contiguous views, which can be passed to pyqtgraph without copying.
+    """
+    def __init__(self, capacity):
+        self._capacity = 0
+        self._x = self._y = numpy.zeros(0)
+        self._begin = self._end = 0
+        self._appended = 0
+        self.set_capacity(capacity)
+
+    def __len__(self):
+        return self._end - self._begin
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def appended(self):
+        """Total number of points appended since the buffer was created or cleared, including the evicted ones"""
+        return self._appended
+
+    def set_capacity(self, capacity):
+        capacity = int(capacity)
+        if capacity == self._capacity:
+            return
+        if capacity < 1:
+            raise ValueError('Invalid capacity: %r' % capacity)
+
+        keep = min(len(self), capacity)
+        x, y = numpy.empty(capacity * 2), numpy.empty(capacity * 2)
+        x[:keep] = self._x[self._end - keep:self._end]
+        y[:keep] = self._y[self._end - keep:self._end]
+
+        self._x, self._y = x, y
+        self._begin, self._end = 0, keep
+        self._capacity = capacity
+
+    def append(self, x, y):
+        if self._end == len(self._x):
+            keep = self._capacity - 1
+            self._x[:keep] = self._x[self._end - keep:self._end]
+            self._y[:keep] = self._y[self._end - keep:self._end]
+            self._begin, self._end = 0, keep
+
+        self._x[self._end] = x
+        self._y[self._end] = y
+        self._end += 1
+        self._appended += 1
+        if self._end - self._begin > self._capacity:
+            self._begin += 1
+
+    def extend(self, x, y):
+        """Same as append() for every element of the arrays, but faster"""
+        self._appended += len(x)
+        x, y = x[-self._capacity:], y[-self._capacity:]
+
+        if self._end + len(x) > len(self._x):
+            keep = min(len(self), self._capacity - len(x))
+            self._x[:keep] = self._x[self._end - keep:self._end]
+            self._y[:keep] = self._y[self._end - keep:self._end]
+            self._begin, self._end = 0, keep
+
+        self._x[self._end:self._end + len(x)] = x
+        self._y[self._end:self._end + len(y)] = y
+        self._end += len(x)
+        self._begin = max(self._begin, self._end - self._capacity)
+
+    def clear(self):
+        self._begin = self._end = 0
+        self._appended = 0
+
+    @property
+    def x(self):
+        return self._x[self._begin:self._end]
+
+    @property
+    def y(self):
+        return self._y[self._begin:self._end]
+
+
 def add_crosshair(plot, render_measurements, color=Qt.gray):
     pen = mkPen(color=QColor(color), width=1)
     vline = InfiniteLine(angle=90, movable=False, pen=pen)
@@ -61,8 +158,10 @@ def add_crosshair(plot, render_measurements, color=Qt.gray):
 
 from .yt import PlotAreaYTWidget
 from .xy import PlotAreaXYWidget
+from .spectrum import PlotAreaSpectrumWidget
 
 PLOT_AREAS = OrderedDict([
     ('Y-T plot', PlotAreaYTWidget),
     ('X-Y plot', PlotAreaXYWidget),
+    ('Spectrum', PlotAreaSpectrumWidget),
 ])
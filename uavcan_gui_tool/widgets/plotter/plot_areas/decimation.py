@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import numpy
+
+
+class _Level:
+    """Ring of buckets of one level of the pyramid, addressed by the absolute bucket index"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.x_min = numpy.empty(capacity)
+        self.y_min = numpy.empty(capacity)
+        self.x_max = numpy.empty(capacity)
+        self.y_max = numpy.empty(capacity)
+        self.begin = 0          # First bucket that has been computed after the last gap
+        self.end = 0            # Next bucket to compute
+
+    def get_valid_range(self):
+        return max(self.begin, self.end - self.capacity), self.end
+
+    def store(self, first_bucket, x_min, y_min, x_max, y_max):
+        excess = len(x_min) - self.capacity
+        if excess > 0:
+            first_bucket += excess
+            x_min, y_min, x_max, y_max = x_min[excess:], y_min[excess:], x_max[excess:], y_max[excess:]
+
+        if first_bucket != self.end:
+            self.begin = first_bucket       # The buckets in between could not be computed
+
+        slots = (first_bucket + numpy.arange(len(x_min))) % self.capacity
+        self.x_min[slots] = x_min
+        self.y_min[slots] = y_min
+        self.x_max[slots] = x_max
+        self.y_max[slots] = y_max
+        self.end = first_bucket + len(x_min)
+
+    def get(self, begin, end):
+        slots = numpy.arange(begin, end) % self.capacity
+        return self.x_min[slots], self.y_min[slots], self.x_max[slots], self.y_max[slots]
+
+
+def _reduce(factor, x_min, y_min, x_max, y_max):
+    """Merges every factor consecutive buckets into one; the lengths of the arrays must be multiples of factor"""
+    shape = -1, factor
+    x_min, y_min, x_max, y_max = x_min.reshape(shape), y_min.reshape(shape), x_max.reshape(shape), y_max.reshape(shape)
+    rows = numpy.arange(len(x_min))
+    index_min = numpy.argmin(y_min, axis=1)
+    index_max = numpy.argmax(y_max, axis=1)
+    return x_min[rows, index_min], y_min[rows, index_min], x_max[rows, index_max], y_max[rows, index_max]
+
+
+def _interleave(x_min, y_min, x_max, y_max):
+    """Converts buckets into a polyline that visits the minimum and the maximum of every bucket in time order"""
+    min_first = x_min <= x_max
+    x = numpy.empty(len(x_min) * 2)
+    y = numpy.empty(len(x_min) * 2)
+    x[0::2] = numpy.where(min_first, x_min, x_max)
+    y[0::2] = numpy.where(min_first, y_min, y_max)
+    x[1::2] = numpy.where(min_first, x_max, x_min)
+    y[1::2] = numpy.where(min_first, y_max, y_min)
+    return x, y
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution min/max envelope of the points of a PointBuffer, used to draw long curves at the resolution of
+    the screen. Every bucket of level K covers FACTOR**K consecutive points and keeps the locations of its minimum
+    and maximum, so that the decimated curve preserves every spike that the full-resolution curve would show.
+    The levels are updated incrementally from the points appended since the previous update, in O(new points).
+    The X coordinates of the points are expected to be monotonically non-decreasing.
+    """
+    FACTOR = 4
+    MIN_BUCKETS = 256
+
+    def __init__(self, points):
+        self._points = points
+        self._levels = []
+        self._capacity = None
+
+    def _rebuild(self):
+        self._capacity = self._points.capacity
+        self._levels = []
+        bucket_size = self.FACTOR
+        while self._capacity // bucket_size >= self.MIN_BUCKETS:
+            self._levels.append(_Level(self._capacity // bucket_size + 2))
+            bucket_size *= self.FACTOR
+
+    def update(self):
+        if self._capacity != self._points.capacity:
+            self._rebuild()
+
+        total = self._points.appended
+        first = total - len(self._points)
+
+        src_begin, src_end = first, total
+        for index, level in enumerate(self._levels):
+            begin = max(level.end, -(-src_begin // self.FACTOR))
+            end = src_end // self.FACTOR
+            if end <= begin:
+                break           # Nothing new for this level, so nothing new for the upper levels either
+
+            if index == 0:
+                x = self._points.x[begin * self.FACTOR - first:end * self.FACTOR - first]
+                y = self._points.y[begin * self.FACTOR - first:end * self.FACTOR - first]
+                buckets = x, y, x, y
+            else:
+                buckets = self._levels[index - 1].get(begin * self.FACTOR, end * self.FACTOR)
+
+            level.store(begin, *_reduce(self.FACTOR, *buckets))
+            src_begin, src_end = level.get_valid_range()
+
+    def get_points(self, x_from, x_to, max_buckets):
+        """
+        Returns arrays (x, y) that represent the curve within the specified range of X using no more than
+        about 2 * max_buckets points, plus one point on either side of the range so that the curve reaches the edges.
+        """
+        self.update()
+
+        all_x, all_y = self._points.x, self._points.y
+        first = self._points.appended - len(all_x)
+
+        begin = max(int(numpy.searchsorted(all_x, x_from, side='left')) - 1, 0)
+        end = min(int(numpy.searchsorted(all_x, x_to, side='right')) + 1, len(all_x))
+        if end - begin <= 2 * max_buckets or not self._levels:
+            return all_x[begin:end], all_y[begin:end]
+
+        # Selecting the finest level that does not exceed the limit, or the coarsest one
+        level_index = len(self._levels) - 1
+        bucket_size = self.FACTOR ** len(self._levels)
+        for index in range(len(self._levels)):
+            if (end - begin) // self.FACTOR ** (index + 1) <= max_buckets:
+                level_index, bucket_size = index, self.FACTOR ** (index + 1)
+                break
+        level = self._levels[level_index]
+
+        valid_begin, valid_end = level.get_valid_range()
+        bucket_begin = min(max(-(-(first + begin) // bucket_size), valid_begin), valid_end)
+        bucket_end = max(min((first + end) // bucket_size, valid_end), bucket_begin)
+
+        # The points that are not covered by complete buckets are used as is; there are few of them
+        head_end = max(bucket_begin * bucket_size - first, begin)
+        tail_begin = max(bucket_end * bucket_size - first, head_end)
+        middle_x, middle_y = _interleave(*level.get(bucket_begin, bucket_end))
+
+        return (numpy.concatenate((all_x[begin:head_end], middle_x, all_x[tail_begin:end])),
+                numpy.concatenate((all_y[begin:head_end], middle_y, all_y[tail_begin:end])))
@@ -0,0 +1,286 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import numpy
+import logging
+import collections
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QSpinBox, QLabel
+from PyQt5.QtGui import QColor
+from PyQt5.QtCore import Qt
+from ....thirdparty.pyqtgraph import PlotWidget, mkPen
+from . import AbstractPlotArea, add_crosshair
+from ... import make_icon_button
+
+
+logger = logging.getLogger(__name__)
+
+
+class WelchEstimator:
+    """
+    Power spectral density of a signal whose samples arrive at irregular intervals, estimated with the Welch method.
+    The samples are resampled to a uniform rate by linear interpolation; the rate is estimated from the median interval
+    between the first samples, and gaps longer than a segment are skipped rather than interpolated over. The signal
+    is split into segments of segment_size samples that overlap by half; the estimate is the average of the
+    periodograms of the last num_segments segments. Every segment is transformed once, as soon as it is complete,
+    so the estimate is only recomputed once enough new samples have arrived.
+    """
+    MIN_SAMPLES_FOR_RATE_ESTIMATION = 64
+
+    def __init__(self, segment_size, num_segments):
+        self.segment_size = segment_size
+        self.sample_rate = None
+        self._hop = segment_size // 2
+        self._window = numpy.hanning(segment_size)
+        self._spectra = collections.deque(maxlen=num_segments)
+        self._spectra_sum = numpy.zeros(segment_size // 2 + 1)
+        self._new_t, self._new_y = [], []           # Arrays of the samples that have not been processed yet
+        self._raw_t = self._raw_y = numpy.zeros(0)  # Samples that the next resampled values depend on
+        self._next_t = None                         # Time of the next resampled value
+        self._resampled = numpy.zeros(0)            # Resampled values that do not form a complete segment yet
+        self.updated = False                        # Whether the estimate has changed since it was last taken
+
+    def add_samples(self, t, y):
+        self._new_t.append(t)
+        self._new_y.append(y)
+
+    def _interpolate(self, t, y):
+        num_values = int((t[-1] - self._next_t) * self.sample_rate) + 1
+        if num_values > 0:
+            grid = self._next_t + numpy.arange(num_values) / self.sample_rate
+            self._resampled = numpy.concatenate((self._resampled, numpy.interp(grid, t, y)))
+            self._next_t = grid[-1] + 1 / self.sample_rate
+
+    def _resample(self):
+        t = numpy.concatenate([self._raw_t] + self._new_t)
+        y = numpy.concatenate([self._raw_y] + self._new_y)
+        self._new_t, self._new_y = [], []
+
+        if self.sample_rate is None:
+            if len(t) < self.MIN_SAMPLES_FOR_RATE_ESTIMATION:
+                self._raw_t, self._raw_y = t, y
+                return
+            intervals = numpy.diff(t)
+            interval = numpy.median(intervals)
+            if interval <= 0:
+                interval = (t[-1] - t[0]) / (len(t) - 1)
+            if interval <= 0:
+                self._raw_t, self._raw_y = t, y
+                return
+            self.sample_rate = 1 / interval
+            self._next_t = t[0]
+            logger.info('Spectrum: estimated sample rate %.3f Hz', self.sample_rate)
+
+        # Interpolating across a gap longer than a segment would add a ramp that is not in the signal, so the
+        # samples before the gap are processed, and the resampling starts over from the first sample after it
+        start = 0
+        for end in (numpy.nonzero(numpy.diff(t) > self.segment_size / self.sample_rate)[0] + 1).tolist():
+            self._interpolate(t[start:end], y[start:end])
+            self._process_segments()
+            self._resampled = numpy.zeros(0)
+            self._next_t = t[end]
+            start = end
+        t, y = t[start:], y[start:]
+        self._interpolate(t, y)
+
+        # Keeping the last sample before the next value, so that it can be interpolated
+        keep_from = max(int(numpy.searchsorted(t, self._next_t, side='right')) - 1, 0)
+        self._raw_t, self._raw_y = t[keep_from:], y[keep_from:]
+
+    def _process_segments(self):
+        num_segments = (len(self._resampled) - self.segment_size) // self._hop + 1
+        if num_segments <= 0:
+            return
+        num_segments = min(num_segments, self._spectra.maxlen + 1)    # The older ones would be discarded anyway
+        first = len(self._resampled) - self.segment_size - (num_segments - 1) * self._hop
+        first -= first % self._hop
+
+        # One row per segment
+        index = first + numpy.arange(num_segments)[:, None] * self._hop + numpy.arange(self.segment_size)
+        segments = self._resampled[index]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        spectra = numpy.abs(numpy.fft.rfft(segments * self._window, axis=1)) ** 2
+        spectra /= self.sample_rate * numpy.sum(self._window ** 2)
+        spectra[:, 1:-1] *= 2                       # One-sided
+
+        for s in spectra:
+            if len(self._spectra) == self._spectra.maxlen:
+                self._spectra_sum -= self._spectra[0]
+            self._spectra.append(s)
+            self._spectra_sum += s
+
+        self._resampled = self._resampled[first + num_segments * self._hop:]
+        self.updated = True
+
+    def process(self):
+        """Processes the samples added since the last call; returns True if the estimate has been updated"""
+        if self._new_t:
+            self._resample()
+            self._process_segments()
+        return self.updated
+
+    def get_estimate(self):
+        """Returns the arrays of frequencies in Hz and of the PSD in units squared per Hz"""
+        self.updated = False
+        frequencies = numpy.fft.rfftfreq(self.segment_size, 1 / self.sample_rate)
+        return frequencies, self._spectra_sum / len(self._spectra)
+
+
+class SpectrumCurve:
+    def __init__(self, plot, base_color, darkening, pen, segment_size, num_segments):
+        self.base_color = base_color
+        self.darkening = darkening
+        self.pen = pen
+        self.plot = plot
+        self.estimator = WelchEstimator(segment_size, num_segments)
+
+    def set_color(self, color):
+        if self.base_color != color:
+            self.base_color = color
+            self.pen.setColor(self.base_color.darker(self.darkening))
+            self.plot.setPen(self.pen)
+
+    def update(self):
+        if self.estimator.process():
+            frequencies, psd = self.estimator.get_estimate()
+            self.plot.setData(frequencies, 10 * numpy.log10(numpy.maximum(psd, 1e-30)))
+
+
+class PlotAreaSpectrumWidget(QWidget, AbstractPlotArea):
+    MAX_CURVES_PER_EXTRACTOR = 9
+    SEGMENT_SIZES = [2 ** x for x in range(6, 15)]
+    DEFAULT_SEGMENT_SIZE = 1024
+
+    def __init__(self, parent, display_measurements):
+        super(PlotAreaSpectrumWidget, self).__init__(parent)
+
+        self._extractor_associations = {}       # Extractor : curves
+
+        self._clear_button = make_icon_button('eraser', 'Clear all curves', self, on_clicked=self._do_clear)
+
+        self._segment_size_box = QComboBox(self)
+        self._segment_size_box.setEditable(False)
+        self._segment_size_box.setToolTip('Samples per FFT segment; the frequency resolution is the sample rate '
+                                          'divided by this number')
+        self._segment_size_box.addItems([str(x) for x in self.SEGMENT_SIZES])
+        self._segment_size_box.setCurrentText(str(self.DEFAULT_SEGMENT_SIZE))
+        self._segment_size_box.currentTextChanged.connect(self._do_clear)
+
+        self._num_segments_spinbox = QSpinBox(self)
+        self._num_segments_spinbox.setToolTip('Number of the most recent segments whose spectra are averaged; '
+                                              'segments overlap by half')
+        self._num_segments_spinbox.setMinimum(1)
+        self._num_segments_spinbox.setMaximum(1000)
+        self._num_segments_spinbox.setValue(16)
+        self._num_segments_spinbox.valueChanged.connect(self._do_clear)
+
+        self._plot = PlotWidget(self, background=QColor(Qt.black))
+        self._plot.showButtons()
+        self._plot.enableAutoRange()
+        self._plot.showGrid(x=True, y=True, alpha=0.4)
+        self._plot.setLabel('bottom', 'Frequency', units='Hz')
+        self._plot.setLabel('left', 'PSD, dB/Hz')
+        self._legend = None
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self._plot, 1)
+
+        controls_layout = QHBoxLayout(self)
+        controls_layout.addWidget(self._clear_button)
+        controls_layout.addStretch(1)
+        controls_layout.addWidget(QLabel('Segment size:', self))
+        controls_layout.addWidget(self._segment_size_box)
+        controls_layout.addWidget(QLabel('Segments to average:', self))
+        controls_layout.addWidget(self._num_segments_spinbox)
+
+        layout.addLayout(controls_layout)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        # Crosshair
+        def _render_measurements(cur, ref):
+            text = 'f %.6f Hz,  %.3f dB/Hz' % cur
+            if ref is not None:
+                text += ';' + ' ' * 4 + 'df %.6f Hz,  d %.3f dB' % (cur[0] - ref[0], cur[1] - ref[1])
+            display_measurements(text)
+
+        display_measurements('Hover to sample frequency/PSD, click to set new reference')
+        add_crosshair(self._plot, _render_measurements)
+
+    def _forge_curves(self, how_many, base_color):
+        if how_many > 1 and self._legend is None:
+            self._legend = self._plot.addLegend()
+
+        segment_size = int(self._segment_size_box.currentText())
+        num_segments = self._num_segments_spinbox.value()
+        darkening_values = [100, 200, 300]
+        dash_patterns = (
+            [],
+            [3, 3],
+            [10, 3]
+        )
+        out = []
+        for idx in range(how_many):
+            logger.info('Adding new spectrum curve')
+            darkening = darkening_values[idx % len(darkening_values)]
+            pattern = dash_patterns[int(idx / len(darkening_values)) % len(dash_patterns)]
+            pen = mkPen(color=base_color.darker(darkening), width=1, dash=pattern)
+            plot = self._plot.plot(name=str(idx), pen=pen)
+            out.append(SpectrumCurve(plot, base_color, darkening, pen, segment_size, num_segments))
+        return out
+
+    def add_value(self, extractor, timestamp, value):
+        self.add_values(extractor, numpy.array([timestamp]), [value])
+
+    def add_values(self, extractor, timestamps, values):
+        try:
+            columns = numpy.asarray(values, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            columns = None
+        if columns is None or columns.ndim not in (1, 2):
+            raise RuntimeError('Values must be numbers or sequences of numbers of the same length')
+
+        # One column per curve; if the number of curves has changed, starting over
+        columns = columns.reshape(len(columns), -1)
+        if extractor in self._extractor_associations and \
+                columns.shape[1] != len(self._extractor_associations[extractor]):
+            self.remove_curves_provided_by_extractor(extractor)
+
+        if extractor not in self._extractor_associations:
+            if columns.shape[1] > self.MAX_CURVES_PER_EXTRACTOR:
+                raise RuntimeError('%r curves is much too many' % columns.shape[1])
+            self._extractor_associations[extractor] = self._forge_curves(columns.shape[1], extractor.color)
+
+        for idx, curve in enumerate(self._extractor_associations[extractor]):
+            curve.estimator.add_samples(timestamps, columns[:, idx])
+            curve.set_color(extractor.color)
+
+    def remove_curves_provided_by_extractor(self, extractor):
+        try:
+            curves = self._extractor_associations[extractor]
+            del self._extractor_associations[extractor]
+            for c in curves:
+                self._plot.removeItem(c.plot)
+        except KeyError:
+            pass
+
+        if self._legend is not None:
+            self._legend.scene().removeItem(self._legend)
+            self._legend = None
+
+    def _do_clear(self):
+        for k in list(self._extractor_associations.keys()):
+            self.remove_curves_provided_by_extractor(k)
+
+    def reset(self):
+        self._do_clear()
+        self._plot.enableAutoRange()
+
+    def update(self):
+        for curves in self._extractor_associations.values():
+            for c in curves:
+                c.update()
@@ -7,12 +7,14 @@
 #
 
 import math
+import numpy
 import logging
+import collections
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QSpinBox, QComboBox, QLabel, QCheckBox, QDoubleSpinBox
 from PyQt5.QtGui import QColor
-from PyQt5.QtCore import Qt
-from ....thirdparty.pyqtgraph import PlotWidget, mkPen
-from . import AbstractPlotArea, add_crosshair
+from PyQt5.QtCore import Qt, QRectF
+from ....thirdparty.pyqtgraph import PlotWidget, ImageItem, ScatterPlotItem, mkPen
+from . import AbstractPlotArea, PointBuffer, add_crosshair
 from ... import make_icon_button
 
 
@@ -22,19 +24,24 @@ logger = logging.getLogger(__name__)
 class AbstractPlotContainer:
     def __init__(self, plot):
         self.plot = plot
-        self.x = []
-        self.y = []
+        self.points = None
+        self.modified = False           # Whether the plot needs to be redrawn
 
     def add_point(self, x, y, max_data_points):
-        while len(self.x) >= max_data_points:
-            self.x.pop(0)
-            self.y.pop(0)
-        assert len(self.x) == len(self.y)
-        self.x.append(x)
-        self.y.append(y)
+        if self.points is None:
+            self.points = PointBuffer(max_data_points)
+        else:
+            self.points.set_capacity(max_data_points)
+        self.points.append(x, y)
+        self.modified = True
 
     def update(self):
-        self.plot.setData(self.x, self.y)
+        if self.modified:
+            self.modified = False
+            self.plot.setData(self.points.x, self.points.y)
+
+    def remove(self, parent):
+        parent.removeItem(self.plot)
 
 
 class LinePlotContainer(AbstractPlotContainer):
@@ -43,23 +50,116 @@ class LinePlotContainer(AbstractPlotContainer):
         self.pen = pen
 
     def set_color(self, color):
-        self.pen.setColor(color)
-        self.plot.setPen(self.pen)
+        if self.pen.color() != color:
+            self.pen.setColor(color)
+            self.plot.setPen(self.pen)
 
 
-class ScatterPlotContainer(AbstractPlotContainer):
+class ScatterPlotContainer:
+    """
+    Setting the data of a scatter plot makes it re-create all of its points, so the points are added incrementally
+    instead. They are distributed among several scatter plots of up to CHUNK_SIZE points each; new points are added
+    to the newest chunk, and the oldest chunk is removed as a whole once the rest hold enough points. The number of
+    displayed points may therefore exceed the limit by up to CHUNK_SIZE.
+    """
+    CHUNK_SIZE = 4096
+
     def __init__(self, parent, color):
         self.parent = parent
-        super(ScatterPlotContainer, self).__init__(self._inst(color))
+        self.color = QColor(color)
+        self._chunks = collections.deque()      # [scatter plot, number of points]
+        self._num_points = 0
+        self._max_data_points = 1
+        self._pending_x = []
+        self._pending_y = []
+
+    def add_point(self, x, y, max_data_points):
+        self._pending_x.append(x)
+        self._pending_y.append(y)
+        self._max_data_points = max_data_points
+
+    def set_color(self, color):
+        if self.color != color:
+            self.color = QColor(color)
+            pen = mkPen(color=self.color, width=1)
+            for plot, _num_points in self._chunks:
+                plot.setPen(pen)
+
+    def update(self):
+        if not self._pending_x:
+            return
+
+        x = numpy.array(self._pending_x[-self._max_data_points:])
+        y = numpy.array(self._pending_y[-self._max_data_points:])
+        self._pending_x, self._pending_y = [], []
+
+        begin = 0
+        while begin < len(x):
+            if not self._chunks or self._chunks[-1][1] >= self.CHUNK_SIZE:
+                plot = ScatterPlotItem(symbol='+', size=2, pen=mkPen(color=self.color, width=1))
+                self.parent.addItem(plot)
+                self._chunks.append([plot, 0])
+            chunk = self._chunks[-1]
+            end = min(begin + self.CHUNK_SIZE - chunk[1], len(x))
+            chunk[0].addPoints(x=x[begin:end], y=y[begin:end])
+            chunk[1] += end - begin
+            self._num_points += end - begin
+            begin = end
+
+        while self._num_points - self._chunks[0][1] >= self._max_data_points:
+            plot, num_points = self._chunks.popleft()
+            self.parent.removeItem(plot)
+            self._num_points -= num_points
+
+    def remove(self, parent):
+        for plot, _num_points in self._chunks:
+            parent.removeItem(plot)
+        self._chunks.clear()
+        self._num_points = 0
+
+
+class DensityPlotContainer(AbstractPlotContainer):
+    """
+    Renders the points as a 2D histogram, whose bins are painted with the color of the curve; the opacity of a bin
+    grows with the logarithm of the number of points in it. Unlike a scatter plot, this keeps large clouds of points
+    readable, and the cost of rendering does not depend on the number of points.
+    """
+    RESOLUTION = 256
 
-    def _inst(self, color):
-        return self.parent.scatterPlot(symbol='+', size=2, pen=mkPen(color=color, width=1))
+    def __init__(self, parent, color):
+        super(DensityPlotContainer, self).__init__(ImageItem())
+        parent.addItem(self.plot)
+        self.color = QColor(color)
 
     def set_color(self, color):
-        # We have to re-create the plot from scratch, because seems to be impossible to re-color a ScatterPlot
-        # once it has been created. Either it's bug in PyQtGraph, or I'm doing something wrong.
-        self.parent.removeItem(self.plot)
-        self.plot = self._inst(color)
+        if self.color != color:
+            self.color = QColor(color)
+            self.modified = True
+
+    def update(self):
+        if not self.modified:
+            return
+        self.modified = False
+
+        x, y = self.points.x, self.points.y
+        finite = numpy.isfinite(x) & numpy.isfinite(y)        # Otherwise the range of the histogram is undefined
+        x, y = x[finite], y[finite]
+        if not len(x):
+            return
+
+        x_min, y_min = x.min(), y.min()
+        width, height = (x.max() - x_min) or 1.0, (y.max() - y_min) or 1.0
+        counts, _, _ = numpy.histogram2d(x, y, bins=self.RESOLUTION,
+                                         range=[[x_min, x_min + width], [y_min, y_min + height]])
+
+        alpha = numpy.log1p(counts)
+        alpha *= 255 / alpha.max()
+
+        image = numpy.empty(counts.shape + (4,), dtype=numpy.ubyte)
+        image[..., :3] = self.color.red(), self.color.green(), self.color.blue()
+        image[..., 3] = alpha
+        self.plot.setImage(image, autoLevels=False, levels=(0, 255))
+        self.plot.setRect(QRectF(x_min, y_min, width, height))
 
 
 class PlotAreaXYWidget(QWidget, AbstractPlotArea):
@@ -80,7 +180,7 @@ class PlotAreaXYWidget(QWidget, AbstractPlotArea):
 
         self._plot_mode_box = QComboBox(self)
         self._plot_mode_box.setEditable(False)
-        self._plot_mode_box.addItems(['Line', 'Scatter'])
+        self._plot_mode_box.addItems(['Line', 'Scatter', 'Density'])
         self._plot_mode_box.setCurrentIndex(0)
         self._plot_mode_box.currentTextChanged.connect(self.reset)
 
@@ -156,6 +256,8 @@ class PlotAreaXYWidget(QWidget, AbstractPlotArea):
             return LinePlotContainer(self._plot.plot(), mkPen(color=color, width=1))
         elif mode == 'scatter':
             return ScatterPlotContainer(self._plot, color)
+        elif mode == 'density':
+            return DensityPlotContainer(self._plot, color)
         else:
             raise RuntimeError('Invalid plot mode: %r' % mode)
 
@@ -174,7 +276,7 @@ class PlotAreaXYWidget(QWidget, AbstractPlotArea):
         self._extractor_associations[extractor].set_color(extractor.color)
 
     def remove_curves_provided_by_extractor(self, extractor):
-        self._plot.removeItem(self._extractor_associations[extractor].plot)
+        self._extractor_associations[extractor].remove(self._plot)
         del self._extractor_associations[extractor]
 
     def _do_clear(self):
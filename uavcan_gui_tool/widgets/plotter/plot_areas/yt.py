@@ -6,12 +6,14 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import numpy
 import logging
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QDoubleSpinBox, QLabel
 from PyQt5.QtGui import QColor
 from PyQt5.QtCore import Qt
 from ....thirdparty.pyqtgraph import PlotWidget, mkPen
-from . import AbstractPlotArea, add_crosshair
+from . import AbstractPlotArea, PointBuffer, add_crosshair
+from .decimation import MinMaxPyramid
 from ... import make_icon_button
 
 
@@ -21,21 +23,24 @@ logger = logging.getLogger(__name__)
 class CurveContainer:
     MAX_DATA_POINTS = 200000
 
-    def __init__(self, plot, base_color, darkening, pen):
+    def __init__(self, plot, base_color, darkening, pen, max_data_points=MAX_DATA_POINTS):
         self.base_color = base_color
         self.darkening = darkening
         self.pen = pen
         self.plot = plot
-        self.x = []
-        self.y = []
+        self.points = PointBuffer(max_data_points)
+        self.pyramid = MinMaxPyramid(self.points)
+        self.modified = False           # Whether the plot needs to be redrawn
+        self.snapshot = None            # Points captured by the trigger, (PointBuffer, MinMaxPyramid)
+        self._rendered_view = None
 
     def add_point(self, x, y):
-        while len(self.x) >= self.MAX_DATA_POINTS:
-            self.x.pop(0)
-            self.y.pop(0)
-        assert len(self.x) == len(self.y)
-        self.x.append(x)
-        self.y.append(y)
+        self.points.append(x, y)
+        self.modified = True
+
+    def add_points(self, x, y):
+        self.points.extend(x, y)
+        self.modified = True
 
     def set_color(self, color):
         if self.base_color != color:
@@ -43,20 +48,129 @@ class CurveContainer:
             color = self.base_color.darker(self.darkening)
             logger.info('Updating color %r --> %r', self.pen.color(), color)
             self.pen.setColor(color)
-
-    def update(self):
-        self.plot.setData(self.x, self.y, pen=self.pen)
+            self._rendered_view = None
+
+    def capture(self, x_from, x_to, x_offset):
+        """Copies the points within the range of X into the snapshot; X of the snapshot is counted from x_offset"""
+        x, y = self.points.x, self.points.y
+        begin = int(numpy.searchsorted(x, x_from, side='left'))
+        end = int(numpy.searchsorted(x, x_to, side='right'))
+        points = PointBuffer(max(end - begin, 1))
+        points.extend(x[begin:end] - x_offset, y[begin:end])
+        self.snapshot = points, MinMaxPyramid(points)
+
+    def update(self, x_range, max_buckets, show_snapshot=False):
+        """
+        Redraws the curve within the specified range of X using about 2 * max_buckets points.
+        If show_snapshot is True, the points captured by the trigger are drawn instead of the live ones.
+        """
+        view = x_range, max_buckets, show_snapshot and self.snapshot
+        if (self.modified and not show_snapshot) or view != self._rendered_view:
+            self._rendered_view = view
+            if not show_snapshot:
+                self.modified = False
+                points = self.pyramid.get_points(x_range[0], x_range[1], max_buckets)
+            elif self.snapshot is not None:
+                points = self.snapshot[1].get_points(x_range[0], x_range[1], max_buckets)
+            else:
+                points = [], []
+            self.plot.setData(*points, pen=self.pen)
+
+
+class Trigger:
+    """
+    Oscilloscope-style trigger that watches the values of one curve.
+    Once the condition is met, the trigger waits until the post-trigger window has been filled, and then reports
+    the time of the event, so that the data around it can be captured. In the normal mode, the trigger is re-armed
+    after every capture; in the single mode, it has to be re-armed with arm(). The auto mode is the normal mode that
+    also captures unconditionally if the condition has not been met for as long as the capture window lasts.
+    """
+    MODE_AUTO = 'Auto'
+    MODE_NORMAL = 'Normal'
+    MODE_SINGLE = 'Single'
+    MODES = [MODE_AUTO, MODE_NORMAL, MODE_SINGLE]
+
+    CONDITION_RISING_EDGE = 'Rising edge'
+    CONDITION_FALLING_EDGE = 'Falling edge'
+    CONDITION_ANY_EDGE = 'Any edge'
+    CONDITION_ABOVE = 'Above'
+    CONDITION_BELOW = 'Below'
+    CONDITIONS = [CONDITION_RISING_EDGE, CONDITION_FALLING_EDGE, CONDITION_ANY_EDGE, CONDITION_ABOVE, CONDITION_BELOW]
+
+    def __init__(self, mode, condition, level, pre_trigger, post_trigger):
+        self.mode = mode
+        self.condition = condition
+        self.level = level
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.armed = False
+        self._armed_at = None       # Events that occurred earlier are ignored
+        self._event_at = None       # Time of the event whose post-trigger window is being filled
+        self._last_y = None
+
+    @property
+    def triggered(self):
+        return self._event_at is not None
+
+    def arm(self, now):
+        self.armed = True
+        self._armed_at = now
+        self._event_at = None
+
+    def _test(self, previous_y, y):
+        rising = (previous_y < self.level) & (y >= self.level)
+        falling = (previous_y > self.level) & (y <= self.level)
+        return {
+            self.CONDITION_RISING_EDGE: lambda: rising,
+            self.CONDITION_FALLING_EDGE: lambda: falling,
+            self.CONDITION_ANY_EDGE: lambda: rising | falling,
+            self.CONDITION_ABOVE: lambda: y > self.level,
+            self.CONDITION_BELOW: lambda: y < self.level,
+        }[self.condition]()
+
+    def feed(self, x, y):
+        """Checks the new points of the curve, given as arrays"""
+        if not len(y):
+            return
+        previous_y = numpy.concatenate(([y[0] if self._last_y is None else self._last_y], y[:-1]))
+        self._last_y = y[-1]
+
+        if self.armed and self._event_at is None:
+            hits = self._test(previous_y, y) & (x >= self._armed_at)
+            index = int(numpy.argmax(hits))
+            if hits[index]:
+                self._event_at = float(x[index])
+
+    def poll(self, now):
+        """Returns the time of the event if the data around it are to be captured now; now is the newest data time"""
+        if not self.armed:
+            return
+
+        if self._event_at is None and self.mode == self.MODE_AUTO and \
+                now - self._armed_at >= self.pre_trigger + self.post_trigger:
+            self._event_at = now - self.post_trigger
+
+        if self._event_at is not None and now >= self._event_at + self.post_trigger:
+            event_at = self._event_at
+            if self.mode == self.MODE_SINGLE:
+                self.armed = False
+                self._event_at = None
+            else:
+                self.arm(now)
+            return event_at
 
 
 class PlotAreaYTWidget(QWidget, AbstractPlotArea):
     INITIAL_X_RANGE = 120
     MAX_CURVES_PER_EXTRACTOR = 9
+    MIN_DECIMATION_WIDTH = 100
 
     def __init__(self, parent, display_measurements):
         super(PlotAreaYTWidget, self).__init__(parent)
 
         self._extractor_associations = {}       # Extractor : plots
         self._max_x = 0
+        self.max_data_points = CurveContainer.MAX_DATA_POINTS   # Capacity of the curves that will be created
 
         self._autoscroll_checkbox = make_icon_button('angle-double-right',
                                                      'Scroll the plot automatically as new data arrives', self,
@@ -64,6 +178,67 @@ class PlotAreaYTWidget(QWidget, AbstractPlotArea):
 
         self._clear_button = make_icon_button('eraser', 'Clear all curves', self, on_clicked=self._do_clear)
 
+        # Trigger
+        self._trigger = None                    # Trigger, if the trigger mode is on
+        self._trigger_sources = []              # (extractor, index of the curve), same order as in the source box
+        self._last_capture_at = None
+
+        self._trigger_button = make_icon_button('bolt', 'Trigger mode: display the data captured around events '
+                                                'of one curve, like an oscilloscope', self, checkable=True,
+                                                on_clicked=self._update_trigger)
+
+        self._trigger_mode_box = QComboBox(self)
+        self._trigger_mode_box.setToolTip('Normal - capture on every event\n'
+                                          'Auto - same, but also capture if there were no events for a while\n'
+                                          'Single - capture on the first event, then wait for re-arming')
+        self._trigger_mode_box.addItems(Trigger.MODES)
+        self._trigger_mode_box.setCurrentText(Trigger.MODE_NORMAL)
+
+        self._trigger_source_box = QComboBox(self)
+        self._trigger_source_box.setToolTip('Curve to watch')
+        self._trigger_source_box.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+
+        self._trigger_condition_box = QComboBox(self)
+        self._trigger_condition_box.addItems(Trigger.CONDITIONS)
+
+        self._trigger_level_spinbox = QDoubleSpinBox(self)
+        self._trigger_level_spinbox.setToolTip('Level')
+        self._trigger_level_spinbox.setRange(-1e9, 1e9)
+        self._trigger_level_spinbox.setDecimals(6)
+
+        self._trigger_pre_spinbox = QDoubleSpinBox(self)
+        self._trigger_post_spinbox = QDoubleSpinBox(self)
+        for spinbox, value in ((self._trigger_pre_spinbox, 1), (self._trigger_post_spinbox, 1)):
+            spinbox.setRange(0, 3600)
+            spinbox.setDecimals(3)
+            spinbox.setSuffix(' s')
+            spinbox.setValue(value)
+
+        self._trigger_arm_button = make_icon_button('play', 'Re-arm the trigger', self, on_clicked=self._arm_trigger)
+        self._trigger_status_label = QLabel(self)
+
+        for box in (self._trigger_mode_box, self._trigger_source_box, self._trigger_condition_box):
+            box.setEditable(False)
+            box.currentIndexChanged.connect(self._update_trigger)
+        for spinbox in (self._trigger_level_spinbox, self._trigger_pre_spinbox, self._trigger_post_spinbox):
+            spinbox.valueChanged.connect(self._update_trigger)
+
+        self._trigger_panel = QWidget(self)
+        trigger_layout = QHBoxLayout(self._trigger_panel)
+        trigger_layout.addWidget(self._trigger_mode_box)
+        trigger_layout.addWidget(self._trigger_source_box, 1)
+        trigger_layout.addWidget(self._trigger_condition_box)
+        trigger_layout.addWidget(self._trigger_level_spinbox)
+        trigger_layout.addWidget(QLabel('Pre:', self))
+        trigger_layout.addWidget(self._trigger_pre_spinbox)
+        trigger_layout.addWidget(QLabel('Post:', self))
+        trigger_layout.addWidget(self._trigger_post_spinbox)
+        trigger_layout.addWidget(self._trigger_arm_button)
+        trigger_layout.addWidget(self._trigger_status_label)
+        trigger_layout.setContentsMargins(0, 0, 0, 0)
+        self._trigger_panel.setLayout(trigger_layout)
+        self._trigger_panel.setVisible(False)
+
         self._plot = PlotWidget(self, background=QColor(Qt.black))
         self._plot.showButtons()
         self._plot.enableAutoRange()
@@ -77,10 +252,14 @@ class PlotAreaYTWidget(QWidget, AbstractPlotArea):
         controls_layout = QVBoxLayout(self)
         controls_layout.addWidget(self._clear_button)
         controls_layout.addWidget(self._autoscroll_checkbox)
+        controls_layout.addWidget(self._trigger_button)
         controls_layout.addStretch(1)
         layout.addLayout(controls_layout)
 
-        layout.addWidget(self._plot, 1)
+        plot_layout = QVBoxLayout(self)
+        plot_layout.addWidget(self._plot, 1)
+        plot_layout.addWidget(self._trigger_panel)
+        layout.addLayout(plot_layout, 1)
 
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
@@ -119,18 +298,12 @@ class PlotAreaYTWidget(QWidget, AbstractPlotArea):
                 pattern = dash_patterns[int(idx / len(darkening_values)) % len(dash_patterns)]
                 pen = mkPen(color=base_color.darker(darkening), width=1, dash=pattern)
                 plot = self._plot.plot(name=str(idx), pen=pen)
-                out.append(CurveContainer(plot, base_color, darkening, pen))
+                out.append(CurveContainer(plot, base_color, darkening, pen, self.max_data_points))
             except Exception:
                 logger.error('Could not add curve', exc_info=True)
         return out
 
-    def add_value(self, extractor, x, y):
-        try:
-            num_curves = len(y)
-        except Exception:
-            num_curves = 1
-            y = y,          # do you love Python as I do
-
+    def _get_curves(self, extractor, num_curves):
         # If number of curves changed, removing all plots from this extractor
         if extractor in self._extractor_associations and num_curves != len(self._extractor_associations[extractor]):
             self.remove_curves_provided_by_extractor(extractor)
@@ -141,21 +314,121 @@ class PlotAreaYTWidget(QWidget, AbstractPlotArea):
             if num_curves > self.MAX_CURVES_PER_EXTRACTOR:
                 raise RuntimeError('%r curves is much too many' % num_curves)
             self._extractor_associations[extractor] = self._forge_curves(num_curves, extractor.color)
+            self._update_trigger_sources()
+
+        return self._extractor_associations[extractor]
+
+    def _update_trigger_sources(self):
+        current = self._get_trigger_source()
+        self._trigger_sources = [(e, i) for e, curves in self._extractor_associations.items()
+                                 for i in range(len(curves))]
+
+        self._trigger_source_box.blockSignals(True)
+        self._trigger_source_box.clear()
+        for e, i in self._trigger_sources:
+            name = e.extraction_expression.source
+            self._trigger_source_box.addItem(name if len(self._extractor_associations[e]) == 1 else
+                                             '%s [%d]' % (name, i))
+        if current in self._trigger_sources:
+            self._trigger_source_box.setCurrentIndex(self._trigger_sources.index(current))
+        self._trigger_source_box.blockSignals(False)
+
+    def _get_trigger_source(self):
+        index = self._trigger_source_box.currentIndex()
+        if 0 <= index < len(self._trigger_sources):
+            return self._trigger_sources[index]
+
+    def _update_trigger(self):
+        enabled = self._trigger_button.isChecked()
+        self._trigger_panel.setVisible(enabled)
+        self._autoscroll_checkbox.setEnabled(not enabled)
+        if enabled != (self._trigger is not None):
+            self._last_capture_at = None
+            for curves in self._extractor_associations.values():
+                for c in curves:
+                    c.snapshot = None
+
+        if not enabled:
+            self._trigger = None
+            return
+
+        self._trigger = Trigger(self._trigger_mode_box.currentText(), self._trigger_condition_box.currentText(),
+                                self._trigger_level_spinbox.value(), self._trigger_pre_spinbox.value(),
+                                self._trigger_post_spinbox.value())
+        self._arm_trigger()
+
+    def _arm_trigger(self):
+        if self._trigger is not None:
+            self._trigger.arm(self._max_x)
+
+    def _feed_trigger(self, extractor, x, columns):
+        source = self._get_trigger_source()
+        if self._trigger is not None and source is not None and source[0] is extractor:
+            self._trigger.feed(x, columns[:, source[1]])
+
+    def _capture(self, event_at):
+        for curves in self._extractor_associations.values():
+            for c in curves:
+                c.capture(event_at - self._trigger.pre_trigger, event_at + self._trigger.post_trigger, event_at)
+        self._last_capture_at = event_at
+        # noinspection PyArgumentList
+        self._plot.setRange(xRange=(-self._trigger.pre_trigger, self._trigger.post_trigger), padding=0)
+
+    def _update_trigger_status(self):
+        if self._trigger.triggered:
+            text = 'Triggered'
+        elif self._trigger.armed:
+            text = 'Armed'
+        else:
+            text = 'Stopped'
+        if self._last_capture_at is not None:
+            text += ', captured at %.3f sec' % self._last_capture_at
+        self._trigger_status_label.setText(text)
+
+    def add_value(self, extractor, x, y):
+        try:
+            num_curves = len(y)
+        except Exception:
+            num_curves = 1
+            y = y,          # do you love Python as I do
 
         # Actually plotting
-        for idx, curve in enumerate(self._extractor_associations[extractor]):
+        curves = self._get_curves(extractor, num_curves)
+        for idx, curve in enumerate(curves):
             curve.add_point(x, float(y[idx]))
             curve.set_color(extractor.color)
 
+        if self._trigger is not None:
+            self._feed_trigger(extractor, numpy.array([x]), numpy.array([[float(v) for v in y[:len(curves)]]]))
+
         # Updating the rightmost value
         self._max_x = max(self._max_x, x)
 
+    def add_values(self, extractor, x, y):
+        try:
+            columns = numpy.asarray(y, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            columns = None
+        if columns is None or columns.ndim not in (1, 2):   # Can't be added in bulk, e.g. the number of curves varies
+            return super(PlotAreaYTWidget, self).add_values(extractor, x, y)
+
+        # One column per curve
+        columns = columns.reshape(len(columns), -1)
+        for idx, curve in enumerate(self._get_curves(extractor, columns.shape[1])):
+            curve.add_points(x, columns[:, idx])
+            curve.set_color(extractor.color)
+
+        self._feed_trigger(extractor, x, columns)
+
+        self._max_x = max(self._max_x, float(x.max()))
+
     def remove_curves_provided_by_extractor(self, extractor):
         try:
             curves = self._extractor_associations[extractor]
             del self._extractor_associations[extractor]
             for c in curves:
                 self._plot.removeItem(c.plot)
+            self._update_trigger_sources()
         except KeyError:
             pass
 
@@ -173,18 +446,33 @@ class PlotAreaYTWidget(QWidget, AbstractPlotArea):
         self._plot.enableAutoRange()
         # noinspection PyArgumentList
         self._plot.setRange(xRange=(0, self.INITIAL_X_RANGE), padding=0)
+        self._arm_trigger()
+
+    def show_all(self):
+        """Disables automatic scrolling and fits the view to the data"""
+        self._autoscroll_checkbox.setChecked(False)
+        self._plot.enableAutoRange()
 
     def update(self):
-        # Updating curves
-        for curves in self._extractor_associations.values():
-            for c in curves:
-                c.update()
+        # In the trigger mode, only the captured data are displayed
+        if self._trigger is not None:
+            event_at = self._trigger.poll(self._max_x)
+            if event_at is not None:
+                self._capture(event_at)
+            self._update_trigger_status()
 
         # Updating view range
-        if self._autoscroll_checkbox.isChecked():
+        if self._autoscroll_checkbox.isChecked() and self._trigger is None:
             (xmin, xmax), _ = self._plot.viewRange()
             diff = xmax - xmin
             xmax = self._max_x
             xmin = self._max_x - diff
             # noinspection PyArgumentList
             self._plot.setRange(xRange=(xmin, xmax), padding=0)
+
+        # Updating curves; only the visible part is drawn, at the resolution of the screen
+        (xmin, xmax), _ = self._plot.viewRange()
+        width = max(int(self._plot.getPlotItem().getViewBox().width()), self.MIN_DECIMATION_WIDTH)
+        for curves in self._extractor_associations.values():
+            for c in curves:
+                c.update((xmin, xmax), width, show_snapshot=self._trigger is not None)
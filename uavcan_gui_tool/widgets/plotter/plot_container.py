@@ -22,6 +22,8 @@ class PlotContainerWidget(QDockWidget):
         self.setAttribute(Qt.WA_DeleteOnClose)              # This is required to stop background timers!
 
         self.on_close = lambda: None
+        self.on_extractors_changed = lambda: None
+        self.on_values_extracted = lambda extractor, timestamps, values: None
 
         self._plot_area = plot_area_class(self, display_measurements=self.setWindowTitle)
 
@@ -82,20 +84,32 @@ class PlotContainerWidget(QDockWidget):
                 self._plot_area.remove_curves_provided_by_extractor(extractor)
                 self._extractors.remove(extractor)
                 self._extractors_layout.removeWidget(widget)
+                self.on_extractors_changed()
 
             widget.on_remove = remove
+            widget.on_change = self.on_extractors_changed
+            self.on_extractors_changed()
 
         win = NewValueExtractorWindow(self, self._active_data_types)
         win.on_done = done
         win.show()
 
-    def process_transfer(self, timestamp, tr):
-        for extractor in self._extractors:
+    @property
+    def extractors(self):
+        return list(self._extractors)
+
+    def process_group(self, timestamps, group, extractors):
+        """
+        The TransferGroup is processed by the specified extractors of this container, which accept its data type.
+        The timestamps of the transfers of the group are given as an array.
+        """
+        for extractor in extractors:
             try:
-                value = extractor.try_extract(tr)
-                if value is None:
-                    continue
-                self._plot_area.add_value(extractor, timestamp, value)
+                indexes, values = extractor.extract_group(group)
+                if len(indexes):
+                    extracted_timestamps = timestamps[indexes]
+                    self.on_values_extracted(extractor, extracted_timestamps, values)
+                    self._plot_area.add_values(extractor, extracted_timestamps, values)
             except Exception:
                 extractor.register_error()
 
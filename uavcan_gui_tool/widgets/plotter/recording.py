@@ -0,0 +1,267 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Recording of the values produced by the extractors of the plotter.
+A recording file starts with the magic string and the format version, followed by blocks of two kinds, each prefixed
+with its kind and length: descriptions of series, and chunks of samples of a series. A series is the output of one
+extractor; every sample has a timestamp and one or more values. A chunk stores its columns (the timestamps, then
+every value column) one after another as float64, compressed with zlib. The file is only ever appended to, so if
+the writer is interrupted, everything but the last incomplete block can still be read.
+"""
+
+import csv
+import json
+import time
+import zlib
+import queue
+import struct
+import logging
+import threading
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+FILE_EXTENSION = '.plotrec'
+
+_MAGIC = b'UCPLOTREC'
+_VERSION = 1
+_FILE_HEADER = struct.Struct('<%dsH' % len(_MAGIC))
+
+_BLOCK_HEADER = struct.Struct('<BI')             # Kind, length of the payload
+_BLOCK_SERIES = 1                               # Payload: series ID, description as JSON
+_BLOCK_CHUNK = 2                                # Payload: series ID, number of rows, compressed columns
+_SERIES_HEADER = struct.Struct('<I')
+_CHUNK_HEADER = struct.Struct('<II')
+
+
+class RecordingError(Exception):
+    pass
+
+
+class RecordingWriter:
+    """
+    Appends samples to a recording file. Compression and writing are done by a background thread; the samples of
+    every series are accumulated until there are CHUNK_ROWS of them, or FLUSH_INTERVAL seconds have passed.
+    """
+    CHUNK_ROWS = 65536
+    FLUSH_INTERVAL = 1.0
+    COMPRESSION_LEVEL = 6
+
+    _STOP = object()
+
+    def __init__(self, path):
+        self.path = path
+        self.error = None
+        self._next_series_id = 0
+        self._file = open(path, 'wb')           # Opened here so that the caller gets the error if any
+        self._file.write(_FILE_HEADER.pack(_MAGIC, _VERSION))
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='recording_writer', daemon=True)
+        self._thread.start()
+
+    def add_series(self, description):
+        """Returns the ID of the new series; the description is a dict that can be represented as JSON"""
+        series_id = self._next_series_id
+        self._next_series_id += 1
+        self._queue.put((_BLOCK_SERIES, series_id, json.dumps(description)))
+        return series_id
+
+    def write(self, series_id, timestamps, values):
+        """Timestamps is an array of N elements, values is an array of N rows"""
+        self._queue.put((_BLOCK_CHUNK, series_id, (timestamps, values)))
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _write_block(self, kind, payload):
+        self._file.write(_BLOCK_HEADER.pack(kind, len(payload)))
+        self._file.write(payload)
+
+    def _write_chunk(self, series_id, timestamps, values):
+        columns = numpy.vstack([numpy.concatenate(timestamps)] + list(numpy.concatenate(values).T))
+        data = zlib.compress(columns.astype('<f8').tobytes(), self.COMPRESSION_LEVEL)
+        self._write_block(_BLOCK_CHUNK, _CHUNK_HEADER.pack(series_id, columns.shape[1]) + data)
+
+    def _run(self):
+        pending = {}            # Series ID : ([timestamp arrays], [value arrays], number of rows)
+        flushed_at = time.monotonic()
+
+        def flush(series_id):
+            timestamps, values, _ = pending.pop(series_id)
+            self._write_chunk(series_id, timestamps, values)
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self.FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            try:
+                if item is self._STOP:
+                    for series_id in list(pending):
+                        flush(series_id)
+                    self._file.close()
+                    break
+
+                if item is not None and item[0] == _BLOCK_SERIES:
+                    _, series_id, description = item
+                    self._write_block(_BLOCK_SERIES, _SERIES_HEADER.pack(series_id) + description.encode())
+                elif item is not None:
+                    _, series_id, (timestamps, values) = item
+                    entry = pending.setdefault(series_id, ([], [], 0))
+                    entry[0].append(timestamps)
+                    entry[1].append(values)
+                    pending[series_id] = entry[0], entry[1], entry[2] + len(timestamps)
+                    if pending[series_id][2] >= self.CHUNK_ROWS:
+                        flush(series_id)
+
+                if time.monotonic() - flushed_at >= self.FLUSH_INTERVAL:
+                    flushed_at = time.monotonic()
+                    for series_id in list(pending):
+                        flush(series_id)
+                    self._file.flush()
+            except Exception as ex:
+                if self.error is None:
+                    logger.error('Recording to %r failed', self.path, exc_info=True)
+                    self.error = ex
+                pending.clear()
+                if item is self._STOP:
+                    break
+
+
+class Recorder:
+    """
+    Records the values of extractors, one series per extractor.
+    If the number of values an extractor produces per sample changes, a new series is started.
+    """
+    def __init__(self, path):
+        self._writer = RecordingWriter(path)
+        self._series = {}           # Extractor : (series ID, number of columns)
+
+    @property
+    def path(self):
+        return self._writer.path
+
+    @property
+    def error(self):
+        return self._writer.error
+
+    def _get_series_id(self, extractor, num_columns):
+        series_id, series_num_columns = self._series.get(extractor, (None, None))
+        if series_num_columns != num_columns:
+            series_id = self._writer.add_series({
+                'data_type_name': extractor.data_type_name,
+                'extraction_expression': extractor.extraction_expression.source,
+                'filter_expressions': [x.source for x in extractor.filter_expressions],
+                'color': extractor.color.name(),
+                'num_columns': num_columns,
+            })
+            self._series[extractor] = series_id, num_columns
+        return series_id
+
+    def _record_rows(self, extractor, timestamps, values):
+        try:
+            values = numpy.asarray(values, dtype=numpy.float64)
+        except (TypeError, ValueError):
+            values = None
+        if values is None or values.ndim not in (1, 2):
+            return False
+
+        values = values.reshape(len(values), -1)
+        self._writer.write(self._get_series_id(extractor, values.shape[1]),
+                           numpy.asarray(timestamps, dtype=numpy.float64), values)
+        return True
+
+    def record(self, extractor, timestamps, values):
+        """The arguments are the same as those of AbstractPlotArea.add_values()"""
+        if not self._record_rows(extractor, timestamps, values):
+            # The number of values per sample varies, or some of them are not numbers
+            for index, value in enumerate(values):
+                self._record_rows(extractor, timestamps[index:index + 1], [value])
+
+    def close(self):
+        self._writer.close()
+
+
+class RecordedSeries:
+    def __init__(self, series_id, description):
+        self.id = series_id
+        self.description = description
+        self.timestamps = numpy.zeros(0)
+        self.values = numpy.zeros((0, description['num_columns']))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def name(self):
+        out = self.description['extraction_expression']
+        if self.description['filter_expressions']:
+            out += ' if ' + ' and '.join(self.description['filter_expressions'])
+        return out
+
+
+def read_recording(path):
+    """Returns the list of RecordedSeries that are stored in the file, at full resolution"""
+    series = {}
+    chunks = {}             # Series ID : list of arrays of columns
+    with open(path, 'rb') as f:
+        header = f.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size or _FILE_HEADER.unpack(header)[0] != _MAGIC:
+            raise RecordingError('%r is not a recording' % path)
+        if _FILE_HEADER.unpack(header)[1] != _VERSION:
+            raise RecordingError('Unsupported version of the recording format: %r' % _FILE_HEADER.unpack(header)[1])
+
+        while True:
+            block_header = f.read(_BLOCK_HEADER.size)
+            if len(block_header) < _BLOCK_HEADER.size:
+                break
+            kind, length = _BLOCK_HEADER.unpack(block_header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logger.warning('Recording %r ends with an incomplete block', path)
+                break
+
+            if kind == _BLOCK_SERIES:
+                series_id, = _SERIES_HEADER.unpack_from(payload)
+                series[series_id] = RecordedSeries(series_id, json.loads(payload[_SERIES_HEADER.size:].decode()))
+                chunks[series_id] = []
+            elif kind == _BLOCK_CHUNK:
+                series_id, num_rows = _CHUNK_HEADER.unpack_from(payload)
+                columns = numpy.frombuffer(zlib.decompress(payload[_CHUNK_HEADER.size:]), dtype='<f8')
+                chunks[series_id].append(columns.reshape(-1, num_rows))
+
+    for series_id, s in series.items():
+        if chunks[series_id]:
+            columns = numpy.hstack(chunks[series_id])
+            s.timestamps = columns[0]
+            s.values = columns[1:].T
+    return list(series.values())
+
+
+def export_npz(series, path):
+    """Arrays series<ID>_timestamps and series<ID>_values, and the JSON descriptions of the series in 'series'"""
+    arrays = {'series': numpy.array([json.dumps(dict(s.description, id=s.id)) for s in series])}
+    for s in series:
+        arrays['series%d_timestamps' % s.id] = s.timestamps
+        arrays['series%d_values' % s.id] = s.values
+    numpy.savez_compressed(path, **arrays)
+
+
+def export_csv(series, path):
+    """One row per sample: series ID, series name, timestamp, values"""
+    num_columns = max([s.values.shape[1] for s in series] or [1])
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['series', 'name', 'timestamp'] + ['value_%d' % i for i in range(num_columns)])
+        for s in series:
+            prefix = [s.id, s.name]
+            writer.writerows(prefix + row for row in numpy.column_stack((s.timestamps, s.values)).tolist())
@@ -0,0 +1,60 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+import os
+import logging
+from PyQt5.QtWidgets import QDockWidget
+from PyQt5.QtGui import QColor
+from PyQt5.QtCore import Qt, QTimer
+from .plot_areas.yt import PlotAreaYTWidget
+from .recording import read_recording
+from .value_extractor import Expression, Extractor
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingViewerWidget(QDockWidget):
+    """
+    Displays a recording at full resolution in a Y-T plot, where time is counted from the first sample.
+    The curves are decimated to the resolution of the screen as usual, so even long recordings can be navigated.
+    """
+    UPDATE_INTERVAL = 0.1
+
+    def __init__(self, parent, path):
+        super(RecordingViewerWidget, self).__init__(parent)
+        self.setAttribute(Qt.WA_DeleteOnClose)              # This is required to stop background timers!
+        self.setWindowTitle(os.path.basename(path))
+
+        series = read_recording(path)       # May throw
+        logger.info('Recording %r: %d series, %d samples', path, len(series), sum(len(x) for x in series))
+
+        self._plot_area = PlotAreaYTWidget(self, display_measurements=self.setWindowTitle)
+        self._plot_area.max_data_points = max([len(x) for x in series] + [1])
+
+        first_timestamp = min([x.timestamps[0] for x in series if len(x)] or [0])
+        for s in series:
+            if not len(s):
+                continue
+            d = s.description
+            extractor = Extractor(d['data_type_name'], Expression(d['extraction_expression']),
+                                  [Expression(x) for x in d['filter_expressions']], QColor(d['color']))
+            self._plot_area.add_values(extractor, s.timestamps - first_timestamp, s.values)
+
+        self._plot_area.show_all()
+        self.setWidget(self._plot_area)
+        self.setFeatures(QDockWidget.DockWidgetFloatable |
+                         QDockWidget.DockWidgetClosable |
+                         QDockWidget.DockWidgetMovable)
+        self.setMinimumWidth(700)
+        self.setMinimumHeight(400)
+
+        self._update_timer = QTimer(self)
+        self._update_timer.setSingleShot(False)
+        self._update_timer.timeout.connect(self._plot_area.update)
+        self._update_timer.start(int(self.UPDATE_INTERVAL * 1000))
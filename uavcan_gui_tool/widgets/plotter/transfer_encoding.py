@@ -0,0 +1,409 @@
+#
+# Copyright (C) 2016  UAVCAN Development Team  <uavcan.org>
+#
+# This software is distributed under the terms of the MIT License.
+#
+# Author: Pavel Kirienko <pavel.kirienko@zubax.com>
+#
+
+"""
+Representation of message transfers that are sent from the main process to the plotter processes.
+Messages whose layout is fixed (no unions, bounded arrays) are encoded as packed records of their numeric leaves:
+the layout is derived from the DSDL definition and sent once, then every transfer costs a few bytes, and batches of
+records are decoded in the plotter process with NumPy. Other messages are sent as pickled CompactMessage trees.
+The plotter processes the transfers of every data type in groups, see TransferGroup.
+"""
+
+import struct
+import numpy
+import operator
+import uavcan
+
+
+MAX_RECORD_BITS = 8192
+
+# Kinds of the nodes of a layout description
+_PRIMITIVE = 'primitive'                # (kind, primitive kind, bit length)
+_STATIC_ARRAY = 'static_array'          # (kind, element, size, string-like)
+_DYNAMIC_ARRAY = 'dynamic_array'        # (kind, element, max size, bit length of the length field, string-like)
+_COMPOUND = 'compound'                  # (kind, data type name, ((field name, node), ...))
+
+_PRIMITIVE_BOOL = 'bool'
+_PRIMITIVE_UINT = 'uint'
+_PRIMITIVE_INT = 'int'
+_PRIMITIVE_FLOAT = 'float'
+
+_RECORD_HEADER = struct.Struct('<dB')           # Monotonic timestamp, source node ID (zero if anonymous)
+
+
+_type_constants = {}     # Data type name : {constant name : value}
+
+
+def _get_type_constants(uavcan_data_type_name):
+    """Returns the DSDL constants of a data type as a dict; throws KeyError if the data type is unknown"""
+    try:
+        return _type_constants[uavcan_data_type_name]
+    except KeyError:
+        data_type = uavcan.TYPENAMES[uavcan_data_type_name]
+        constants = {c.name: c.value for c in data_type.constants}
+        _type_constants[uavcan_data_type_name] = constants
+        return constants
+
+
+class CompactMessage:
+    """
+    Transfer and message objects from Pyuavcan cannot be exchanged between processes,
+    so we build this minimal representation that is just enough to mimic a Pyuavcan message object.
+    Fields are stored as instance attributes, so that reading them does not involve any Python code.
+    """
+    def __init__(self, uavcan_data_type_name):
+        self._uavcan_data_type_name = uavcan_data_type_name
+
+    def __repr__(self):
+        return '%s(%r)' % (self._uavcan_data_type_name, self._fields)
+
+    @property
+    def _fields(self):
+        return {k: v for k, v in vars(self).items() if k != '_uavcan_data_type_name'}
+
+    def _add_field(self, name, value):
+        setattr(self, name, value)
+
+    def __getattr__(self, item):
+        # Invoked only if there is no such field. Constants are resolved from the DSDL definition; a missing field
+        # must not read as its default value, since the sample would be plotted as if it carried that value.
+        if item != '_uavcan_data_type_name' and not item.startswith('__'):
+            try:
+                return _get_type_constants(self._uavcan_data_type_name)[item]
+            except KeyError:
+                pass
+            data_type = uavcan.TYPENAMES.get(self._uavcan_data_type_name)
+            if data_type is not None and data_type.union and item in [f.name for f in data_type.fields]:
+                raise AttributeError('%r is not the active field of the union %s' %
+                                     (item, self._uavcan_data_type_name))
+        raise AttributeError(item)
+
+
+# noinspection PyProtectedMember
+def _extract_struct_fields(m, field_names=None):
+    """If field_names is not None, only the specified fields of the top-level message are extracted"""
+    if isinstance(m, uavcan.transport.CompoundValue):
+        out = CompactMessage(uavcan.get_uavcan_data_type(m).full_name)
+        for field_name, field in uavcan.get_fields(m).items():
+            if field_names is not None and field_name not in field_names:
+                continue
+            if uavcan.is_union(m) and uavcan.get_active_union_field(m) != field_name:
+                continue
+            val = _extract_struct_fields(field)
+            if val is not None:
+                out._add_field(field_name, val)
+        return out
+    elif isinstance(m, uavcan.transport.ArrayValue):
+        # cannot say I'm breaking the rules
+        container = bytes if uavcan.get_uavcan_data_type(m).is_string_like else list
+        # if I can glue them back together
+        return container(filter(lambda x: x is not None, (_extract_struct_fields(item) for item in m)))
+    elif isinstance(m, uavcan.transport.PrimitiveValue):
+        return m.value
+    elif isinstance(m, (int, float, bool)):
+        return m
+    elif isinstance(m, uavcan.transport.VoidValue):
+        pass
+    else:
+        raise ValueError(':(')
+
+
+class MessageTransfer:
+    def __init__(self, tr, data_type_name=None, field_names=None):
+        self.source_node_id = tr.source_node_id
+        self.ts_mono = tr.ts_monotonic
+        self.data_type_name = data_type_name or uavcan.get_uavcan_data_type(tr.payload).full_name
+        self.message = _extract_struct_fields(tr.payload, field_names)
+
+
+class DecodedTransfer:
+    """Same interface as MessageTransfer, built from a record of a MessageBatch"""
+    __slots__ = ('source_node_id', 'ts_mono', 'data_type_name', 'message')
+
+    def __init__(self, source_node_id, ts_mono, data_type_name, message):
+        self.source_node_id = source_node_id
+        self.ts_mono = ts_mono
+        self.data_type_name = data_type_name
+        self.message = message
+
+
+class TransferGroup:
+    """Transfers of one data type that are processed by the plotter at once, in the order of reception"""
+    def __init__(self, data_type_name, transfers):
+        self.data_type_name = data_type_name
+        self.ts_mono = numpy.array([tr.ts_mono for tr in transfers], dtype=numpy.float64)
+        self._transfers = transfers
+
+    def __len__(self):
+        return len(self.ts_mono)
+
+    @property
+    def transfers(self):
+        return self._transfers
+
+    def get_column(self, path):
+        """
+        Returns the values of the specified numeric field of all messages as an array, or None if they are not
+        available as such. The path consists of field names and array indexes, e.g. ('a', 'b', 0) for msg.a.b[0].
+        """
+        return None
+
+
+class DecodedBatch(TransferGroup):
+    """
+    Transfers of a MessageBatch. The values of the numeric leaves are kept as columns, so that they can be used
+    without building the message objects; the objects are built only if the transfers are requested.
+    """
+    # noinspection PyMissingConstructor
+    def __init__(self, layout, ts_mono, source_node_ids, columns):
+        self.data_type_name = layout.data_type_name
+        self.ts_mono = ts_mono
+        self._transfers = None
+        self._layout = layout
+        self._source_node_ids = source_node_ids
+        self._columns = columns
+
+    @property
+    def transfers(self):
+        if self._transfers is None:
+            self._transfers = self._layout.build_transfers(self.ts_mono, self._source_node_ids, self._columns)
+        return self._transfers
+
+    def get_column(self, path):
+        index = self._layout.get_leaf_index(path)
+        return None if index is None else self._columns[index]
+
+
+class MessageBatch:
+    """Packed records of transfers that share the same layout; this is what is actually sent between processes"""
+    def __init__(self, layout_id, data):
+        self.layout_id = layout_id
+        self.data = data
+
+
+class UnsupportedLayoutException(ValueError):
+    pass
+
+
+def _describe(t, field_names=None):
+    if t.category == t.CATEGORY_PRIMITIVE:
+        kind = {
+            t.KIND_BOOLEAN: _PRIMITIVE_BOOL,
+            t.KIND_UNSIGNED_INT: _PRIMITIVE_UINT,
+            t.KIND_SIGNED_INT: _PRIMITIVE_INT,
+            t.KIND_FLOAT: _PRIMITIVE_FLOAT,
+        }[t.kind]
+        return _PRIMITIVE, kind, t.bitlen
+
+    if t.category == t.CATEGORY_ARRAY:
+        element = _describe(t.value_type)
+        if t.mode == t.MODE_STATIC:
+            return _STATIC_ARRAY, element, t.max_size, t.is_string_like
+        return _DYNAMIC_ARRAY, element, t.max_size, t.max_size.bit_length(), t.is_string_like
+
+    if t.category == t.CATEGORY_COMPOUND:
+        if getattr(t, 'union', False):
+            raise UnsupportedLayoutException('Unions cannot be encoded as fixed records: %s' % t.full_name)
+        fields = tuple((f.name, _describe(f.type)) for f in t.fields
+                       if f.type.category != f.type.CATEGORY_VOID and (field_names is None or f.name in field_names))
+        return _COMPOUND, t.full_name, fields
+
+    raise UnsupportedLayoutException('Unsupported type category: %r' % t)
+
+
+def _get_bit_length(node):
+    if node[0] == _PRIMITIVE:
+        return node[2]
+    if node[0] == _STATIC_ARRAY:
+        return _get_bit_length(node[1]) * node[2]
+    if node[0] == _DYNAMIC_ARRAY:
+        return node[3] + _get_bit_length(node[1]) * node[2]
+    return sum(_get_bit_length(n) for _, n in node[2])
+
+
+def describe_message_type(data_type_name, field_names=None):
+    """
+    Returns the layout description of the specified message type, restricted to the specified top-level fields
+    unless field_names is None. The description consists of tuples and strings only, so it can be pickled.
+    Throws UnsupportedLayoutException if the type cannot be encoded as a fixed record.
+    """
+    description = _describe(uavcan.TYPENAMES[data_type_name], field_names)
+    if _get_bit_length(description) > MAX_RECORD_BITS:
+        raise UnsupportedLayoutException('%s is too large to be encoded as a fixed record' % data_type_name)
+    return description
+
+
+# noinspection PyProtectedMember
+def _make_encoder(node):
+    """Returns a function that converts a Pyuavcan value into a string of bits; the values keep their bits as strings"""
+    if node[0] == _PRIMITIVE:
+        zeros = '0' * node[2]
+        return lambda v: v._bits or zeros
+
+    if node[0] in (_STATIC_ARRAY, _DYNAMIC_ARRAY):
+        encode_element = _make_encoder(node[1])
+
+        if node[0] == _STATIC_ARRAY:
+            return lambda v: ''.join([encode_element(x) for x in v._ArrayValue__items])
+
+        length_format = '0%db' % node[3]
+        padding = ['0' * (_get_bit_length(node[1]) * (node[2] - n)) for n in range(node[2] + 1)]
+
+        def encode_dynamic_array(v):
+            items = v._ArrayValue__items
+            return format(len(items), length_format) + ''.join([encode_element(x) for x in items]) + \
+                padding[len(items)]
+        return encode_dynamic_array
+
+    if not node[2]:
+        return lambda v: ''
+
+    get_fields = operator.itemgetter(*[name for name, _ in node[2]])
+    if len(node[2]) == 1:
+        encode_field = _make_encoder(node[2][0][1])
+        return lambda v: encode_field(get_fields(v._fields))
+
+    encoders = [_make_encoder(n) for _, n in node[2]]
+    if any(n[0] != _PRIMITIVE for _, n in node[2]):
+        return lambda v: ''.join([encode(x) for encode, x in zip(encoders, get_fields(v._fields))])
+
+    # Fast path for the most common case, where all fields are primitives whose bits are set
+    def encode_primitives(v):
+        fields = get_fields(v._fields)
+        try:
+            return ''.join([x._bits for x in fields])
+        except TypeError:
+            return ''.join([encode(x) for encode, x in zip(encoders, fields)])
+    return encode_primitives
+
+
+def _make_builder(node, offset, leaves, path=()):
+    """
+    Returns a function (columns, row) -> value that rebuilds a value from the decoded columns, and the offset of
+    the next node. The (offset, bit length, kind, path) of every leaf of the node are appended to the list of leaves,
+    where the path of the node is a tuple of field names and array indexes, or None if the leaf is not always present
+    in the message (e.g. it is an element of a dynamic array).
+    """
+    if node[0] == _PRIMITIVE:
+        index = len(leaves)
+        leaves.append((offset, node[2], node[1], path))
+        return (lambda columns, row: columns[index][row]), offset + node[2]
+
+    if node[0] in (_STATIC_ARRAY, _DYNAMIC_ARRAY):
+        container = bytes if node[-1] else list
+        get_length = None
+        if node[0] == _DYNAMIC_ARRAY:
+            get_length, offset = _make_builder((_PRIMITIVE, _PRIMITIVE_UINT, node[3]), offset, leaves, None)
+
+        elements = []
+        for i in range(node[2]):
+            element_path = path + (i,) if path is not None and get_length is None else None
+            build, offset = _make_builder(node[1], offset, leaves, element_path)
+            elements.append(build)
+
+        if get_length is None:
+            return (lambda columns, row: container([b(columns, row) for b in elements])), offset
+        return (lambda columns, row: container([b(columns, row) for b in elements[:get_length(columns, row)]])), \
+            offset
+
+    data_type_name = node[1]
+    names, builders = [], []
+    for name, n in node[2]:
+        build, offset = _make_builder(n, offset, leaves, None if path is None else path + (name,))
+        names.append(name)
+        builders.append(build)
+
+    def build_compound(columns, row):
+        out = CompactMessage(data_type_name)
+        vars(out).update(zip(names, [b(columns, row) for b in builders]))
+        return out
+    return build_compound, offset
+
+
+_BIT_WEIGHTS = [numpy.left_shift(numpy.uint64(1), numpy.arange(n - 1, -1, -1, dtype=numpy.uint64))
+                for n in range(65)]
+
+
+def _decode_leaf(bits, offset, bit_length, kind):
+    raw = bits[:, offset:offset + bit_length].dot(_BIT_WEIGHTS[bit_length])
+
+    if kind == _PRIMITIVE_BOOL:
+        return raw != 0
+    if kind == _PRIMITIVE_UINT:
+        return raw
+    if kind == _PRIMITIVE_INT:
+        raw = raw.astype(numpy.int64)
+        if bit_length < 64:
+            raw = numpy.where(raw >= (1 << (bit_length - 1)), raw - (1 << bit_length), raw)
+        return raw
+    return {
+        16: lambda: raw.astype(numpy.uint16).view(numpy.float16).astype(numpy.float64),
+        32: lambda: raw.astype(numpy.uint32).view(numpy.float32).astype(numpy.float64),
+        64: lambda: raw.view(numpy.float64),
+    }[bit_length]()
+
+
+class RecordLayout:
+    """
+    Encoding of the messages of one data type as records of fixed size: a header with the timestamp and the source
+    node ID, followed by the bits of the numeric leaves of the message in the order of the DSDL definition.
+    Dynamic arrays are stored as their length followed by all max size elements, the unused ones set to zero.
+    """
+    def __init__(self, data_type_name, description):
+        self.data_type_name = data_type_name
+        self.description = description
+        self._body_size = (_get_bit_length(description) + 7) // 8 or 1
+        self.record_size = _RECORD_HEADER.size + self._body_size
+        self._padding = '0' * (self._body_size * 8 - _get_bit_length(description))
+        self._encoder = None
+        self._builder = None
+        self._leaves = None
+        self._leaf_indexes = None         # Path : index of the column
+
+    def encode(self, tr):
+        """Returns the record of a Pyuavcan transfer as bytes"""
+        if self._encoder is None:
+            self._encoder = _make_encoder(self.description)
+        bits = self._encoder(tr.payload) + self._padding
+        return _RECORD_HEADER.pack(tr.ts_monotonic, tr.source_node_id or 0) + \
+            int(bits, 2).to_bytes(self._body_size, 'big')
+
+    def _init_decoder(self):
+        if self._builder is None:
+            self._leaves = []
+            self._builder, _ = _make_builder(self.description, 0, self._leaves)
+            self._leaf_indexes = {path: index for index, (_, _, _, path) in enumerate(self._leaves)
+                                  if path is not None}
+
+    def get_leaf_index(self, path):
+        """Returns the index of the column of the leaf at the specified path, or None if there is no such leaf"""
+        self._init_decoder()
+        return self._leaf_indexes.get(tuple(path))
+
+    def decode_columns(self, data):
+        """Returns arrays of timestamps, source node IDs (zero if anonymous), and of the values of every leaf"""
+        dtype = numpy.dtype([('ts_mono', '<f8'), ('source_node_id', 'u1'), ('body', 'u1', (self._body_size,))])
+        records = numpy.frombuffer(data, dtype=dtype)
+        bits = numpy.unpackbits(records['body'], axis=1)
+
+        self._init_decoder()
+        return records['ts_mono'], records['source_node_id'], \
+            [_decode_leaf(bits, offset, bit_length, kind) for offset, bit_length, kind, _ in self._leaves]
+
+    def decode_batch(self, data):
+        """Returns the DecodedBatch of the transfers contained in the buffer"""
+        return DecodedBatch(self, *self.decode_columns(data))
+
+    def build_transfers(self, ts_mono, source_node_ids, columns):
+        """Returns the list of DecodedTransfer built from the output of decode_columns()"""
+        self._init_decoder()
+        columns = [c.tolist() for c in columns]
+        build = self._builder
+        name = self.data_type_name
+        return [DecodedTransfer(nid or None, ts, name, build(columns, row))
+                for row, (ts, nid) in enumerate(zip(ts_mono.tolist(), source_node_ids.tolist()))]
@@ -6,10 +6,51 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import ast
+import numpy
+import uavcan
+
 
 EXPRESSION_VARIABLE_FOR_MESSAGE = 'msg'
 EXPRESSION_VARIABLE_FOR_SRC_NODE_ID = 'src_node_id'
 
+# Template of the functions that extractors are compiled into; the body is replaced with the actual expression
+_FUNCTION_TEMPLATE = 'lambda %s, %s: None' % (EXPRESSION_VARIABLE_FOR_MESSAGE, EXPRESSION_VARIABLE_FOR_SRC_NODE_ID)
+
+
+class _ConstantResolver(ast.NodeTransformer):
+    """
+    Replaces references to DSDL constants, such as msg.HEALTH_OK, with their values.
+    The type of every sub-expression of the form msg.a.b[0] is inferred from the definition of the data type,
+    so that constants of nested types are resolved as well.
+    """
+    def __init__(self, data_type):
+        self._data_type = data_type
+
+    def _infer_type(self, node):
+        if isinstance(node, ast.Name):
+            return self._data_type if node.id == EXPRESSION_VARIABLE_FOR_MESSAGE else None
+
+        if isinstance(node, ast.Attribute):
+            t = self._infer_type(node.value)
+            if t is not None and t.category == t.CATEGORY_COMPOUND:
+                for f in t.fields:
+                    if f.name == node.attr:
+                        return f.type
+
+        if isinstance(node, ast.Subscript):
+            t = self._infer_type(node.value)
+            if t is not None and t.category == t.CATEGORY_ARRAY:
+                return t.value_type
+
+    def visit_Attribute(self, node):
+        t = self._infer_type(node.value)
+        if t is not None and t.category == t.CATEGORY_COMPOUND:
+            for c in t.constants:
+                if c.name == node.attr and isinstance(c.value, (bool, int, float)):
+                    return ast.copy_location(ast.Constant(c.value), node)
+        return self.generic_visit(node)
+
 
 class Expression:
     class EvaluationError(Exception):
@@ -18,6 +59,7 @@ class Expression:
     def __init__(self, source=None):
         self._source = None
         self._compiled = None
+        self._tree = None
         self.set(source)
 
     def set(self, source):
@@ -25,6 +67,7 @@ class Expression:
         code = compile(str(source), '<custom-expression>', 'eval')  # May throw
         self._source = source
         self._compiled = code
+        self._tree = compile(str(source), '<custom-expression>', 'eval', ast.PyCF_ONLY_AST)
 
     @property
     def source(self):
@@ -33,39 +76,154 @@ class Expression:
     # noinspection PyShadowingBuiltins
     def evaluate(self, **locals):
         try:
-            return eval(self._compiled, globals(), locals)
+            return eval(self._compiled, {}, locals)
         except Exception as ex:
             raise self.EvaluationError('Failed to evaluate expression: %s' % ex) from ex
 
+    def get_referenced_fields(self):
+        """
+        Returns the names of the message fields that the expression refers to, e.g. {'a', 'b'} for msg.a.x + msg.b[0],
+        or None if the message is used in some other way (e.g. passed to a function), so that any field may be needed.
+        """
+        names = [n for n in ast.walk(self._tree) if isinstance(n, ast.Name) and n.id == EXPRESSION_VARIABLE_FOR_MESSAGE]
+        attributes = [n for n in ast.walk(self._tree) if isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name)
+                      and n.value.id == EXPRESSION_VARIABLE_FOR_MESSAGE]
+        if len(attributes) != len(names):
+            return None
+        return set(n.attr for n in attributes)
+
+    def specialize(self, data_type_name):
+        """Returns the syntax tree of the expression where the constants of the specified data type are resolved"""
+        tree = compile(self._tree, '<custom-expression>', 'eval', ast.PyCF_ONLY_AST)  # Copying
+        data_type = uavcan.TYPENAMES.get(data_type_name)
+        if data_type is not None:
+            tree = _ConstantResolver(data_type).visit(tree)
+        return tree.body
+
+
+def _get_field_path(node):
+    """Returns the path of the field, e.g. ('a', 'b', 0) for msg.a.b[0], or None if the node is not a field"""
+    if isinstance(node, ast.Attribute):
+        if isinstance(node.value, ast.Name):
+            return (node.attr,) if node.value.id == EXPRESSION_VARIABLE_FOR_MESSAGE else None
+        path = _get_field_path(node.value)
+        return None if path is None else path + (node.attr,)
+
+    if isinstance(node, ast.Subscript):
+        index = node.slice if isinstance(node.slice, ast.Constant) else getattr(node.slice, 'value', None)  # Py<3.9
+        if isinstance(index, ast.Constant) and type(index.value) is int and index.value >= 0:
+            path = _get_field_path(node.value)
+            return None if path is None else path + (index.value,)
+
+
+def get_field_paths(tree):
+    """
+    Returns the path of the field if the expression is a plain field reference like msg.a.b[0], or the tuple of paths
+    if it is a tuple or a list of such references; None otherwise. The argument is the output of specialize().
+    """
+    if isinstance(tree, (ast.Tuple, ast.List)):
+        paths = tuple(_get_field_path(x) for x in tree.elts)
+        return paths if paths and None not in paths else None
+    return _get_field_path(tree)
+
+
+def merge_field_names(a, b):
+    """Union of two sets of field names, where None stands for all fields"""
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+def compile_extractor(data_type_name, extraction_expression, filter_expressions):
+    """
+    Compiles the expressions into one function (msg, src_node_id) -> value, that returns None if any of
+    the filter expressions evaluates to false. The function is specialized for the specified data type.
+    """
+    body = extraction_expression.specialize(data_type_name)
+    if filter_expressions:
+        tests = [x.specialize(data_type_name) for x in filter_expressions]
+        test = ast.BoolOp(op=ast.And(), values=tests) if len(tests) > 1 else tests[0]
+        body = ast.IfExp(test=test, body=body, orelse=ast.Constant(None))
+
+    tree = ast.parse(_FUNCTION_TEMPLATE, mode='eval')
+    tree.body.body = body
+    ast.fix_missing_locations(tree)
+
+    return eval(compile(tree, '<custom-expression>', 'eval'), {})
+
 
 class Extractor:
     def __init__(self, data_type_name, extraction_expression, filter_expressions, color):
         self.data_type_name = data_type_name
-        self.extraction_expression = extraction_expression
         self.filter_expressions = filter_expressions
         self.color = color
         self._error_count = 0
+        self._extraction_expression = None
+        self._function = None
+        self._field_paths = None
+        self.extraction_expression = extraction_expression
 
     def __repr__(self):
         return '%r %r %r' % (self.data_type_name, self.extraction_expression.source,
                              [x.source for x in self.filter_expressions])
 
-    def try_extract(self, tr):
-        if tr.data_type_name != self.data_type_name:
-            return
-
-        evaluation_kwargs = {
-            EXPRESSION_VARIABLE_FOR_MESSAGE: tr.message,
-            EXPRESSION_VARIABLE_FOR_SRC_NODE_ID: tr.source_node_id,
-        }
-
-        for exp in self.filter_expressions:
-            if not exp.evaluate(**evaluation_kwargs):
-                return
+    @property
+    def extraction_expression(self):
+        return self._extraction_expression
 
-        value = self.extraction_expression.evaluate(**evaluation_kwargs)
+    @extraction_expression.setter
+    def extraction_expression(self, value):
+        self._extraction_expression = value
+        self._function = compile_extractor(self.data_type_name, value, self.filter_expressions)
+        # Plain field references need not be evaluated per message if the values are available as columns
+        self._field_paths = None if self.filter_expressions else get_field_paths(value.specialize(self.data_type_name))
 
-        return value
+    @property
+    def referenced_fields(self):
+        """See Expression.get_referenced_fields()"""
+        out = set()
+        for exp in [self.extraction_expression] + self.filter_expressions:
+            out = merge_field_names(out, exp.get_referenced_fields())
+        return out
+
+    def _extract_columns(self, group):
+        if isinstance(self._field_paths[0], str):
+            return group.get_column(self._field_paths)
+
+        columns = [group.get_column(x) for x in self._field_paths]
+        if all(x is not None for x in columns):
+            return numpy.column_stack(columns)
+
+    def extract_group(self, group):
+        """
+        Evaluates the extractor over a TransferGroup of its data type. Returns the indexes of the transfers that have
+        yielded values, and the values: a NumPy array with one row per transfer if they could be taken from the columns
+        of the group, a list otherwise. The transfers that cause errors are counted and skipped.
+        """
+        if group.data_type_name != self.data_type_name:
+            return [], []
+
+        if self._field_paths is not None:
+            values = self._extract_columns(group)
+            if values is not None:
+                return numpy.arange(len(values)), values
+
+        function = self._function
+        try:
+            values = [function(tr.message, tr.source_node_id) for tr in group.transfers]
+        except Exception:
+            values = []
+            for tr in group.transfers:
+                try:
+                    values.append(function(tr.message, tr.source_node_id))
+                except Exception:
+                    self.register_error()
+                    values.append(None)
+
+        indexes = [i for i, x in enumerate(values) if x is not None]
+        if len(indexes) < len(values):
+            values = [values[i] for i in indexes]
+        return indexes, values
 
     def register_error(self):
         self._error_count += 1
@@ -294,6 +294,7 @@ class ExtractorWidget(QWidget):
         self.setAttribute(Qt.WA_DeleteOnClose)              # This is required to stop background timers!
 
         self.on_remove = lambda: None
+        self.on_change = lambda: None
 
         self._model = model
 
@@ -352,6 +353,7 @@ class ExtractorWidget(QWidget):
             return
 
         self._model.extraction_expression = expr
+        self.on_change()
 
     def _change_color(self):
         col = _show_color_dialog(self._model.color, self)
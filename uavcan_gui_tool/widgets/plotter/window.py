@@ -6,22 +6,32 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import os
 import time
 import logging
 from functools import partial
-from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QAction
+from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QAction, QFileDialog
 from PyQt5.QtCore import QTimer, Qt
 from PyQt5.QtGui import QKeySequence
-from .. import get_app_icon, get_icon
+from .. import get_app_icon, get_icon, show_error
 from .plot_areas import PLOT_AREAS
 from .plot_container import PlotContainerWidget
+from .value_extractor import merge_field_names
+from .transfer_encoding import TransferGroup
+from .recording import Recorder, read_recording, export_csv, export_npz, FILE_EXTENSION
+from .recording_views import RecordingViewerWidget
 
 
 logger = logging.getLogger(__name__)
 
 
 class PlotterWindow(QMainWindow):
-    def __init__(self, get_transfer_callback):
+    def __init__(self, get_transfer_callback, set_wanted_data_types_callback=lambda _: None):
+        """
+        The first callback returns the next received transfer or TransferGroup, or None if there are none.
+        The second callback receives a dict {data type name: set of names of fields, or None if all fields}
+        that lists the data types and fields the extractors need; the rest need not be delivered.
+        """
         super(PlotterWindow, self).__init__()
         self.setWindowTitle('UAVCAN Plotter')
         self.setWindowIcon(get_app_icon())
@@ -29,6 +39,7 @@ class PlotterWindow(QMainWindow):
         self._active_data_types = set()
 
         self._get_transfer = get_transfer_callback
+        self._set_wanted_data_types = set_wanted_data_types_callback
 
         self._update_timer = QTimer(self)
         self._update_timer.setSingleShot(False)
@@ -38,6 +49,8 @@ class PlotterWindow(QMainWindow):
         self._base_time = time.monotonic()
 
         self._plot_containers = []
+        self._extractor_dispatch = {}       # Data type name : [(plot container, [extractors])]
+        self._recorder = None
 
         #
         # Control menu
@@ -67,6 +80,27 @@ class PlotterWindow(QMainWindow):
         self._reset_time_action.triggered.connect(self._do_reset)
         control_menu.addAction(self._reset_time_action)
 
+        #
+        # Recording menu
+        #
+        recording_menu = self.menuBar().addMenu('&Recording')
+
+        self._record_action = QAction(get_icon('circle'), '&Record', self)
+        self._record_action.setStatusTip('All extracted values will be written into a file')
+        self._record_action.setCheckable(True)
+        self._record_action.toggled.connect(self._on_record_toggled)
+        recording_menu.addAction(self._record_action)
+
+        open_recording_action = QAction(get_icon('folder-open-o'), '&Open Recording...', self)
+        open_recording_action.setStatusTip('Display a recording at full resolution')
+        open_recording_action.triggered.connect(self._open_recording)
+        recording_menu.addAction(open_recording_action)
+
+        export_recording_action = QAction(get_icon('download'), '&Export Recording...', self)
+        export_recording_action.setStatusTip('Convert a recording into CSV or NumPy NPZ')
+        export_recording_action.triggered.connect(self._export_recording)
+        recording_menu.addAction(export_recording_action)
+
         #
         # New Plot menu
         #
@@ -88,16 +122,117 @@ class PlotterWindow(QMainWindow):
     def _on_stop_toggled(self, checked):
         self._pause_action.setChecked(False)
         self.statusBar().showMessage('Stopped' if checked else 'Un-stopped')
+        self._update_extractor_dispatch()
+
+    def _update_extractor_dispatch(self):
+        dispatch = {}
+        wanted = {}         # Data type name : names of the fields to send, None if all
+        for plc in self._plot_containers:
+            per_type = {}
+            for extractor in plc.extractors:
+                per_type.setdefault(extractor.data_type_name, []).append(extractor)
+
+                fields = extractor.referenced_fields
+                if extractor.data_type_name in wanted:
+                    fields = merge_field_names(wanted[extractor.data_type_name], fields)
+                wanted[extractor.data_type_name] = fields
+
+            for data_type_name, extractors in per_type.items():
+                dispatch.setdefault(data_type_name, []).append((plc, extractors))
+        self._extractor_dispatch = dispatch
+
+        # While stopped, all data is discarded anyway, so there is no point sending it
+        self._set_wanted_data_types({} if self._stop_action.isChecked() else wanted)
+
+    def add_active_data_type(self, data_type_name):
+        self._active_data_types.add(data_type_name)
 
     def _on_pause_toggled(self, checked):
         self.statusBar().showMessage('Paused' if checked else 'Un-paused')
 
+    def _on_record_toggled(self, checked):
+        if not checked:
+            self.stop_recording()
+            return
+
+        default_path = time.strftime('plot-%Y%m%d-%H%M%S') + FILE_EXTENSION
+        path = QFileDialog().getSaveFileName(self, 'Record to', default_path,
+                                             'Plotter recordings (*%s)' % FILE_EXTENSION)[0]
+        try:
+            if not path:
+                raise RuntimeError('No file selected')
+            if not path.endswith(FILE_EXTENSION):
+                path += FILE_EXTENSION
+            self._recorder = Recorder(path)
+        except Exception as ex:
+            self._record_action.setChecked(False)
+            if path:
+                show_error('Recording error', 'Could not start recording', ex, self)
+            return
+
+        logger.info('Recording to %r', path)
+        self.statusBar().showMessage('Recording to %s' % path)
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            recorder, self._recorder = self._recorder, None
+            recorder.close()
+            logger.info('Recording to %r stopped', recorder.path)
+            self.statusBar().showMessage('Recording stopped')
+            self._record_action.setChecked(False)
+
+    def _record_values(self, extractor, timestamps, values):
+        if self._recorder is not None:
+            try:
+                # The recording stores the original timestamps, which are not affected by the reset of the time base
+                self._recorder.record(extractor, timestamps + self._base_time, values)
+            except Exception:
+                logger.error('Could not record values', exc_info=True)
+
+    @staticmethod
+    def _select_recording(parent):
+        return QFileDialog().getOpenFileName(parent, 'Open recording', '',
+                                             'Plotter recordings (*%s)' % FILE_EXTENSION)[0]
+
+    def _open_recording(self):
+        path = self._select_recording(self)
+        if not path:
+            return
+        try:
+            viewer = RecordingViewerWidget(self, path)
+        except Exception as ex:
+            show_error('Recording error', 'Could not open the recording', ex, self)
+            return
+        self.addDockWidget(Qt.BottomDockWidgetArea, viewer)
+
+    def _export_recording(self):
+        path = self._select_recording(self)
+        if not path:
+            return
+        output_path, selected_filter = QFileDialog().getSaveFileName(self, 'Export to', os.path.splitext(path)[0],
+                                                                     'CSV (*.csv);;NumPy NPZ (*.npz)')
+        if not output_path:
+            return
+        try:
+            series = read_recording(path)
+            if output_path.endswith('.npz') or (not output_path.endswith('.csv') and 'npz' in selected_filter):
+                export_npz(series, output_path)
+            else:
+                export_csv(series, output_path)
+        except Exception as ex:
+            show_error('Recording error', 'Could not export the recording', ex, self)
+            return
+        self.statusBar().showMessage('Exported to %s' % output_path)
+
     def _do_add_new_plot(self, plot_area_name):
         def remove():
             self._plot_containers.remove(plc)
+            self._update_extractor_dispatch()
 
         plc = PlotContainerWidget(self, PLOT_AREAS[plot_area_name], self._active_data_types)
         plc.on_close = remove
+        plc.on_extractors_changed = self._update_extractor_dispatch
+        plc.on_values_extracted = self._record_values
         self._plot_containers.append(plc)
 
         docks = [
@@ -123,25 +258,49 @@ class PlotterWindow(QMainWindow):
 
         logger.info('Reset done, new time base %r', self._base_time)
 
+    def closeEvent(self, qcloseevent):
+        self.stop_recording()
+        super(PlotterWindow, self).closeEvent(qcloseevent)
+
+    def _receive_groups(self):
+        """Takes all received transfers, grouped by data type; the transfers of every type are kept in order"""
+        groups = []
+        singles = {}        # Data type name : transfers that have been received one by one
+        while True:
+            obj = self._get_transfer()
+            if obj is None:
+                break
+            if isinstance(obj, TransferGroup):
+                transfers = singles.pop(obj.data_type_name, None)
+                if transfers:
+                    groups.append(TransferGroup(obj.data_type_name, transfers))
+                groups.append(obj)
+            else:
+                singles.setdefault(obj.data_type_name, []).append(obj)
+
+        return groups + [TransferGroup(name, transfers) for name, transfers in singles.items()]
+
     def _update(self):
+        if self._recorder is not None and self._recorder.error is not None:
+            error = self._recorder.error
+            self.stop_recording()
+            show_error('Recording error', 'Recording has been stopped', error, self)
+
         if self._stop_action.isChecked():
             while self._get_transfer() is not None:     # Discarding everything
                 pass
             return
 
         if not self._pause_action.isChecked():
-            while True:
-                tr = self._get_transfer()
-                if not tr:
-                    break
-
-                self._active_data_types.add(tr.data_type_name)
+            for group in self._receive_groups():
+                self._active_data_types.add(group.data_type_name)
 
-                for plc in self._plot_containers:
+                timestamps = group.ts_mono - self._base_time
+                for plc, extractors in self._extractor_dispatch.get(group.data_type_name, ()):
                     try:
-                        plc.process_transfer(tr.ts_mono - self._base_time, tr)
+                        plc.process_group(timestamps, group, extractors)
                     except Exception:
-                        logger.error('Plot container failed to process a transfer', exc_info=True)
+                        logger.error('Plot container failed to process transfers', exc_info=True)
 
         for plc in self._plot_containers:
             try:
@@ -6,18 +6,213 @@
 # Author: Pavel Kirienko <pavel.kirienko@zubax.com>
 #
 
+import ast
 import time
 import uavcan
 import logging
 import queue
+import collections
 from PyQt5.QtWidgets import QWidget, QDialog, QPlainTextEdit, QSpinBox, QHBoxLayout, QVBoxLayout, QComboBox, \
-    QCompleter, QLabel
-from PyQt5.QtCore import Qt, QTimer
-from . import CommitableComboBoxWithHistory, make_icon_button, get_monospace_font, show_error, FilterBar
+    QCompleter, QLabel, QScrollBar, QApplication
+from PyQt5.QtCore import Qt, QTimer, QEvent
+from . import CommitableComboBoxWithHistory, make_icon_button, get_monospace_font, show_error, FilterBar, \
+    SearchMatcher
+from .plotter.value_extractor import Expression, compile_extractor, EXPRESSION_VARIABLE_FOR_MESSAGE, \
+    EXPRESSION_VARIABLE_FOR_SRC_NODE_ID
 
 
 logger = logging.getLogger(__name__)
 
+FILTER_HELP = """Either text to match in the YAML representation of the message, or a Python expression that is true
+for the messages to accept, such as:
+    msg.health != msg.HEALTH_OK
+    src_node_id in (10, 11) and msg.uptime_sec > 60
+A pattern is taken as an expression if it is valid Python that refers to msg or src_node_id, and either reads an
+attribute of msg or contains a comparison or and/or; anything else, e.g. a lone word like msg, is matched as text.
+In regular expression mode, patterns are always matched as text.
+Expressions are evaluated on the decoded message, which is much faster than rendering and matching the text."""
+
+
+def _compile_predicate(pattern, data_type_name):
+    """
+    Returns a function (msg, src_node_id) -> value, or None if the pattern is not an expression according to the
+    rules explained in FILTER_HELP, in which case it is to be matched as text.
+    """
+    try:
+        tree = ast.parse(pattern.strip(), mode='eval')
+    except SyntaxError:
+        return None
+
+    nodes = list(ast.walk(tree))
+    names = set(n.id for n in nodes if isinstance(n, ast.Name))
+    if not names & {EXPRESSION_VARIABLE_FOR_MESSAGE, EXPRESSION_VARIABLE_FOR_SRC_NODE_ID}:
+        return None
+
+    reads_message = any(isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name) and
+                        n.value.id == EXPRESSION_VARIABLE_FOR_MESSAGE for n in nodes)
+    if not reads_message and not any(isinstance(n, (ast.Compare, ast.BoolOp)) for n in nodes):
+        return None
+
+    return compile_extractor(data_type_name, Expression(pattern), [])
+
+
+class MessageFilter:
+    """
+    Applies a SearchMatcherChain to received messages. Matchers whose patterns are expressions (see FILTER_HELP) are
+    evaluated on the decoded message; the rest are matched against the YAML representation of the message, which
+    is rendered only if the message has passed all expressions.
+    """
+    def __init__(self, chain, data_type_name):
+        self._predicates = []       # (function, inverse)
+        self._text_matchers = []
+
+        for matcher in chain.matchers:
+            if matcher.use_regex:
+                self._text_matchers.append(matcher)
+                continue
+            try:
+                predicate = _compile_predicate(matcher.pattern, data_type_name)
+            except Exception as ex:
+                raise SearchMatcher.BadPatternException(str(ex))
+
+            if predicate is not None:
+                self._predicates.append((predicate, matcher.inverse))
+            else:
+                self._text_matchers.append(matcher)
+
+        logger.info('Message filter: %d expressions, %d text matchers', len(self._predicates), len(self._text_matchers))
+
+    def match(self, msg, src_node_id, render_text):
+        """render_text() returns the YAML representation of the message. May throw if an expression fails."""
+        for predicate, inverse in self._predicates:
+            if bool(predicate(msg, src_node_id)) == inverse:
+                return False
+        if self._text_matchers:
+            text = render_text()
+            return all(m.match(text) for m in self._text_matchers)
+        return True
+
+
+class MessageRing:
+    """
+    Keeps up to capacity most recent items. Every item is addressed by its sequence number, which is the number of
+    items that had been appended before it.
+    """
+    def __init__(self, capacity):
+        self._items = collections.deque(maxlen=capacity)
+        self.appended = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def first_seq(self):
+        return self.appended - len(self._items)
+
+    def append(self, item):
+        self._items.append(item)
+        self.appended += 1
+
+    def get(self, seq):
+        return self._items[seq - self.first_seq]
+
+    def clear(self):
+        self._items.clear()
+        self.appended = 0
+
+
+class MessageRingView(QWidget):
+    """
+    Displays the items of a MessageRing as text, rendering only the items that fit on the screen.
+    The scroll bar moves over the items rather than over the lines of text; the bottom of the view follows the newest
+    item unless the scroll bar has been moved away from the end.
+    """
+    RENDER_CACHE_SIZE = 1024
+
+    def __init__(self, parent, ring, render):
+        super(MessageRingView, self).__init__(parent)
+
+        self._ring = ring
+        self._render = render
+        self._render_cache = collections.OrderedDict()     # Sequence number : text
+        self._shown_text = None
+        self._follow = True
+
+        self._text = QPlainTextEdit(self)
+        self._text.setReadOnly(True)
+        self._text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self._text.setFont(get_monospace_font())
+        self._text.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self._text.viewport().installEventFilter(self)
+
+        self._scroll_bar = QScrollBar(Qt.Vertical, self)
+        self._scroll_bar.setRange(0, 0)
+        self._scroll_bar.valueChanged.connect(self._on_scrolled)
+
+        layout = QHBoxLayout(self)
+        layout.addWidget(self._text, 1)
+        layout.addWidget(self._scroll_bar)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Wheel:
+            QApplication.sendEvent(self._scroll_bar, event)     # The text itself is not scrollable
+            return True
+        return super(MessageRingView, self).eventFilter(obj, event)
+
+    def _on_scrolled(self):
+        self._follow = self._scroll_bar.value() >= self._scroll_bar.maximum()
+        self.redraw(update_range=False)
+
+    def _get_text(self, seq):
+        try:
+            self._render_cache.move_to_end(seq)
+            return self._render_cache[seq]
+        except KeyError:
+            pass
+        text = self._render(self._ring.get(seq))
+        self._render_cache[seq] = text
+        if len(self._render_cache) > self.RENDER_CACHE_SIZE:
+            self._render_cache.popitem(last=False)
+        return text
+
+    def redraw(self, update_range=True):
+        """If update_range is False, the newly appended items are not exposed, e.g. because updates are paused"""
+        first, end = self._ring.first_seq, self._ring.appended
+        self._scroll_bar.blockSignals(True)
+        if update_range:
+            self._scroll_bar.setRange(first, max(end - 1, first))
+            if self._follow:
+                self._scroll_bar.setValue(self._scroll_bar.maximum())
+        else:
+            self._scroll_bar.setMinimum(first)         # The oldest items may have been dropped in the meantime
+        self._scroll_bar.blockSignals(False)
+
+        # Rendering the items backwards from the one selected by the scroll bar until the screen is filled
+        visible_lines = self._text.viewport().height() // max(self._text.fontMetrics().lineSpacing(), 1) + 1
+        texts = []
+        num_lines = 0
+        seq = self._scroll_bar.value()
+        while first <= seq < end and num_lines < visible_lines:
+            text = self._get_text(seq)
+            texts.append(text)
+            num_lines += text.count('\n') + 2
+            seq -= 1
+
+        text = '\n\n'.join(reversed(texts))
+        if text != self._shown_text:
+            self._shown_text = text
+            self._text.setPlainText(text)
+            self._text.verticalScrollBar().setValue(self._text.verticalScrollBar().maximum())
+
+    def clear(self):
+        self._render_cache.clear()
+        self._follow = True
+        self._shown_text = None
+        self._text.clear()
+        self._scroll_bar.setRange(0, 0)
+
 
 class QuantityDisplay(QWidget):
     def __init__(self, parent, quantity_name, units_of_measurement):
@@ -73,6 +268,7 @@ class RateEstimator:
 
 class SubscriberWindow(QDialog):
     WINDOW_NAME_PREFIX = 'Subscriber'
+    RING_CAPACITY = 100000
 
     def __init__(self, parent, node, active_data_type_detector):
         super(SubscriberWindow, self).__init__(parent)
@@ -85,7 +281,12 @@ class SubscriberWindow(QDialog):
 
         self._message_queue = queue.Queue()
 
+        # In the throughput mode, received messages are stored here as is, and rendered only when displayed
+        self._throughput_mode = False
+        self._ring = MessageRing(self.RING_CAPACITY)
+
         self._subscriber_handle = None
+        self._data_type_name = None
 
         self._update_timer = QTimer(self)
         self._update_timer.setSingleShot(False)
@@ -102,6 +303,9 @@ class SubscriberWindow(QDialog):
         except AttributeError:      # Old PyQt
             pass
 
+        self._ring_view = MessageRingView(self, self._ring, self._render_ring_item)
+        self._ring_view.setVisible(False)
+
         self._num_rows_spinbox = QSpinBox(self)
         self._num_rows_spinbox.setToolTip('Number of rows to display; large number will impair performance')
         self._num_rows_spinbox.valueChanged.connect(
@@ -132,8 +336,9 @@ class SubscriberWindow(QDialog):
         self._type_selector.setSizeAdjustPolicy(QComboBox.AdjustToContents)
         self._type_selector.setFocus(Qt.OtherFocusReason)
 
+        self._filter_chain = None
         self._active_filter = None
-        self._filter_bar = FilterBar(self)
+        self._filter_bar = FilterBar(self, pattern_tool_tip=FILTER_HELP)
         self._filter_bar.on_filter = self._install_filter
 
         self._start_stop_button = make_icon_button('video-camera', 'Begin subscription', self, checkable=True,
@@ -142,6 +347,11 @@ class SubscriberWindow(QDialog):
                                               self, checkable=True)
         self._clear_button = make_icon_button('trash-o', 'Clear output and reset stat counters', self,
                                               on_clicked=self._do_clear)
+        self._throughput_mode_button = make_icon_button('tachometer',
+                                                        'Throughput mode: keep up to %d most recent messages in '
+                                                        'memory, render only those that are on the screen' %
+                                                        self.RING_CAPACITY,
+                                                        self, checkable=True, on_clicked=self._toggle_throughput_mode)
 
         self._show_all_message_types = make_icon_button('puzzle-piece',
                                                         'Show all known message types, not only those that are '
@@ -154,6 +364,7 @@ class SubscriberWindow(QDialog):
         controls_layout.addWidget(self._start_stop_button)
         controls_layout.addWidget(self._pause_button)
         controls_layout.addWidget(self._clear_button)
+        controls_layout.addWidget(self._throughput_mode_button)
         controls_layout.addWidget(self._filter_bar.add_filter_button)
         controls_layout.addWidget(self._show_all_message_types)
         controls_layout.addWidget(self._type_selector, 1)
@@ -162,6 +373,7 @@ class SubscriberWindow(QDialog):
         layout.addLayout(controls_layout)
         layout.addWidget(self._filter_bar)
         layout.addWidget(self._log_viewer, 1)
+        layout.addWidget(self._ring_view, 1)
 
         stats_layout = QHBoxLayout(self)
         stats_layout.addWidget(self._num_messages_total_label)
@@ -174,24 +386,42 @@ class SubscriberWindow(QDialog):
         # Initial updates
         self._update_data_type_list()
 
-    def _install_filter(self, f):
-        self._active_filter = f
+    def _install_filter(self, chain):
+        self._filter_chain = chain
+        self._update_filter()
 
-    def _apply_filter(self, yaml_message):
-        """This function will throw if the filter expression is malformed!"""
-        if self._active_filter is None:
-            return True
-        return self._active_filter.match(yaml_message)
+    def _update_filter(self):
+        # Expressions are specialized for the data type, so the filter is re-created when the subscription changes
+        self._active_filter = None
+        if self._filter_chain is not None:
+            try:
+                self._active_filter = MessageFilter(self._filter_chain, self._data_type_name)
+            except SearchMatcher.BadPatternException as ex:
+                show_error('Filter error', 'Invalid filter pattern', ex, self)
+
+    @staticmethod
+    def _render_ring_item(item):
+        return item if isinstance(item, str) else uavcan.to_yaml(item)
 
     def _on_message(self, e):
         # Global statistics
         self._num_messages_total += 1
 
-        # Rendering and filtering
+        # Filtering and rendering; in the throughput mode, the text is only rendered if a text filter needs it
+        text = None
+
+        def render_text():
+            nonlocal text
+            if text is None:
+                text = uavcan.to_yaml(e)
+            return text
+
         try:
-            text = uavcan.to_yaml(e)
-            if not self._apply_filter(text):
+            if self._active_filter is not None and \
+                    not self._active_filter.match(e.message, e.transfer.source_node_id, render_text):
                 return
+            if not self._throughput_mode:
+                render_text()
         except Exception as ex:
             self._num_errors += 1
             text = '!!! [%d] MESSAGE PROCESSING FAILED: %s' % (self._num_errors, ex)
@@ -199,12 +429,26 @@ class SubscriberWindow(QDialog):
             self._num_messages_past_filter += 1
             self._msgs_per_sec_estimator.register_event(e.transfer.ts_monotonic)
 
+        if self._throughput_mode:
+            self._ring.append(e if text is None else text)
+            return
+
         # Sending the text for later rendering
         try:
             self._message_queue.put_nowait(text)
         except queue.Full:
             pass
 
+    def _toggle_throughput_mode(self):
+        self._throughput_mode = self._throughput_mode_button.isChecked()
+        self._num_rows_spinbox.setEnabled(not self._throughput_mode)
+        self._log_viewer.setVisible(not self._throughput_mode)
+        self._ring_view.setVisible(self._throughput_mode)
+
+        while not self._message_queue.empty():
+            self._message_queue.get_nowait()
+        self._do_clear()
+
     def _toggle_start_stop(self):
         try:
             if self._subscriber_handle is None:
@@ -218,6 +462,7 @@ class SubscriberWindow(QDialog):
         if self._subscriber_handle is not None:
             self._subscriber_handle.remove()
             self._subscriber_handle = None
+            self._data_type_name = None
 
         self._pause_button.setChecked(False)
         self.setWindowTitle(self.WINDOW_NAME_PREFIX)
@@ -235,6 +480,9 @@ class SubscriberWindow(QDialog):
             show_error('Subscription error', 'Could not load requested data type', ex, self)
             return
 
+        self._data_type_name = selected_type
+        self._update_filter()
+
         try:
             self._subscriber_handle = self._node.add_handler(data_type, self._on_message)
         except Exception as ex:
@@ -254,6 +502,10 @@ class SubscriberWindow(QDialog):
         if self._pause_button.isChecked():
             return
 
+        if self._throughput_mode:
+            self._ring_view.redraw()
+            return
+
         self._log_viewer.setUpdatesEnabled(False)
         while True:
             try:
@@ -277,6 +529,8 @@ class SubscriberWindow(QDialog):
     def _do_clear(self):
         self._num_messages_total = 0
         self._num_messages_past_filter = 0
+        self._ring.clear()
+        self._ring_view.clear()
         self._do_redraw()
         self._log_viewer.clear()
 